@@ -0,0 +1,274 @@
+# src/asgi_server.py
+"""
+Асинхронный (ASGI) режим стримингового сервера: те же маршруты, что и у Flask-версии
+в inference_server.py, но на Starlette + Uvicorn.
+
+Клиенты не занимают поток каждый: пакеты из FrameBroadcaster (он живет в потоках
+конвейера) передаются в event loop одним потоком-мостом на broadcaster, а у каждого
+клиента своя ограниченная очередь отправки. Если клиент не успевает забирать кадры
+(медленный Wi-Fi), старые кадры в его очереди выбрасываются - память не растет,
+а остальные клиенты не замедляются. Uvicorn при этом сам приостанавливает запись
+в сокет, пока клиент не вычитает буфер.
+
+При остановке (Ctrl+C / SIGTERM) потоки клиентов закрываются, конвейер
+останавливается, а VideoCapture источников освобождаются.
+"""
+import asyncio
+import contextlib
+import json
+import threading
+from urllib.parse import parse_qs
+
+import uvicorn
+from starlette.applications import Starlette
+from starlette.exceptions import HTTPException
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Route
+
+import metrics
+
+# Маркер конца потока для клиентских очередей
+_END = object()
+
+CLIENT_DROPS = metrics.REGISTRY.counter(
+    'wdd_client_frames_dropped_total', 'Пакеты, выброшенные из очередей медленных клиентов.')
+
+
+def _put_latest(q, item):
+    """put_latest для asyncio.Queue: при переполнении выбрасывает самые старые элементы."""
+    dropped = 0
+    while True:
+        try:
+            q.put_nowait(item)
+            return dropped
+        except asyncio.QueueFull:
+            try:
+                q.get_nowait()
+                dropped += 1
+            except asyncio.QueueEmpty:
+                pass
+
+
+class AsyncFanout:
+    """
+    Мост из FrameBroadcaster в asyncio. Поток-мост подписан на broadcaster, только пока
+    есть хотя бы один клиент (иначе источник не тратит CPU на отрисовку), и раздает
+    каждый пакет по клиентским очередям размера buffer_size.
+    """
+
+    def __init__(self, broadcaster, loop, buffer_size=2, labels=None):
+        self.broadcaster = broadcaster
+        self.loop = loop
+        self.buffer_size = buffer_size
+        self.labels = labels or {}
+        self._clients = set()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._closed = False
+
+    @property
+    def client_count(self):
+        return len(self._clients)
+
+    def connect(self):
+        q = asyncio.Queue(maxsize=self.buffer_size)
+        with self._lock:
+            if self._closed:
+                q.put_nowait(_END)
+                return q
+            self._clients.add(q)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="asgi-fanout", daemon=True)
+                self._thread.start()
+        return q
+
+    def disconnect(self, q):
+        with self._lock:
+            self._clients.discard(q)
+
+    def close(self):
+        """Завершает потоки всех клиентов (используется при остановке сервера)."""
+        with self._lock:
+            self._closed = True
+        self._call(self._dispatch, _END)
+
+    def _call(self, callback, *args):
+        try:
+            self.loop.call_soon_threadsafe(callback, *args)
+        except RuntimeError:
+            pass  # event loop уже закрыт
+
+    def _run(self):
+        for packet in self.broadcaster.subscribe():
+            with self._lock:
+                if not self._clients or self._closed:
+                    self._thread = None
+                    return
+            self._call(self._dispatch, packet)
+        # broadcaster закрыт - источник закончился или конвейер остановлен
+        with self._lock:
+            self._closed = True
+            self._thread = None
+        self._call(self._dispatch, _END)
+
+    def _dispatch(self, packet):
+        for q in list(self._clients):
+            dropped = _put_latest(q, packet)
+            if dropped:
+                CLIENT_DROPS.inc(dropped, **self.labels)
+
+    async def packets(self):
+        """Асинхронный генератор пакетов для одного клиента."""
+        q = self.connect()
+        try:
+            while True:
+                packet = await q.get()
+                if packet is _END:
+                    return
+                yield packet
+        finally:
+            self.disconnect(q)
+
+
+def create_app(startup, client_buffer=2):
+    """
+    Собирает Starlette-приложение. startup - StartupState: конвейер появляется в нем,
+    когда модель загружена и прогрета, до этого маршруты конвейера отвечают 503.
+    """
+    fanouts = {}
+
+    def get_pipeline():
+        if startup.pipeline is None:
+            raise HTTPException(503, detail="Сервер запускается: модель еще не загружена (см. /readyz)")
+        return startup.pipeline
+
+    def fanout(key, broadcaster):
+        if key not in fanouts:
+            fanouts[key] = AsyncFanout(broadcaster, asyncio.get_running_loop(), client_buffer,
+                                       labels={'stream': key})
+        return fanouts[key]
+
+    def get_stream(source_id):
+        stream = get_pipeline().streams.get(source_id)
+        if stream is None:
+            raise HTTPException(404, detail=f"Неизвестный источник: {source_id}")
+        return stream
+
+    async def video_feed(request):
+        stream = get_stream(request.path_params.get('source_id', startup.default_source_id))
+
+        async def frames():
+            async for packet in fanout(stream.source_id, stream.broadcaster).packets():
+                yield packet['chunk']
+
+        return StreamingResponse(frames(), media_type="multipart/x-mixed-replace; boundary=frame")
+
+    async def detections(request):
+        source_id = request.path_params.get('source_id')
+        pipeline = get_pipeline()
+        if source_id is not None:
+            get_stream(source_id)
+
+        async def events():
+            async for records in fanout('detections', pipeline.detections).packets():
+                for record in records:
+                    if source_id is None or record['source_id'] == source_id:
+                        yield f"data: {json.dumps(record, separators=(',', ':'))}\n\n"
+
+        return StreamingResponse(events(), media_type="text/event-stream", headers={'Cache-Control': 'no-cache'})
+
+    async def frame_skip_control(request):
+        source_id = request.path_params.get('source_id')
+        streams = [get_stream(source_id)] if source_id else list(get_pipeline().streams.values())
+        if request.method == 'POST':
+            value = request.query_params.get('value')
+            if value is None:
+                body = await request.body()
+                if request.headers.get('content-type', '').startswith('application/json'):
+                    try:
+                        body = json.loads(body or b'{}')
+                    except ValueError:
+                        raise HTTPException(400, detail="Тело запроса - не JSON")
+                    # Принимается объект {"value": ...} или само значение: 3, "auto"
+                    value = body.get('value') if isinstance(body, dict) else body
+                else:
+                    value = (parse_qs(body.decode()).get('value') or [None])[0]
+            try:
+                for stream in streams:
+                    stream.set_frame_skip(value)
+            except (TypeError, ValueError):
+                raise HTTPException(400, detail="value должен быть целым числом >= 1 или 'auto'")
+        return JSONResponse({stream.source_id: stream.frame_skip_state() for stream in streams})
+
+    async def metrics_endpoint(request):
+        return Response(metrics.render(), headers={'Content-Type': metrics.CONTENT_TYPE})
+
+    async def stats(request):
+        snapshot = get_pipeline().snapshot()
+        snapshot['asgi_clients'] = {key: f.client_count for key, f in fanouts.items()}
+        return JSONResponse(snapshot)
+
+    async def healthz(request):
+        return JSONResponse({'status': 'ok', 'uptime_s': round(startup.total_seconds(), 1)})
+
+    async def readyz(request):
+        return JSONResponse(startup.report(), status_code=200 if startup.ready else 503)
+
+    def close_clients():
+        for f in fanouts.values():
+            f.close()
+
+    @contextlib.asynccontextmanager
+    async def lifespan(app):
+        yield
+        # Клиенты к этому моменту отключены - останавливаем конвейер и освобождаем источники
+        close_clients()
+        if startup.pipeline is not None:
+            await asyncio.to_thread(startup.pipeline.stop)
+        print("[*] Конвейер остановлен, источники видео освобождены.")
+
+    app = Starlette(routes=[
+        Route("/video_feed", video_feed),
+        Route("/video_feed/{source_id}", video_feed),
+        Route("/detections", detections),
+        Route("/detections/{source_id}", detections),
+        Route("/frame_skip", frame_skip_control, methods=['GET', 'POST']),
+        Route("/frame_skip/{source_id}", frame_skip_control, methods=['GET', 'POST']),
+        Route("/metrics", metrics_endpoint),
+        Route("/stats", stats),
+        Route("/healthz", healthz),
+        Route("/readyz", readyz),
+    ], lifespan=lifespan)
+    app.state.close_clients = close_clients
+
+    # Подписчик broadcaster'а здесь - один поток-мост, поэтому клиентов считаем по очередям
+    # (callback ставится после запуска конвейера, который регистрирует свой)
+    startup.on_ready(lambda pipeline: metrics.REGISTRY.gauge('wdd_connected_clients', '').set_callback(
+        lambda: [({'source': sid, 'stream': 'video'}, fanouts[sid].client_count if sid in fanouts else 0)
+                 for sid in pipeline.streams]
+        + [({'source': 'all', 'stream': 'detections'},
+            fanouts['detections'].client_count if 'detections' in fanouts else 0)]))
+    return app
+
+
+class _Server(uvicorn.Server):
+    """Uvicorn, который при сигнале остановки сначала завершает бесконечные стримы клиентов."""
+
+    def __init__(self, config, app):
+        super().__init__(config)
+        self._app = app
+
+    def handle_exit(self, sig, frame):
+        self._app.state.close_clients()
+        super().handle_exit(sig, frame)
+
+
+def serve(startup, host='0.0.0.0', port=5000, client_buffer=2):
+    """Запускает ASGI-сервер и блокируется до его остановки."""
+    app = create_app(startup, client_buffer)
+    config = uvicorn.Config(app, host=host, port=port, log_level='warning',
+                            timeout_graceful_shutdown=5, backlog=2048)
+    try:
+        _Server(config, app).run()
+    except KeyboardInterrupt:
+        pass  # Uvicorn повторно поднимает перехваченный SIGINT после корректной остановки
@@ -0,0 +1,148 @@
+# src/benchmark_decode.py
+"""
+Сравнение чтения видео через OpenCV и через ffmpeg (FFmpegReader) на записях.
+
+OpenCV-путь - то, что делают потребители сейчас: cv2.VideoCapture декодирует кадр в
+полном разрешении, после чего он уменьшается cv2.resize (INTER_AREA) до --width.
+ffmpeg-путь - FFmpegReader с уменьшением в декодере и кольцом из одного буфера.
+
+Для каждого видео и способа печатаются скорость декодирования (кадров/с), размер
+кадра, попадающего в Python, объем памяти, через который проходят кадры (МБ/с),
+и процессорное время (включая подпроцесс ffmpeg) на кадр.
+"""
+import argparse
+import json
+import os
+import time
+
+import cv2
+
+from data_processing import VIDEO_EXTENSIONS
+from video_reader import FFmpegReader, ffmpeg_available
+
+
+def _cpu_seconds():
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+
+def _measure(read_frame, max_frames):
+    """Читает кадры read_frame() до конца видео или max_frames. Возвращает статистику прохода."""
+    frames = 0
+    decoded_bytes = 0  # байты кадров, прошедших через память Python (до и после уменьшения)
+    frame_bytes = 0
+    cpu_started = _cpu_seconds()
+    started = time.perf_counter()
+    while max_frames is None or frames < max_frames:
+        result = read_frame()
+        if result is None:
+            break
+        full_bytes, frame = result
+        frames += 1
+        frame_bytes = frame.nbytes
+        decoded_bytes += full_bytes + frame.nbytes
+    seconds = time.perf_counter() - started
+    cpu = _cpu_seconds() - cpu_started
+    return {
+        'frames': frames,
+        'seconds': round(seconds, 3),
+        'fps': round(frames / seconds, 1) if seconds > 0 else 0.0,
+        'frame_bytes': frame_bytes,
+        'bandwidth_mb_s': round(decoded_bytes / seconds / 1024 / 1024, 1) if seconds > 0 else 0.0,
+        'cpu_ms_per_frame': round(1000 * cpu / frames, 2) if frames else 0.0,
+    }
+
+
+def bench_opencv(video_path, width=None, every_nth=1, max_frames=None):
+    cap = cv2.VideoCapture(str(video_path))
+    if not cap.isOpened():
+        return None
+    source_width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+    source_height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    size = None
+    if width and width != source_width:
+        size = (width, max(2, int(round(source_height * width / source_width / 2.0)) * 2))
+
+    def read_frame():
+        # Как в data_processing.py: пропускаемые кадры только захватываются
+        for _ in range(every_nth - 1):
+            if not cap.grab():
+                return None
+        ret, frame = cap.read()
+        if not ret:
+            return None
+        if size is None:
+            return 0, frame
+        return frame.nbytes, cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+
+    try:
+        return _measure(read_frame, max_frames)
+    finally:
+        cap.release()
+
+
+def bench_ffmpeg(video_path, width=None, every_nth=1, max_frames=None, hwaccel=None):
+    reader = FFmpegReader(str(video_path), width=width, every_nth=every_nth, buffers=1, hwaccel=hwaccel)
+    if not reader.isOpened():
+        if reader.error:
+            print(f"Предупреждение: ffmpeg не запустился для {video_path}: {reader.error}")
+        return None
+
+    def read_frame():
+        ret, frame = reader.read()
+        return (0, frame) if ret else None
+
+    try:
+        return _measure(read_frame, max_frames)
+    finally:
+        reader.release()
+
+
+def print_result(method, stats):
+    if stats is None:
+        print(f"  {method:<7} не удалось открыть видео")
+        return
+    print(f"  {method:<7} {stats['fps']:>8.1f} кадров/с  {stats['frames']:>6} кадров  "
+          f"кадр {stats['frame_bytes'] / 1024:>8.1f} КБ  память {stats['bandwidth_mb_s']:>8.1f} МБ/с  "
+          f"CPU {stats['cpu_ms_per_frame']:>6.2f} мс/кадр")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Сравнение скорости чтения видео: OpenCV и ffmpeg с уменьшением в декодере.")
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('--video_dir', type=str, help='Папка с видео (например, data/01_raw).')
+    group.add_argument('--video_file', type=str, nargs='+', help='Одно или несколько видео.')
+    parser.add_argument('--width', type=int, default=640, help='Ширина кадра, нужная потребителю (0 - исходный размер).')
+    parser.add_argument('--every_nth', type=int, default=1, help='Читать каждый N-й кадр (как --frame_skip).')
+    parser.add_argument('--max_frames', type=int, default=None, help='Не больше N кадров с каждого видео.')
+    parser.add_argument('--hwaccel', type=str, help='Аппаратное декодирование ffmpeg (cuda, vaapi, qsv, auto).')
+    parser.add_argument('--json', type=str, help='Сохранить результаты в JSON-файл.')
+    args = parser.parse_args()
+
+    if args.video_dir:
+        videos = [os.path.join(args.video_dir, f) for f in sorted(os.listdir(args.video_dir))
+                  if f.lower().endswith(VIDEO_EXTENSIONS)]
+    else:
+        videos = args.video_file
+    width = args.width or None
+    use_ffmpeg = ffmpeg_available()
+    if not use_ffmpeg:
+        print("Предупреждение: ffmpeg не найден в PATH - измеряется только OpenCV")
+
+    results = []
+    for video in videos:
+        print(f"\n{os.path.basename(video)} (ширина {width or 'исходная'}, каждый {args.every_nth}-й кадр):")
+        opencv_stats = bench_opencv(video, width, args.every_nth, args.max_frames)
+        print_result('opencv', opencv_stats)
+        ffmpeg_stats = None
+        if use_ffmpeg:
+            ffmpeg_stats = bench_ffmpeg(video, width, args.every_nth, args.max_frames, args.hwaccel)
+            print_result('ffmpeg', ffmpeg_stats)
+            if opencv_stats and ffmpeg_stats and opencv_stats['fps'] > 0:
+                print(f"  ffmpeg / opencv по скорости: {ffmpeg_stats['fps'] / opencv_stats['fps']:.2f}x")
+        results.append({'video': video, 'opencv': opencv_stats, 'ffmpeg': ffmpeg_stats})
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'width': width, 'every_nth': args.every_nth, 'results': results}, f, indent=2, ensure_ascii=False)
+        print(f"\nРезультаты сохранены: {args.json}")
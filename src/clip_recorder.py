@@ -0,0 +1,221 @@
+# src/clip_recorder.py
+"""
+Запись коротких клипов вокруг дефектов прямо на сервере.
+
+Поток захвата кладет каждый декодированный кадр в кольцевой буфер последних
+pre_seconds секунд (ограничен и по памяти - max_buffer_mb). Когда конвейер сообщает
+о подтвержденном дефекте, буфер становится началом клипа, затем в клип идут кадры
+еще post_seconds секунд (новый дефект за это время продлевает тот же клип).
+Запись на диск - MP4 и JSON с рамками - идет в отдельном потоке, поэтому
+захват и инференс никогда не ждут диск. Кадры, ждущие записи, ограничены тем же
+max_buffer_mb: если поток записи отстает, клип завершается раньше (с предупреждением
+и счетчиком clips_truncated), а не копит сырые кадры в памяти.
+"""
+import json
+import queue
+import threading
+import time
+from collections import deque
+from datetime import datetime
+from pathlib import Path
+
+import cv2
+
+# Маркер конца клипа в очереди кадров
+_END = object()
+
+
+class _Clip:
+    def __init__(self, path, end_time, frames):
+        self.path = path
+        self.start_time = time.time()
+        self.end_time = end_time
+        self.frames = queue.Queue()
+        for item in frames:
+            self.frames.put(item)
+        self.fps = None
+        self.events = []
+        self.detections = []
+        self.truncated = False
+
+
+class ClipRecorder:
+    """
+    output_dir      - каталог для клипов (<source_id>_<дата_время>.mp4 и .json рядом);
+    pre_seconds     - сколько секунд до события сохраняется из кольцевого буфера;
+    post_seconds    - сколько секунд после (последнего) события пишется в клип;
+    max_buffer_mb   - ограничение памяти кольцевого буфера (сырые кадры BGR);
+    max_clip_seconds - предельная длина клипа после события, если дефекты идут непрерывно;
+    """
+
+    def __init__(self, source_id, output_dir, pre_seconds=5.0, post_seconds=5.0, max_buffer_mb=512,
+                 max_clip_seconds=60.0, timings=None):
+        self.source_id = source_id
+        self.output_dir = Path(output_dir)
+        self.pre_seconds = pre_seconds
+        self.post_seconds = post_seconds
+        self.max_buffer_bytes = int(max_buffer_mb * 1024 * 1024)
+        self.max_clip_seconds = max_clip_seconds
+        self.timings = timings
+        self.clips_written = 0
+        self.clips_truncated = 0
+        self.last_clip = None
+
+        self._lock = threading.Lock()
+        self._buffer = deque()  # (время, frame_index, кадр)
+        self._active = None
+        self._queued_bytes = 0  # кадры в очередях клипов, еще не записанные на диск
+        self._jobs = queue.Queue()
+        self._thread = threading.Thread(target=self._write_loop, name=f"clips-{source_id}", daemon=True)
+        self._thread.start()
+
+    def add_frame(self, frame_index, frame):
+        """Вызывается из потока захвата для каждого декодированного кадра."""
+        now = time.time()
+        item = (now, frame_index, frame)
+        with self._lock:
+            clip = self._active
+            if clip is not None:
+                if now > clip.end_time:
+                    clip.frames.put(_END)
+                    self._active = None
+                elif self._queued_bytes + frame.nbytes > self.max_buffer_bytes:
+                    # Запись отстает: завершаем клип, чтобы не копить кадры сверх бюджета памяти
+                    self._truncate(clip, "запись не успевает, клип завершен раньше")
+                    clip.frames.put(_END)
+                    self._active = None
+                else:
+                    self._queued_bytes += frame.nbytes
+                    clip.frames.put(item)
+
+            self._buffer.append(item)
+            # Храним только последние pre_seconds секунд и не больше max_buffer_bytes
+            max_frames = max(1, self.max_buffer_bytes // max(1, frame.nbytes))
+            while self._buffer and (now - self._buffer[0][0] > self.pre_seconds or len(self._buffer) > max_frames):
+                self._buffer.popleft()
+
+    def observe(self, record):
+        """
+        Вызывается конвейером для каждой записи детекций. Клип начинается или продлевается
+        по событию трекера (record['events'] - подтвержденный дефект), а не по отдельному
+        кадру с рамками, чтобы одиночное ложное срабатывание не давало клип.
+        """
+        events = record.get('events') or []
+        with self._lock:
+            clip = self._active
+            if events:
+                end_time = time.time() + self.post_seconds
+                if clip is None:
+                    clip = self._start_clip(end_time)
+                else:
+                    clip.end_time = min(end_time, clip.start_time + self.max_clip_seconds)
+                clip.events.extend(events)
+            if clip is not None and record['boxes']:
+                clip.detections.append({key: record[key] for key in ('frame_index', 'timestamp', 'boxes')})
+
+    def _truncate(self, clip, reason):
+        if clip.truncated:
+            return
+        clip.truncated = True
+        self.clips_truncated += 1
+        if self.timings is not None:
+            self.timings.incr('clips_truncated')
+        print(f"Предупреждение: [{self.source_id}] {clip.path.name}: {reason} "
+              f"(ожидают записи {self._queued_bytes / 1024 / 1024:.0f} МБ)")
+
+    def _start_clip(self, end_time):
+        frames = list(self._buffer)
+        # Предыстория берется с конца, пока помещается в бюджет (его часть могут занимать недописанные клипы)
+        available = self.max_buffer_bytes - self._queued_bytes
+        keep = 0
+        for _, _, frame in reversed(frames):
+            if frame.nbytes > available:
+                break
+            available -= frame.nbytes
+            keep += 1
+        trimmed = keep < len(frames)
+        frames = frames[len(frames) - keep:]
+        self._queued_bytes += sum(frame.nbytes for _, _, frame in frames)
+        if len(frames) >= 2 and frames[-1][0] > frames[0][0]:
+            fps = (len(frames) - 1) / (frames[-1][0] - frames[0][0])
+        else:
+            fps = None
+        stamp = datetime.now().strftime('%Y%m%d_%H%M%S_%f')[:-3]
+        clip = _Clip(self.output_dir / f"{self.source_id}_{stamp}.mp4", end_time, frames)
+        clip.fps = fps
+        if trimmed:
+            self._truncate(clip, "предыстория клипа укорочена")
+        self._active = clip
+        self._jobs.put(clip)
+        return clip
+
+    def _write_loop(self):
+        while True:
+            clip = self._jobs.get()
+            if clip is _END:
+                return
+            self._write_clip(clip)
+
+    def _write_clip(self, clip):
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        writer, first, last, count = None, None, None, 0
+        while True:
+            item = clip.frames.get()
+            if item is _END:
+                break
+            timestamp, frame_index, frame = item
+            if writer is None:
+                height, width = frame.shape[:2]
+                writer = cv2.VideoWriter(str(clip.path), cv2.VideoWriter_fourcc(*'mp4v'),
+                                         round(clip.fps or 25.0, 2), (width, height))
+                first = (timestamp, frame_index)
+            writer.write(frame)
+            with self._lock:
+                self._queued_bytes -= frame.nbytes
+            last = (timestamp, frame_index)
+            count += 1
+        if writer is None:
+            return
+        writer.release()
+
+        sidecar = {
+            'source_id': self.source_id,
+            'video': clip.path.name,
+            'fps': round(clip.fps, 2) if clip.fps else None,
+            'frames': count,
+            'start': {'timestamp': round(first[0], 3), 'frame_index': first[1]},
+            'end': {'timestamp': round(last[0], 3), 'frame_index': last[1]},
+            'events': clip.events,
+            'detections': clip.detections,
+            'truncated': clip.truncated,
+        }
+        with open(clip.path.with_suffix('.json'), 'w') as f:
+            json.dump(sidecar, f, indent=2, ensure_ascii=False)
+        self.clips_written += 1
+        self.last_clip = str(clip.path)
+        if self.timings is not None:
+            self.timings.incr('clips_written')
+        print(f"[{self.source_id}] Сохранен клип дефекта: {clip.path} ({count} кадров)")
+
+    def state(self):
+        with self._lock:
+            buffered = len(self._buffer)
+            recording = self._active is not None
+            queued_mb = self._queued_bytes / 1024 / 1024
+        return {
+            'buffered_frames': buffered,
+            'recording': recording,
+            'queued_mb': round(queued_mb, 1),
+            'clips_written': self.clips_written,
+            'clips_truncated': self.clips_truncated,
+            'last_clip': self.last_clip,
+        }
+
+    def stop(self, timeout=10.0):
+        """Дописывает текущий клип (без оставшегося хвоста) и останавливает поток записи."""
+        with self._lock:
+            if self._active is not None:
+                self._active.frames.put(_END)
+                self._active = None
+        self._jobs.put(_END)
+        self._thread.join(timeout=timeout)
@@ -3,9 +3,18 @@ import shutil
 import math
 import subprocess
 
-def create_chunks(input_dir, output_base_dir, chunk_size=5000):
+from frame_store import FrameStore
+
+def create_chunks(input_dir, output_base_dir, chunk_size=5000, image_store_dir=None):
+    """
+    Раскладывает изображения и метки из input_dir по чанкам для CVAT.
+    Если задан image_store_dir, изображения берутся из упакованного хранилища кадров
+    (см. frame_store.py), а в input_dir лежат только метки (prelabel.py --input_store).
+    """
     print(f"--- Создание чанков для CVAT ---")
     print(f"Исходная директория: {input_dir}")
+    if image_store_dir:
+        print(f"Хранилище кадров: {image_store_dir}")
     print(f"Размер чанка: {chunk_size} изображений")
 
     # Убедимся, что obj.names существует
@@ -15,7 +24,11 @@ def create_chunks(input_dir, output_base_dir, chunk_size=5000):
         return
 
     # Получаем список всех .jpg файлов
-    image_files = sorted([f for f in os.listdir(input_dir) if f.lower().endswith('.jpg')])
+    image_store = FrameStore(image_store_dir) if image_store_dir else None
+    if image_store is not None:
+        image_files = [f for f in image_store.names() if f.lower().endswith('.jpg')]
+    else:
+        image_files = sorted([f for f in os.listdir(input_dir) if f.lower().endswith('.jpg')])
     if not image_files:
         print(f"Ошибка: В директории {input_dir} не найдено изображений.")
         return
@@ -52,7 +65,12 @@ def create_chunks(input_dir, output_base_dir, chunk_size=5000):
             dest_img_path = os.path.join(chunk_dir, img_filename)
             dest_label_path = os.path.join(chunk_dir, label_filename)
 
-            shutil.copy(src_img_path, dest_img_path)
+            if image_store is not None:
+                # Байты JPEG из шарда как есть, без перекодирования
+                with open(dest_img_path, 'wb') as f:
+                    f.write(image_store.read_bytes(img_filename))
+            else:
+                shutil.copy(src_img_path, dest_img_path)
             if os.path.exists(src_label_path):
                 shutil.copy(src_label_path, dest_label_path)
             else:
@@ -82,4 +100,6 @@ def create_chunks(input_dir, output_base_dir, chunk_size=5000):
 if __name__ == '__main__':
     input_directory = "/app/data/06_prelabeled"
     output_base_directory = "/app/data/06_prelabeled/chunks"
-    create_chunks(input_directory, output_base_directory)
+    # Хранилище кадров, если кадры нарезаны с STORE_DIR (см. run_data_prep.py), например "/app/data/02_processed/frame_store"
+    image_store_directory = None
+    create_chunks(input_directory, output_base_directory, image_store_dir=image_store_directory)
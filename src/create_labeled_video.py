@@ -1,77 +1,736 @@
 # src/create_labeled_video.py
 import cv2
 import argparse
-from ultralytics import YOLO
+import heapq
+import json
+import os
+import queue
+import shutil
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import numpy as np
+from detection_cache import DetectionCache, DetectionLog, resolve_class_ids
+from model_backend import BACKENDS, load_model
+from roi import check_roi, crop, load_rois, select_roi, shift_result
+from stream_pipeline import detection_record
+from tracking import DefectTracker, tracks_to_result
+from video_reader import READERS, FFmpegReader
 from pathlib import Path
 from tqdm import tqdm
 
-def process_video(model_path: str, input_video: str, output_video: str, conf_threshold: float, imgsz: int):
+# Маркер конца потока в очередях конвейера
+END_OF_STREAM = object()
+
+# Сегменты пишутся без потерь (FFV1), чтобы итоговое видео кодировалось один раз,
+# как и в обычном режиме
+SEGMENT_FOURCC = 'FFV1'
+SEGMENT_SUFFIX = '.avi'
+
+
+class FrameAnnotator:
+    """
+    Детекция для последовательных кадров одного видео: ROI, батчевый инференс и трекинг.
+    Используется и в по-кадровом режиме (батч из одного кадра), и в конвейерном,
+    поэтому результат обоих режимов одинаков.
+
+    Если задан log (DetectionLog), модель запускается с порогом model_conf (ниже conf_threshold),
+    все рамки сохраняются в журнал, а на видео попадают только рамки выше conf_threshold
+    и классов class_ids (None - все классы).
+    """
+
+    def __init__(self, model, conf_threshold, imgsz, roi=None, tracker=None, detect_interval=1, fps=None, name='',
+                 log=None, model_conf=None, class_ids=None):
+        self.model = model
+        self.conf_threshold = conf_threshold
+        self.model_conf = conf_threshold if model_conf is None else min(model_conf, conf_threshold)
+        self.class_ids = class_ids
+        self.imgsz = imgsz
+        self.roi = roi
+        self.tracker = tracker
+        self.detect_interval = max(1, detect_interval)
+        self.fps = fps
+        self.name = name
+        self.log = log
+        self.names = model.names if model is not None else {}
+        self.events = []
+
+    def is_keyframe(self, frame_index):
+        return self.tracker is None or frame_index % self.detect_interval == 0
+
+    def detect(self, keyframes):
+        """Результаты детекции (в координатах полного кадра) для списка (frame_index, frame)."""
+        # Выполняем детекцию на кадрах (или только на их ROI) одним батчем
+        crops = [crop(frame, self.roi) for _, frame in keyframes]
+        results = self.model([model_input for model_input, _ in crops], imgsz=self.imgsz,
+                             conf=self.model_conf, verbose=False)
+        return [shift_result(result, offset, frame) if self.roi is not None else result
+                for (_, frame), (_, offset), result in zip(keyframes, crops, results)]
+
+    def filter(self, result):
+        """Оставляет рамки не ниже conf_threshold и нужных классов."""
+        if self.model_conf >= self.conf_threshold and self.class_ids is None:
+            return result
+        keep = result.boxes.conf.cpu().numpy() >= self.conf_threshold
+        if self.class_ids is not None:
+            keep &= np.isin(result.boxes.cls.cpu().numpy().astype(int), list(self.class_ids))
+        return result[keep.nonzero()[0].tolist()] if not keep.all() else result
+
+    def process(self, batch):
+        """batch - список (frame_index, frame) по порядку. Возвращает список Results того же порядка."""
+        keyframes = [(i, frame) for i, frame in batch if self.is_keyframe(i)]
+        detections = {}
+        if keyframes:
+            for (i, _), result in zip(keyframes, self.detect(keyframes)):
+                if self.log is not None:
+                    self.log.add(i, result)
+                detections[i] = self.filter(result)
+
+        output = []
+        for frame_index, frame in batch:
+            result = detections.get(frame_index)
+            if self.tracker is not None:
+                if result is None:
+                    # Промежуточный кадр: модель не запускаем, рамки продлевает трекер
+                    rows = self.tracker.predict(frame_index)
+                else:
+                    boxes = detection_record(self.name, frame_index, 0.0, result)['boxes']
+                    rows, new_events = self.tracker.update(frame_index, boxes)
+                    for event in new_events:
+                        event['time_sec'] = round(frame_index / self.fps, 2) if self.fps else None
+                    self.events.extend(new_events)
+                result = tracks_to_result(frame, rows, self.names)
+            output.append(result)
+        return output
+
+
+class CachedFrameAnnotator(FrameAnnotator):
+    """FrameAnnotator, который берет детекции из sidecar-файла (DetectionCache) вместо модели."""
+
+    def __init__(self, cache, conf_threshold, **kwargs):
+        super().__init__(None, conf_threshold, imgsz=None, model_conf=cache.meta.get('conf_floor'), **kwargs)
+        self.cache = cache
+        self.names = cache.names
+
+    def detect(self, keyframes):
+        import torch
+        from ultralytics.engine.results import Results
+
+        return [Results(frame, path='', names=self.names, boxes=torch.from_numpy(self.cache.frame_boxes(i)))
+                for i, frame in keyframes]
+
+
+class StageStats:
+    """Суммарное время работы каждой стадии и число обработанных ею кадров."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.seconds = {}
+        self.frames = {}
+
+    def add(self, stage, seconds, frames=1):
+        with self._lock:
+            self.seconds[stage] = self.seconds.get(stage, 0.0) + seconds
+            self.frames[stage] = self.frames.get(stage, 0) + frames
+
+    def report(self, wall_seconds, total_frames):
+        print("\n--- Производительность по стадиям ---")
+        print(f"{'Стадия':<12}{'кадров':>8}{'время, с':>10}{'к/с':>9}")
+        for stage, seconds in self.seconds.items():
+            frames = self.frames[stage]
+            fps = frames / seconds if seconds > 0 else float('inf')
+            print(f"{stage:<12}{frames:>8}{seconds:>10.2f}{fps:>9.1f}")
+        if wall_seconds > 0:
+            print(f"{'итого':<12}{total_frames:>8}{wall_seconds:>10.2f}{total_frames / wall_seconds:>9.1f}")
+        if self.seconds:
+            slowest = max(self.seconds, key=lambda s: self.seconds[s] / max(1, self.frames[s]))
+            print(f"Самая медленная стадия: {slowest}")
+
+
+def run_sequential(cap, writer, annotator, stats, pbar):
+    """Исходный режим: чтение, инференс, отрисовка и запись по одному кадру в одном потоке."""
+    frame_index = 0
+    while cap.isOpened():
+        t0 = time.perf_counter()
+        ret, frame = cap.read()
+        if not ret:
+            break
+        t1 = time.perf_counter()
+        result = annotator.process([(frame_index, frame)])[0]
+        t2 = time.perf_counter()
+        # Используем встроенный метод .plot() для отрисовки рамок и меток
+        annotated_frame = result.plot()
+        t3 = time.perf_counter()
+        # Записываем аннотированный кадр в выходной файл
+        writer.write(annotated_frame)
+        t4 = time.perf_counter()
+
+        stats.add('decode', t1 - t0)
+        stats.add('inference', t2 - t1)
+        stats.add('render', t3 - t2)
+        stats.add('write', t4 - t3)
+        frame_index += 1
+        pbar.update(1)
+    return frame_index
+
+
+def run_pipelined(cap, writer, annotator, stats, pbar, batch_size=8, render_workers=2, queue_size=32):
+    """
+    Конвейерный режим: поток декодирования -> батчевый инференс (в текущем потоке) ->
+    потоки отрисовки -> запись в исходном порядке кадров. Очереди ограничены,
+    поэтому в памяти одновременно находится не больше queue_size кадров на стадию.
+    """
+    decode_queue = queue.Queue(maxsize=queue_size)
+    render_queue = queue.Queue(maxsize=queue_size)
+    write_queue = queue.Queue(maxsize=queue_size)
+    stop_event = threading.Event()
+    errors = []
+
+    def guarded(target):
+        def run():
+            try:
+                target()
+            except Exception as e:
+                errors.append(e)
+                stop_event.set()
+        return run
+
+    def put(q, item):
+        # Блокирующая запись, которую можно прервать при ошибке в другой стадии
+        while not stop_event.is_set():
+            try:
+                q.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def get(q):
+        # Блокирующее чтение; при ошибке в другой стадии возвращает END_OF_STREAM
+        while not stop_event.is_set():
+            try:
+                return q.get(timeout=0.5)
+            except queue.Empty:
+                continue
+        return END_OF_STREAM
+
+    def decode():
+        frame_index = 0
+        while not stop_event.is_set():
+            t0 = time.perf_counter()
+            ret, frame = cap.read()
+            if not ret:
+                break
+            stats.add('decode', time.perf_counter() - t0)
+            if not put(decode_queue, (frame_index, frame)):
+                return
+            frame_index += 1
+        put(decode_queue, END_OF_STREAM)
+
+    def render():
+        while not stop_event.is_set():
+            item = get(render_queue)
+            if item is END_OF_STREAM:
+                put(write_queue, END_OF_STREAM)
+                return
+            frame_index, result = item
+            t0 = time.perf_counter()
+            annotated_frame = result.plot()
+            stats.add('render', time.perf_counter() - t0)
+            put(write_queue, (frame_index, annotated_frame))
+
+    def write():
+        # Потоки отрисовки завершают кадры не по порядку - восстанавливаем его через кучу
+        pending, next_index, finished = [], 0, 0
+        while finished < render_workers and not stop_event.is_set():
+            item = get(write_queue)
+            if item is END_OF_STREAM:
+                finished += 1
+                continue
+            heapq.heappush(pending, item)
+            while pending and pending[0][0] == next_index:
+                _, annotated_frame = heapq.heappop(pending)
+                t0 = time.perf_counter()
+                writer.write(annotated_frame)
+                stats.add('write', time.perf_counter() - t0)
+                next_index += 1
+                pbar.update(1)
+
+    threads = [threading.Thread(target=guarded(decode), name="decode", daemon=True)]
+    threads += [threading.Thread(target=guarded(render), name=f"render-{i}", daemon=True) for i in range(render_workers)]
+    threads.append(threading.Thread(target=guarded(write), name="write", daemon=True))
+    for thread in threads:
+        thread.start()
+
+    frames_done = 0
+    try:
+        finished = False
+        while not finished and not stop_event.is_set():
+            batch = []
+            while len(batch) < batch_size:
+                item = get(decode_queue)
+                if item is END_OF_STREAM:
+                    finished = True
+                    break
+                batch.append(item)
+            if not batch:
+                break
+            t0 = time.perf_counter()
+            results = annotator.process(batch)
+            stats.add('inference', time.perf_counter() - t0, len(batch))
+            for (frame_index, _), result in zip(batch, results):
+                if not put(render_queue, (frame_index, result)):
+                    break
+            frames_done += len(batch)
+    except Exception:
+        stop_event.set()
+        raise
+    finally:
+        for _ in range(render_workers):
+            put(render_queue, END_OF_STREAM)
+        for thread in threads:
+            thread.join()
+    if errors:
+        raise errors[0]
+    return frames_done
+
+
+class FrameRangeReader:
+    """Обертка над VideoCapture, которая отдает не больше count кадров (count=None - до конца видео)."""
+
+    def __init__(self, cap, count=None):
+        self.cap = cap
+        self.remaining = count
+
+    def isOpened(self):
+        return self.cap.isOpened() and (self.remaining is None or self.remaining > 0)
+
+    def read(self):
+        if self.remaining is not None:
+            if self.remaining <= 0:
+                return False, None
+            self.remaining -= 1
+        return self.cap.read()
+
+
+# Модель процесса-воркера: загружается один раз в инициализаторе пула
+_worker_model = None
+
+
+def _init_segment_worker(model_path, backend, torch_threads):
+    global _worker_model
+    if torch_threads:
+        # Иначе каждый воркер займет все ядра, и процессы будут мешать друг другу
+        import torch
+        torch.set_num_threads(torch_threads)
+        cv2.setNumThreads(1)
+    _worker_model = load_model(model_path, backend)
+
+
+def _process_segment(input_video, part_path, start, count, fps, size, conf_threshold, imgsz, roi, batch,
+                     render_workers, detections_floor=None):
+    """
+    Размечает кадры [start, start + count) в отдельный файл сегмента. Выполняется в воркере пула.
+    Если задан detections_floor, сырые детекции сегмента сохраняются рядом (<сегмент>.detections.npz).
+    """
+    cap = cv2.VideoCapture(input_video)
+    cap.set(cv2.CAP_PROP_POS_FRAMES, start)
+    part_path = Path(part_path)
+    tmp_path = part_path.with_name(part_path.stem + '.tmp' + part_path.suffix)
+    writer = cv2.VideoWriter(str(tmp_path), cv2.VideoWriter_fourcc(*SEGMENT_FOURCC), fps, size)
+
+    log = DetectionLog(frame_offset=start) if detections_floor is not None else None
+    annotator = FrameAnnotator(_worker_model, conf_threshold, imgsz, roi, fps=fps, name=Path(input_video).stem,
+                               log=log, model_conf=detections_floor)
+    stats = StageStats()
+    reader = FrameRangeReader(cap, count)
+    with tqdm(disable=True) as pbar:
+        if batch > 1 or render_workers > 0:
+            frames = run_pipelined(reader, writer, annotator, stats, pbar, batch, max(1, render_workers))
+        else:
+            frames = run_sequential(reader, writer, annotator, stats, pbar)
+    cap.release()
+    writer.release()
+
+    if count is not None and frames != count:
+        raise RuntimeError(f"Сегмент с кадра {start}: прочитано {frames} кадров вместо {count}")
+    if log is not None:
+        log.save(part_path.with_suffix('.detections.npz'), 0, {'names': dict(_worker_model.names)})
+    # Готовый сегмент появляется под своим именем только целиком - по нему и продолжается прерванный запуск
+    os.replace(tmp_path, part_path)
+    return frames, stats.seconds, stats.frames
+
+
+def process_video_segments(model_path: str, input_video: str, output_video: str, conf_threshold: float, imgsz: int,
+                           backend: str = 'pytorch', roi=None, workers: int = 2, segment_seconds: float = 60.0,
+                           batch: int = 1, render_workers: int = 0, keep_segments: bool = False,
+                           save_detections=None, detections_floor: float = 0.05):
+    """
+    Делит видео на сегменты по segment_seconds секунд и размечает их параллельно
+    в пуле из workers процессов (у каждого своя копия модели). Сегменты сохраняются
+    в каталог <имя_выхода>.segments/ и склеиваются по порядку в итоговое видео по
+    мере готовности. Если запуск прервать, повторный запуск с теми же параметрами
+    обработает только недостающие сегменты.
+    Если задан save_detections, сырые детекции сегментов собираются в один sidecar-файл.
+    Возвращает True, если видео создано.
+    """
+    input_path = Path(input_video)
+    output_path = Path(output_video)
+
+    cap = cv2.VideoCapture(str(input_path))
+    if not cap.isOpened():
+        print(f"Ошибка: не удалось открыть исходное видео: {input_path}")
+        return False
+    frame_width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+    frame_height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    cap.release()
+    if total_frames <= 0:
+        print(f"Ошибка: не удалось определить число кадров видео: {input_path}")
+        return False
+    roi = check_roi(roi, (frame_height, frame_width), input_path.name)
+
+    segment_frames = max(1, round(segment_seconds * (fps or 25.0)))
+    starts = list(range(0, total_frames, segment_frames))
+    parts_dir = output_path.with_name(output_path.stem + '.segments')
+    parts = [parts_dir / f"segment_{i:05d}{SEGMENT_SUFFIX}" for i in range(len(starts))]
+
+    # Сегменты прошлого запуска переиспользуются, только если параметры совпадают
+    manifest = {
+        'input_video': str(input_path.resolve()), 'input_size': input_path.stat().st_size,
+        'model_path': str(Path(model_path).resolve()), 'backend': backend, 'conf': conf_threshold,
+        'imgsz': imgsz, 'roi': list(roi) if roi else None, 'segment_frames': segment_frames,
+        'total_frames': total_frames,
+        'detections_floor': detections_floor if save_detections else None,
+    }
+    manifest_path = parts_dir / 'manifest.json'
+    if parts_dir.exists():
+        try:
+            with open(manifest_path) as f:
+                previous = json.load(f)
+        except (OSError, ValueError):
+            previous = None
+        if previous != manifest:
+            print(f"Параметры изменились - сегменты прошлого запуска удаляются: {parts_dir}")
+            shutil.rmtree(parts_dir)
+    parts_dir.mkdir(parents=True, exist_ok=True)
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f, indent=2, ensure_ascii=False)
+
+    pending = [i for i, part in enumerate(parts) if not part.exists()]
+    print(f"Обработка видео: {input_video}")
+    print(f"Сегментов: {len(parts)} по {segment_frames} кадров, готово ранее: {len(parts) - len(pending)}, "
+          f"процессов: {workers}")
+    print(f"Результат будет сохранен в: {output_video}")
+
+    stats = StageStats()
+    started = time.perf_counter()
+    torch_threads = max(1, (os.cpu_count() or workers) // workers)
+    # spawn: fork процесса с уже инициализированными потоками torch может зависнуть
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=_init_segment_worker,
+                             initargs=(model_path, backend, torch_threads)) as pool:
+        futures = {}
+        for i in pending:
+            # Последний сегмент читается до конца файла: CAP_PROP_FRAME_COUNT бывает неточным
+            count = segment_frames if i < len(starts) - 1 else None
+            futures[i] = pool.submit(_process_segment, str(input_path), str(parts[i]), starts[i], count, fps,
+                                     (frame_width, frame_height), conf_threshold, imgsz, roi, batch, render_workers,
+                                     detections_floor if save_detections else None)
+
+        # Склеиваем сегменты по порядку, не дожидаясь остальных
+        writer = cv2.VideoWriter(str(output_path), cv2.VideoWriter_fourcc(*'mp4v'), fps, (frame_width, frame_height))
+        frames_written = 0
+        try:
+            with tqdm(total=len(parts), desc="Сегменты") as pbar:
+                for i, part in enumerate(parts):
+                    if i in futures:
+                        _, seconds, frames = futures[i].result()
+                        for stage in seconds:
+                            stats.add(stage, seconds[stage], frames[stage])
+                    t0 = time.perf_counter()
+                    part_cap = cv2.VideoCapture(str(part))
+                    while True:
+                        ret, frame = part_cap.read()
+                        if not ret:
+                            break
+                        writer.write(frame)
+                        frames_written += 1
+                    part_cap.release()
+                    stats.add('concat', time.perf_counter() - t0, 0)
+                    pbar.update(1)
+        except BaseException:
+            for future in futures.values():
+                future.cancel()
+            print(f"\nОбработка прервана. Готовые сегменты сохранены в {parts_dir}, "
+                  "повторный запуск обработает только недостающие.")
+            raise
+        finally:
+            writer.release()
+    wall_seconds = time.perf_counter() - started
+
+    stats.frames['concat'] = frames_written
+    stats.report(wall_seconds, frames_written)
+    print("(время стадий суммировано по всем процессам)")
+    if save_detections:
+        log, names = DetectionLog(), {}
+        for part in parts:
+            part_cache = DetectionCache(part.with_suffix('.detections.npz'))
+            log.extend(part_cache.arrays())
+            names = names or part_cache.names
+        meta = detection_meta(input_path, fps, frame_width, frame_height, names, min(detections_floor, conf_threshold),
+                              model_path, imgsz, roi, 1)
+        boxes = log.save(save_detections, frames_written, meta)
+        print(f"Детекций сохранено: {boxes}, файл: {save_detections}")
+    if not keep_segments:
+        shutil.rmtree(parts_dir)
+    print("\n--- Готово! Видео с метками успешно создано. ---")
+    return True
+
+
+def process_video(model_path: str, input_video: str, output_video: str, conf_threshold: float, imgsz: int,
+                  backend: str = 'pytorch', roi=None, tracking=None, detect_interval: int = 1,
+                  track_low_conf: float = 0.1, batch: int = 1, render_workers: int = 0, save_detections=None,
+                  detections_floor: float = 0.05, classes=None, cache=None, reader=None):
     """
     Обрабатывает входное видео, наносит на него рамки детекции и сохраняет в новый файл.
+    Если задана roi (x, y, w, h), инференс выполняется только по этой области кадра.
+    Если задан tracking (параметры DefectTracker), модель запускается на каждом
+    detect_interval-м кадре, рисуются только подтвержденные треки с их ID,
+    а события (одно на дефект) сохраняются рядом с видео в <имя>.events.json.
+    При batch > 1 или render_workers > 0 используется конвейерный режим (см. run_pipelined).
+    Если задан save_detections, все детекции не ниже detections_floor сохраняются в sidecar-файл
+    (см. detection_cache.py). Если задан cache (DetectionCache), модель не загружается:
+    рамки берутся из sidecar-файла. classes - имена или номера классов, которые рисуются (None - все).
+    reader - параметры FFmpegReader (см. video_reader.py): видео читается через ffmpeg, и кадр
+    уменьшается в декодере (итоговое видео - в размере декодированных кадров).
+    Возвращает True, если видео создано.
     """
     # --- 1. Загрузка модели ---
-    print(f"Загрузка модели из: {model_path}")
-    try:
-        model = YOLO(model_path)
-    except Exception as e:
-        print(f"Ошибка при загрузке модели: {e}")
-        return
+    model = None
+    if cache is None:
+        print(f"Загрузка модели из: {model_path} (бэкенд: {backend})")
+        try:
+            model = load_model(model_path, backend)
+        except Exception as e:
+            print(f"Ошибка при загрузке модели: {e}")
+            return False
+        class_ids = resolve_class_ids(classes, model.names)
+    else:
+        class_ids = cache.class_ids(classes)
+        # С --track --detect_interval N модель запускалась (и рамки сохранялись) только на каждом N-м кадре
+        cached_interval = cache.meta.get('detect_interval') or 1
+        if cached_interval > 1:
+            if tracking is None:
+                print(f"Ошибка: в sidecar-файле рамки только каждого {cached_interval}-го кадра (--track "
+                      f"--detect_interval {cached_interval}), перерисовать его можно только с --track")
+                return False
+            if detect_interval % cached_interval:
+                print(f"Предупреждение: детектор в sidecar-файле запускался на каждом {cached_interval}-м кадре, "
+                      f"используется --detect_interval {cached_interval}")
+                detect_interval = cached_interval
+        print(f"Детекции из sidecar-файла (нижний порог {cache.meta.get('conf_floor')}), модель не запускается")
 
     # --- 2. Открытие видеофайлов ---
     input_path = Path(input_video)
     output_path = Path(output_video)
-    
-    cap = cv2.VideoCapture(str(input_path))
+
+    cap = FFmpegReader(str(input_path), **reader) if reader is not None else cv2.VideoCapture(str(input_path))
     if not cap.isOpened():
         print(f"Ошибка: не удалось открыть исходное видео: {input_path}")
-        return
+        return False
 
     # Получаем свойства видео для создания выходного файла
     frame_width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
     frame_height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
     fps = cap.get(cv2.CAP_PROP_FPS)
     total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    if cache is not None and (cache.meta.get('width'), cache.meta.get('height')) != (frame_width, frame_height):
+        print(f"Ошибка: детекции сохранены для кадров {cache.meta.get('width')}x{cache.meta.get('height')}, "
+              f"а видео читается в {frame_width}x{frame_height}")
+        cap.release()
+        return False
+    roi = check_roi(roi, (frame_height, frame_width), input_path.name)
 
     # Создаем объект для записи видео
     fourcc = cv2.VideoWriter_fourcc(*'mp4v') # Кодек для .mp4 файлов
     writer = cv2.VideoWriter(str(output_path), fourcc, fps, (frame_width, frame_height))
 
     print(f"Обработка видео: {input_video}")
+    if roi is not None:
+        print(f"Область интереса (x, y, w, h): {roi}")
     print(f"Результат будет сохранен в: {output_video}")
 
-    # --- 3. По-кадровая обработка ---
-    with tqdm(total=total_frames, desc="Создание видео") as pbar:
-        while cap.isOpened():
-            ret, frame = cap.read()
-            if not ret:
-                break
-
-            # Выполняем детекцию на кадре
-            results = model(frame, imgsz=imgsz, conf=conf_threshold, verbose=False)
-            
-            # Используем встроенный метод .plot() для отрисовки рамок и меток
-            annotated_frame = results[0].plot()
+    tracker = None
+    if tracking is not None:
+        tracker = DefectTracker(high_conf=conf_threshold, **tracking)
+        # Слабые детекции нужны трекеру, чтобы продлевать уже найденные дефекты
+        conf_threshold = min(track_low_conf, conf_threshold)
+        print(f"Трекинг включен: детектор на каждом {detect_interval}-м кадре")
+    log = DetectionLog() if save_detections else None
+    if cache is not None:
+        annotator = CachedFrameAnnotator(cache, conf_threshold, tracker=tracker, detect_interval=detect_interval,
+                                         fps=fps, name=input_path.stem, class_ids=class_ids)
+    else:
+        annotator = FrameAnnotator(model, conf_threshold, imgsz, roi, tracker, detect_interval, fps, input_path.stem,
+                                   log=log, model_conf=detections_floor if log is not None else None,
+                                   class_ids=class_ids)
 
-            # Записываем аннотированный кадр в выходной файл
-            writer.write(annotated_frame)
-            
-            pbar.update(1)
+    # --- 3. Обработка кадров ---
+    pipelined = batch > 1 or render_workers > 0
+    if pipelined:
+        render_workers = max(1, render_workers)
+        print(f"Конвейерный режим: батч {batch}, потоков отрисовки {render_workers}")
+    stats = StageStats()
+    started = time.perf_counter()
+    with tqdm(total=total_frames, desc="Создание видео") as pbar:
+        if pipelined:
+            frames_done = run_pipelined(cap, writer, annotator, stats, pbar, batch, render_workers)
+        else:
+            frames_done = run_sequential(cap, writer, annotator, stats, pbar)
+    wall_seconds = time.perf_counter() - started
 
     # --- 4. Очистка ---
     cap.release()
     writer.release()
     cv2.destroyAllWindows()
+
+    stats.report(wall_seconds, frames_done)
+    if tracker is not None:
+        events_path = output_path.with_suffix('.events.json')
+        with open(events_path, 'w') as f:
+            json.dump(annotator.events, f, indent=2, ensure_ascii=False)
+        print(f"Подтвержденных дефектов: {len(annotator.events)}, события сохранены в: {events_path}")
+    if log is not None:
+        meta = detection_meta(input_path, fps, frame_width, frame_height, model.names, annotator.model_conf,
+                              model_path, imgsz, roi, detect_interval if tracker is not None else 1)
+        boxes = log.save(save_detections, frames_done, meta)
+        print(f"Детекций сохранено: {boxes}, файл: {save_detections}")
     print("\n--- Готово! Видео с метками успешно создано. ---")
+    return True
+
+
+def detection_meta(input_path, fps, width, height, names, conf_floor, model_path, imgsz, roi, detect_interval):
+    """Метаданные sidecar-файла детекций."""
+    return {
+        'input_video': str(Path(input_path).resolve()), 'fps': fps, 'width': width, 'height': height,
+        'names': {int(k): v for k, v in dict(names).items()}, 'conf_floor': conf_floor,
+        'model_path': str(Path(model_path).resolve()), 'imgsz': imgsz, 'roi': list(roi) if roi else None,
+        'detect_interval': detect_interval,
+    }
+
+
+def print_detection_stats(cache, conf_threshold, class_ids):
+    """Печатает сводную статистику дефектов по классам из sidecar-файла."""
+    stats = cache.stats(conf_threshold, class_ids)
+    duration = cache.total_frames / (cache.fps or 25.0)
+    print(f"\n--- Статистика дефектов (порог {conf_threshold}, {cache.total_frames} кадров, {duration:.1f} с) ---")
+    if not stats:
+        print("Дефекты не найдены.")
+        return
+    print(f"{'Класс':<20}{'рамок':>8}{'кадров':>8}{'доля':>8}{'ср.conf':>9}{'макс':>7}{'эпизодов':>10}"
+          f"{'первый, с':>11}{'послед., с':>12}")
+    for name, s in stats.items():
+        print(f"{name:<20}{s['boxes']:>8}{s['frames']:>8}{s['frame_share']:>8.1%}{s['mean_conf']:>9.3f}"
+              f"{s['max_conf']:>7.3f}{s['episodes']:>10}{s['first_sec']:>11.2f}{s['last_sec']:>12.2f}")
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="Скрипт для создания видео с нанесенными метками детекции.")
-    parser.add_argument('--model_path', required=True, type=str, help='Путь к обученной модели .pt.')
+    parser.add_argument('--model_path', type=str, help='Путь к обученной модели .pt (не нужен с --from_detections).')
     parser.add_argument('--input_video', required=True, type=str, help='Путь к исходному видеофайлу.')
-    parser.add_argument('--output_video', required=True, type=str, help='Путь для сохранения итогового видеофайла.')
+    parser.add_argument('--output_video', type=str,
+                        help='Путь для сохранения итогового видеофайла (с --from_detections можно не указывать - только статистика).')
     parser.add_argument('--conf', type=float, default=0.5, help='Порог уверенности для детекции.')
     parser.add_argument('--imgsz', type=int, default=640, help='Размер изображения для инференса.')
-    
+    parser.add_argument('--backend', choices=BACKENDS, default='pytorch', help='Бэкенд инференса (pytorch, onnx, openvino, openvino-int8).')
+    parser.add_argument('--roi', type=str, help='Область интереса x,y,w,h: инференс только по этой части кадра.')
+    parser.add_argument('--roi_config', type=str, help='YAML-файл с ROI (ключ - префикс имени видео или default).')
+    parser.add_argument('--track', action='store_true', help='Сопровождать дефекты трекером (ID треков, события в .events.json).')
+    parser.add_argument('--detect_interval', type=int, default=1, help='С --track запускать модель на каждом N-м кадре.')
+    parser.add_argument('--confirm_hits', type=int, default=3, help='Число детекций для подтверждения дефекта.')
+    parser.add_argument('--max_missed', type=int, default=3, help='Сколько запусков детектора трек может не находиться.')
+    parser.add_argument('--track_low_conf', type=float, default=0.1, help='Порог модели для продления треков при --track.')
+    parser.add_argument('--batch', type=int, default=1,
+                        help='Размер батча инференса. Больше 1 - конвейерный режим (декодирование, инференс, отрисовка и запись в разных потоках).')
+    parser.add_argument('--render_workers', type=int, default=0,
+                        help='Число потоков отрисовки в конвейерном режиме (0 - по-кадровый режим при --batch 1, иначе 2).')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Число процессов: больше 1 - видео делится на сегменты, которые размечаются параллельно.')
+    parser.add_argument('--segment_seconds', type=float, default=60.0, help='Длина сегмента при --workers > 1, секунды.')
+    parser.add_argument('--keep_segments', action='store_true', help='Не удалять каталог сегментов после склейки.')
+    parser.add_argument('--reader', choices=READERS, default='opencv',
+                        help='Чтение видео: opencv или ffmpeg (уменьшение кадра в декодере, только при --workers 1).')
+    parser.add_argument('--decode_width', type=int,
+                        help='С --reader ffmpeg: ширина декодированных кадров (и итогового видео).')
+    parser.add_argument('--hwaccel', type=str, help='С --reader ffmpeg: аппаратное декодирование (cuda, vaapi, qsv, auto).')
+    parser.add_argument('--save_detections', nargs='?', const='', default=None, metavar='PATH',
+                        help='Сохранить сырые детекции в sidecar-файл NPZ (по умолчанию <выход>.detections.npz).')
+    parser.add_argument('--detections_floor', type=float, default=0.05,
+                        help='Нижний порог уверенности детекций, сохраняемых в sidecar-файл.')
+    parser.add_argument('--from_detections', '--from-detections', type=str, metavar='PATH',
+                        help='Перерисовать видео по sidecar-файлу детекций без запуска модели.')
+    parser.add_argument('--classes', type=str, nargs='+', help='Рисовать только эти классы (имена или номера).')
+    parser.add_argument('--detection_stats', action='store_true',
+                        help='Вывести статистику дефектов по классам из sidecar-файла детекций.')
+
     args = parser.parse_args()
-    
-    process_video(args.model_path, args.input_video, args.output_video, args.conf, args.imgsz)
\ No newline at end of file
+    if args.from_detections is None and not args.model_path:
+        parser.error("нужен --model_path (или --from_detections)")
+    if args.from_detections is None and not args.output_video:
+        parser.error("нужен --output_video")
+
+    if args.from_detections is not None and args.save_detections is not None:
+        parser.error("--save_detections нельзя совместить с --from_detections: модель не запускается")
+
+    cache = DetectionCache(args.from_detections) if args.from_detections else None
+    if args.save_detections == '':
+        args.save_detections = str(Path(args.output_video).with_suffix('.detections.npz'))
+    if cache is not None:
+        floor = cache.meta.get('conf_floor') or 0.0
+        if args.conf < floor:
+            print(f"Предупреждение: порог {args.conf} ниже сохраненного в sidecar-файле ({floor})")
+    try:
+        class_ids = cache.class_ids(args.classes) if cache is not None else None
+    except ValueError as e:
+        parser.error(str(e))
+
+    if cache is not None and not args.output_video:
+        print_detection_stats(cache, args.conf, class_ids)
+        raise SystemExit(0)
+
+    rois = load_rois([args.roi] if args.roi else None, args.roi_config)
+    roi = select_roi(rois, Path(args.input_video).stem)
+
+    tracking = {'confirm_hits': args.confirm_hits, 'max_missed': args.max_missed} if args.track else None
+    render_workers = args.render_workers or (2 if args.batch > 1 else 0)
+
+    if args.workers > 1:
+        if tracking is not None:
+            # Треки не переходят через границы сегментов, обрабатываемых независимо
+            parser.error("--track нельзя совместить с --workers > 1")
+        if cache is not None or args.classes or args.reader != 'opencv':
+            parser.error("--from_detections, --classes и --reader ffmpeg работают только с --workers 1")
+        ok = process_video_segments(args.model_path, args.input_video, args.output_video, args.conf, args.imgsz,
+                                    args.backend, roi, args.workers, args.segment_seconds, args.batch,
+                                    render_workers, args.keep_segments, args.save_detections, args.detections_floor)
+    else:
+        if cache is not None:
+            # Рамки в sidecar-файле уже в координатах полного кадра
+            roi = None
+        ok = process_video(args.model_path, args.input_video, args.output_video, args.conf, args.imgsz, args.backend,
+                           roi, tracking, args.detect_interval, args.track_low_conf, args.batch, render_workers,
+                           args.save_detections, args.detections_floor, args.classes, cache,
+                           {'width': args.decode_width, 'hwaccel': args.hwaccel} if args.reader == 'ffmpeg' else None)
+    if not ok:
+        raise SystemExit(1)
+
+    if args.detection_stats:
+        stats_path = args.from_detections or args.save_detections
+        if stats_path:
+            stats_cache = cache or DetectionCache(stats_path)
+            print_detection_stats(stats_cache, args.conf, stats_cache.class_ids(args.classes))
+        else:
+            print("Статистика доступна только с --save_detections или --from_detections.")
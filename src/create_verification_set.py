@@ -5,13 +5,26 @@ import shutil
 import sys
 from tqdm import tqdm
 
-def create_balanced_set(input_dir, output_dir, neg_sample_rate):
+from frame_store import FrameStore
+
+def copy_image(image_name, input_dir, output_dir, image_store=None):
+    """Копирует изображение из input_dir или, если задан image_store (FrameStore), из хранилища кадров."""
+    if image_store is not None:
+        # Байты JPEG из шарда как есть, без перекодирования
+        with open(os.path.join(output_dir, image_name), 'wb') as f:
+            f.write(image_store.read_bytes(image_name))
+    else:
+        shutil.copy(os.path.join(input_dir, image_name), os.path.join(output_dir, image_name))
+
+def create_balanced_set(input_dir, output_dir, neg_sample_rate, image_store_dir=None):
     """
     Создает сбалансированный набор данных для верификации.
     Копирует все изображения с аннотациями (позитивные) и
     каждое N-е изображение без аннотации (негативные).
     
     ИСПРАВЛЕНИЕ: Для негативных примеров создается ПУСТОЙ .txt файл.
+    Если задан image_store_dir, изображения берутся из упакованного хранилища кадров
+    (см. frame_store.py), а в input_dir лежат только метки.
     """
     if not os.path.isdir(input_dir):
         print(f"[ОШИБКА] Директория с исходными данными не найдена: {input_dir}", file=sys.stderr)
@@ -19,7 +32,11 @@ def create_balanced_set(input_dir, output_dir, neg_sample_rate):
         
     os.makedirs(output_dir, exist_ok=True)
     
-    all_images = sorted([f for f in os.listdir(input_dir) if f.lower().endswith('.jpg')])
+    image_store = FrameStore(image_store_dir) if image_store_dir else None
+    if image_store is not None:
+        all_images = [f for f in image_store.names() if f.lower().endswith('.jpg')]
+    else:
+        all_images = sorted([f for f in os.listdir(input_dir) if f.lower().endswith('.jpg')])
     
     print(f"Найдено {len(all_images)} изображений. Начинаем сэмплирование...")
     
@@ -31,19 +48,18 @@ def create_balanced_set(input_dir, output_dir, neg_sample_rate):
         base_name = os.path.splitext(image_name)[0]
         label_name = f"{base_name}.txt"
         
-        image_path = os.path.join(input_dir, image_name)
         label_path = os.path.join(input_dir, label_name)
         
         # Проверяем, есть ли разметка (позитивный пример)
         if os.path.exists(label_path) and os.path.getsize(label_path) > 0:
-            shutil.copy(image_path, os.path.join(output_dir, image_name))
+            copy_image(image_name, input_dir, output_dir, image_store)
             shutil.copy(label_path, os.path.join(output_dir, label_name))
             positive_count += 1
         else:
             # Это негативный пример. Берем каждого N-го.
             if negative_counter % neg_sample_rate == 0:
                 # Копируем само изображение
-                shutil.copy(image_path, os.path.join(output_dir, image_name))
+                copy_image(image_name, input_dir, output_dir, image_store)
                 
                 # *** ГЛАВНОЕ ИЗМЕНЕНИЕ: СОЗДАЕМ ПУСТОЙ .txt ФАЙЛ ***
                 output_label_path = os.path.join(output_dir, label_name)
@@ -64,6 +80,8 @@ if __name__ == '__main__':
     parser.add_argument('--input_dir', required=True, type=str, help='Папка с экспортом из CVAT (где все jpg и txt).')
     parser.add_argument('--output_dir', required=True, type=str, help='Папка для сохранения сбалансированного набора.')
     parser.add_argument('--neg_sample_rate', type=int, default=20, help='Брать каждый N-й кадр без дефектов.')
+    parser.add_argument('--image_store', type=str,
+                        help='Упакованное хранилище кадров (см. frame_store.py): изображения берутся из него, а из --input_dir - только метки.')
     
     args = parser.parse_args()
-    create_balanced_set(args.input_dir, args.output_dir, args.neg_sample_rate)
\ No newline at end of file
+    create_balanced_set(args.input_dir, args.output_dir, args.neg_sample_rate, args.image_store)
\ No newline at end of file
@@ -1,48 +1,218 @@
 # src/data_processing.py (МОДЕРНИЗИРОВАННАЯ ВЕРСИЯ)
+"""
+Нарезка видео на кадры для разметки.
+
+Пропускаемые кадры только захватываются (cap.grab()) без декодирования в BGR
+(cap.retrieve()), JPEG-кодирование и запись на диск идут в отдельном потоке,
+а несколько видео обрабатываются параллельно в пуле процессов.
+
+С dedup кадр-кандидат сохраняется, только если заметно отличается от последнего
+сохраненного (та же уменьшенная серая подпись, что у ChangeGate в motion_gate.py):
+на медленной намотке это убирает почти одинаковые кадры из разметки и обучения.
+
+С store_dir кадры пишутся не отдельными файлами, а в упакованное хранилище
+(frame_store.py): у каждого видео свои шарды и индекс.
+
+С reader (параметры FFmpegReader, см. video_reader.py) видео читается через ffmpeg:
+прореживание по frame_skip и уменьшение кадра выполняет сам декодер.
+"""
 import cv2
 import os
 import argparse
+import queue
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from tqdm import tqdm
 
-def process_single_video(video_path, output_dir, frame_skip):
+from frame_store import FrameShardWriter, remove_prefix
+from motion_gate import ChangeGate
+from video_reader import READERS, FFmpegReader
+
+VIDEO_EXTENSIONS = ('.mp4', '.avi', '.mov')
+
+
+class JpegWriter:
+    """
+    Поток записи JPEG: декодирование не ждет кодирования и диска. Очередь ограничена по числу кадров.
+    Если задан store (FrameShardWriter), JPEG дописываются в его шард вместо отдельных файлов.
+    """
+
+    DEFAULT_PENDING = 64
+
+    def __init__(self, max_pending=DEFAULT_PENDING, store=None, video=None):
+        self.store = store
+        self.video = video
+        self.saved = 0
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._error = None
+        self._thread = threading.Thread(target=self._run, name="jpeg-writer", daemon=True)
+        self._thread.start()
+
+    def write(self, path, frame, frame_index=None):
+        if self._error is not None:
+            raise self._error
+        self._queue.put((path, frame, frame_index))
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            path, frame, frame_index = item
+            try:
+                if self.store is not None:
+                    ok, data = cv2.imencode('.jpg', frame)
+                    if not ok:
+                        raise OSError(f"Не удалось закодировать кадр: {path}")
+                    height, width = frame.shape[:2]
+                    self.store.write(os.path.basename(path), data, width, height, self.video, frame_index)
+                elif not cv2.imwrite(path, frame):
+                    raise OSError(f"Не удалось записать кадр: {path}")
+                self.saved += 1
+            except Exception as e:
+                self._error = e
+
+    def close(self):
+        """Дожидается записи всех кадров из очереди."""
+        self._queue.put(None)
+        self._thread.join()
+        if self.store is not None:
+            self.store.close()
+        if self._error is not None:
+            raise self._error
+
+
+def process_single_video(video_path, output_dir, frame_skip, show_progress=True, dedup=None, store_dir=None,
+                         reader=None):
     """
     Обрабатывает один видеофайл, нарезая его на кадры.
     Имена кадров содержат префикс из имени видео.
+    dedup - параметры ChangeGate (threshold, pixel_delta) для отсева почти одинаковых кадров, None - без отсева.
+    store_dir - упакованное хранилище кадров вместо output_dir (прежние кадры этого видео в нем заменяются).
+    reader - параметры FFmpegReader (например, {'width': 640}) для чтения через ffmpeg, None - OpenCV.
+    Возвращает статистику: {'video', 'frames', 'candidates', 'saved', 'files', 'seconds'}, files - имена сохраненных кадров.
     """
     video_filename = os.path.basename(video_path)
     video_name_prefix = os.path.splitext(video_filename)[0]
-    
-    cap = cv2.VideoCapture(video_path)
+    started = time.perf_counter()
+
+    if reader is not None:
+        # Декодер сам оставляет каждый frame_skip-й кадр. Кадры пишутся из кольца заранее выделенных
+        # буферов, которое больше очереди JpegWriter, поэтому кадр не перезаписывается до записи
+        cap = FFmpegReader(video_path, every_nth=frame_skip, buffers=JpegWriter.DEFAULT_PENDING + 2, **reader)
+        step, source_step = 1, frame_skip
+    else:
+        cap = cv2.VideoCapture(video_path)
+        step, source_step = frame_skip, 1
     if not cap.isOpened():
         print(f"Предупреждение: Не удалось открыть видеофайл: {video_path}")
-        return
+        return {'video': video_filename, 'frames': 0, 'candidates': 0, 'saved': 0, 'files': [], 'seconds': 0.0}
 
     total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
     frame_count = 0
     saved_count = 0
+    candidates = 0
+    files = []
+    store = None
+    if store_dir is not None:
+        remove_prefix(store_dir, video_name_prefix)
+        store = FrameShardWriter(store_dir, video_name_prefix)
+    writer = JpegWriter(store=store, video=video_filename)
+    # Опорный кадр меняется только при сохранении, поэтому медленный дрейф тоже будет замечен
+    gate = ChangeGate(max_interval=float('inf'), **dedup) if dedup is not None else None
 
     # Создаем прогресс-бар для текущего видео
-    pbar = tqdm(total=total_frames, desc=f"Обработка {video_filename}")
+    pbar = tqdm(total=total_frames, desc=f"Обработка {video_filename}", disable=not show_progress)
+
+    try:
+        while cap.isOpened():
+            # grab() только достает кадр из потока; декодирование в BGR - лишь для сохраняемых кадров
+            if not cap.grab():
+                break
+
+            pbar.update(1)
+
+            if frame_count % step == 0:
+                ret, frame = cap.retrieve()
+                if not ret:
+                    break
+                candidates += 1
+                if gate is not None and not gate.check(frame):
+                    frame_count += 1
+                    continue
+                # Формируем имя файла с префиксом
+                image_name = f"{video_name_prefix}_frame_{saved_count:06d}.jpg"
+                image_path = os.path.join(output_dir, image_name)
+                writer.write(image_path, frame, frame_count * source_step)
+                files.append(image_name)
+                saved_count += 1
+
+            frame_count += 1
+    finally:
+        pbar.close()
+        cap.release()
+        writer.close()
+
+    frame_count *= source_step  # кадров исходного видео
+    seconds = time.perf_counter() - started
+    dedup_note = ''
+    if gate is not None:
+        dedup_note = f", отсеяно похожих: {candidates - saved_count} из {candidates} ({gate.skip_ratio():.1%})"
+    print(f"-> Завершено. Сохранено {saved_count} кадров из {video_filename} "
+          f"({frame_count / seconds if seconds > 0 else 0:.0f} кадров/с{dedup_note})")
+    return {'video': video_filename, 'frames': frame_count, 'candidates': candidates, 'saved': saved_count,
+            'files': files, 'seconds': seconds}
 
-    while cap.isOpened():
-        ret, frame = cap.read()
-        if not ret:
-            break
 
-        pbar.update(1)
+def _init_worker():
+    # Параллелизм дают процессы пула - внутренние потоки OpenCV им только мешают
+    cv2.setNumThreads(1)
 
-        if frame_count % frame_skip == 0:
-            # Формируем имя файла с префиксом
-            image_name = f"{video_name_prefix}_frame_{saved_count:06d}.jpg"
-            image_path = os.path.join(output_dir, image_name)
-            cv2.imwrite(image_path, frame)
-            saved_count += 1
-        
-        frame_count += 1
 
-    pbar.close()
-    cap.release()
-    print(f"-> Завершено. Сохранено {saved_count} кадров из {video_filename}")
+def process_videos(video_paths, output_dir, frame_skip, workers=None, dedup=None, on_result=None, store_dir=None,
+                   reader=None):
+    """
+    Нарезает несколько видео параллельно в пуле из workers процессов
+    (по умолчанию - по числу ядер, но не больше числа видео) и печатает
+    суммарную скорость. on_result(video_path, stats) вызывается по готовности каждого видео.
+    Возвращает список статистик по видео.
+    """
+    video_paths = list(video_paths)
+    if not video_paths:
+        return []
+    workers = max(1, min(workers or os.cpu_count() or 1, len(video_paths)))
+    started = time.perf_counter()
+
+    results = []
+    if workers == 1:
+        for path in video_paths:
+            results.append(process_single_video(path, output_dir, frame_skip, dedup=dedup, store_dir=store_dir,
+                                                reader=reader))
+            if on_result is not None:
+                on_result(path, results[-1])
+    else:
+        print(f"Параллельная нарезка: {len(video_paths)} видео, процессов: {workers}")
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as pool:
+            futures = {pool.submit(process_single_video, path, output_dir, frame_skip, False, dedup, store_dir,
+                                   reader): path
+                       for path in video_paths}
+            for future in tqdm(as_completed(futures), total=len(futures), desc="Видео"):
+                results.append(future.result())
+                if on_result is not None:
+                    on_result(futures[future], results[-1])
+
+    wall_seconds = time.perf_counter() - started
+    frames = sum(r['frames'] for r in results)
+    saved = sum(r['saved'] for r in results)
+    fps = frames / wall_seconds if wall_seconds > 0 else 0.0
+    print(f"\nИтого: {len(results)} видео, прочитано {frames} кадров, сохранено {saved} "
+          f"за {wall_seconds:.1f} с ({fps:.0f} кадров/с)")
+    if dedup is not None:
+        candidates = sum(r['candidates'] for r in results)
+        if candidates:
+            print(f"Отсев похожих кадров: {candidates} -> {saved} (сокращение на {1 - saved / candidates:.1%})")
+    return results
 
 
 if __name__ == '__main__':
@@ -51,19 +221,39 @@ if __name__ == '__main__':
     group = parser.add_mutually_exclusive_group(required=True)
     group.add_argument('--video_dir', type=str, help='Папка с видеофайлами для обработки.')
     group.add_argument('--video_file', type=str, help='Путь к одному видеофайлу для обработки.')
-    
-    parser.add_argument('--output_dir', required=True, type=str, help='Папка для сохранения кадров.')
+
+    parser.add_argument('--output_dir', type=str, help='Папка для сохранения кадров.')
+    parser.add_argument('--store_dir', type=str,
+                        help='Писать кадры в упакованное хранилище (шарды + индекс, см. frame_store.py) вместо --output_dir.')
     parser.add_argument('--frame_skip', type=int, default=4, help='Сохранять каждый N-ный кадр.')
-    
+    parser.add_argument('--workers', type=int, default=None,
+                        help='Число процессов для параллельной обработки видео (по умолчанию - число ядер).')
+    parser.add_argument('--reader', choices=READERS, default='opencv',
+                        help='Чтение видео: opencv или ffmpeg (прореживание и уменьшение кадра в декодере).')
+    parser.add_argument('--decode_width', type=int, help='С --reader ffmpeg: ширина сохраняемых кадров.')
+    parser.add_argument('--hwaccel', type=str, help='С --reader ffmpeg: аппаратное декодирование (cuda, vaapi, qsv, auto).')
+    parser.add_argument('--dedup', action='store_true',
+                        help='Не сохранять кадры, почти не отличающиеся от последнего сохраненного.')
+    parser.add_argument('--dedup_threshold', type=float, default=0.02,
+                        help='Доля изменившихся блоков подписи (0..1), начиная с которой кадр сохраняется.')
+    parser.add_argument('--dedup_pixel_delta', type=int, default=12,
+                        help='Изменение яркости блока (0..255), которое считается изменением.')
+
     args = parser.parse_args()
-    
-    os.makedirs(args.output_dir, exist_ok=True)
+    if not args.output_dir and not args.store_dir:
+        parser.error("нужен --output_dir или --store_dir")
+
+    output_dir = args.output_dir or args.store_dir
+    os.makedirs(output_dir, exist_ok=True)
+    dedup = {'threshold': args.dedup_threshold, 'pixel_delta': args.dedup_pixel_delta} if args.dedup else None
+    reader = {'width': args.decode_width, 'hwaccel': args.hwaccel} if args.reader == 'ffmpeg' else None
 
     if args.video_dir:
         # Старый режим: обработка всех видео в папке
-        video_files = [os.path.join(args.video_dir, f) for f in os.listdir(args.video_dir) if f.lower().endswith(('.mp4', '.avi', '.mov'))]
-        for video_path in video_files:
-            process_single_video(video_path, args.output_dir, args.frame_skip)
+        video_files = [os.path.join(args.video_dir, f) for f in os.listdir(args.video_dir) if f.lower().endswith(VIDEO_EXTENSIONS)]
+        process_videos(video_files, output_dir, args.frame_skip, args.workers, dedup, store_dir=args.store_dir,
+                       reader=reader)
     elif args.video_file:
         # Новый режим: обработка только одного указанного файла
-        process_single_video(args.video_file, args.output_dir, args.frame_skip)
\ No newline at end of file
+        process_videos([args.video_file], output_dir, args.frame_skip, 1, dedup, store_dir=args.store_dir,
+                       reader=reader)
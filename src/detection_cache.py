@@ -0,0 +1,148 @@
+# src/detection_cache.py
+"""
+Кэш сырых детекций видео (sidecar), чтобы перерисовывать разметку с другим
+порогом уверенности или фильтром классов без повторного прогона модели.
+
+Формат - сжатый NPZ в колоночном виде, одна строка на рамку:
+  frame_index (int32), cls (int16), conf (float32), xyxy (float32, N x 4)
+плюс frame_offsets (int64, total_frames + 1): рамки кадра i - это строки
+frame_offsets[i]:frame_offsets[i + 1] (строки отсортированы по кадру), и meta -
+JSON с FPS, размером кадра, именами классов, нижним порогом и параметрами запуска.
+"""
+import json
+
+import numpy as np
+
+
+def resolve_class_ids(classes, names):
+    """Переводит список имен или номеров классов в множество номеров (None - все классы)."""
+    if not classes:
+        return None
+    by_name = {name: int(cls) for cls, name in dict(names).items()}
+    ids = set()
+    for value in classes:
+        if str(value) in by_name:
+            ids.add(by_name[str(value)])
+        elif str(value).isdigit():
+            ids.add(int(value))
+        else:
+            raise ValueError(f"Неизвестный класс: {value}. Доступны: {', '.join(by_name)}")
+    return ids
+
+
+class DetectionLog:
+    """Накопитель детекций при разметке видео. frame_offset прибавляется к номерам кадров (для сегментов)."""
+
+    def __init__(self, frame_offset=0):
+        self.frame_offset = frame_offset
+        self._frames, self._cls, self._conf, self._xyxy = [], [], [], []
+
+    def add(self, frame_index, result):
+        """Добавляет рамки результата YOLO (в координатах полного кадра)."""
+        boxes = result.boxes
+        count = len(boxes)
+        if count == 0:
+            return
+        self._frames.append(np.full(count, frame_index + self.frame_offset, dtype=np.int32))
+        self._cls.append(boxes.cls.cpu().numpy().astype(np.int16))
+        self._conf.append(boxes.conf.cpu().numpy().astype(np.float32))
+        self._xyxy.append(boxes.xyxy.cpu().numpy().astype(np.float32))
+
+    def extend(self, arrays):
+        """Добавляет массивы другого журнала (см. arrays()), например, из процесса-воркера."""
+        if len(arrays['frame_index']):
+            self._frames.append(arrays['frame_index'])
+            self._cls.append(arrays['cls'])
+            self._conf.append(arrays['conf'])
+            self._xyxy.append(arrays['xyxy'])
+
+    def arrays(self):
+        if not self._frames:
+            return {
+                'frame_index': np.zeros(0, dtype=np.int32), 'cls': np.zeros(0, dtype=np.int16),
+                'conf': np.zeros(0, dtype=np.float32), 'xyxy': np.zeros((0, 4), dtype=np.float32),
+            }
+        return {
+            'frame_index': np.concatenate(self._frames), 'cls': np.concatenate(self._cls),
+            'conf': np.concatenate(self._conf), 'xyxy': np.concatenate(self._xyxy),
+        }
+
+    def save(self, path, total_frames, meta):
+        """Сохраняет журнал в NPZ. total_frames - число кадров видео (для frame_offsets)."""
+        arrays = self.arrays()
+        order = np.argsort(arrays['frame_index'], kind='stable')
+        arrays = {key: value[order] for key, value in arrays.items()}
+        total_frames = max(total_frames, int(arrays['frame_index'].max()) + 1 if len(order) else 0)
+        offsets = np.searchsorted(arrays['frame_index'], np.arange(total_frames + 1)).astype(np.int64)
+        meta = dict(meta, total_frames=total_frames, boxes=int(len(order)))
+        np.savez_compressed(path, frame_offsets=offsets, meta=np.array(json.dumps(meta, ensure_ascii=False)),
+                            **arrays)
+        return len(order)
+
+
+class DetectionCache:
+    """Чтение sidecar-файла: рамки отдельных кадров с фильтрами и сводная статистика по видео."""
+
+    def __init__(self, path):
+        with np.load(path) as data:
+            self.frame_index = data['frame_index']
+            self.cls = data['cls']
+            self.conf = data['conf']
+            self.xyxy = data['xyxy']
+            self.frame_offsets = data['frame_offsets']
+            self.meta = json.loads(str(data['meta']))
+        self.names = {int(k): v for k, v in self.meta.get('names', {}).items()}
+        self.fps = self.meta.get('fps') or None
+        self.total_frames = len(self.frame_offsets) - 1
+
+    def arrays(self):
+        """Колонки рамок в формате DetectionLog.arrays()."""
+        return {'frame_index': self.frame_index, 'cls': self.cls, 'conf': self.conf, 'xyxy': self.xyxy}
+
+    def class_ids(self, classes):
+        return resolve_class_ids(classes, self.names)
+
+    def _mask(self, conf, class_ids, rows=slice(None)):
+        mask = self.conf[rows] >= conf
+        if class_ids is not None:
+            mask &= np.isin(self.cls[rows], list(class_ids))
+        return mask
+
+    def frame_boxes(self, frame_index, conf=0.0, class_ids=None):
+        """Рамки кадра как массив N x 6 [x1, y1, x2, y2, conf, cls] (формат boxes.data YOLO)."""
+        if frame_index >= self.total_frames:
+            return np.zeros((0, 6), dtype=np.float32)
+        rows = slice(self.frame_offsets[frame_index], self.frame_offsets[frame_index + 1])
+        mask = self._mask(conf, class_ids, rows)
+        data = np.empty((int(mask.sum()), 6), dtype=np.float32)
+        data[:, :4] = self.xyxy[rows][mask]
+        data[:, 4] = self.conf[rows][mask]
+        data[:, 5] = self.cls[rows][mask]
+        return data
+
+    def stats(self, conf=0.0, class_ids=None, max_gap_seconds=1.0):
+        """
+        Статистика дефектов по классам: число рамок и кадров с детекциями, доля кадров,
+        уверенность, время первой/последней детекции и число эпизодов - серий кадров
+        с детекциями, разделенных паузой больше max_gap_seconds.
+        """
+        mask = self._mask(conf, class_ids)
+        fps = self.fps or 25.0
+        max_gap = max(1, round(max_gap_seconds * fps))
+        result = {}
+        for cls in np.unique(self.cls[mask]):
+            class_mask = mask & (self.cls == cls)
+            frames = np.unique(self.frame_index[class_mask])
+            confs = self.conf[class_mask]
+            episodes = 1 + int(np.count_nonzero(np.diff(frames) > max_gap)) if len(frames) else 0
+            result[self.names.get(int(cls), str(int(cls)))] = {
+                'boxes': int(class_mask.sum()),
+                'frames': int(len(frames)),
+                'frame_share': round(len(frames) / self.total_frames, 4) if self.total_frames else 0.0,
+                'mean_conf': round(float(confs.mean()), 3),
+                'max_conf': round(float(confs.max()), 3),
+                'first_sec': round(float(frames[0]) / fps, 2),
+                'last_sec': round(float(frames[-1]) / fps, 2),
+                'episodes': episodes,
+            }
+        return result
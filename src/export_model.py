@@ -0,0 +1,98 @@
+# src/export_model.py
+"""
+Экспорт обученной модели (.pt) в оптимизированный формат для CPU-инференса
+(ONNX Runtime или OpenVINO) с опциональным INT8-квантованием и проверкой
+соответствия (mAP и задержка) исходной PyTorch-модели.
+"""
+import argparse
+import json
+import sys
+from pathlib import Path
+from ultralytics import YOLO
+
+
+def validate(model_path, data, imgsz, task=None):
+    """Прогоняет валидацию на CPU и возвращает mAP50, mAP50-95 и время этапов (мс/изображение)."""
+    model = YOLO(str(model_path), task=task)
+    metrics = model.val(data=data, imgsz=imgsz, batch=1, device='cpu', plots=False, verbose=False)
+    return {
+        'mAP50': round(float(metrics.box.map50), 4),
+        'mAP50-95': round(float(metrics.box.map), 4),
+        'preprocess_ms': round(metrics.speed['preprocess'], 2),
+        'inference_ms': round(metrics.speed['inference'], 2),
+        'postprocess_ms': round(metrics.speed['postprocess'], 2),
+    }
+
+
+def parity_check(reference_path, exported_path, data, imgsz):
+    """Сравнивает экспортированную модель с исходной .pt и печатает таблицу."""
+    print("\n--- Проверка соответствия (валидация на CPU) ---")
+    reference = validate(reference_path, data, imgsz)
+    exported = validate(exported_path, data, imgsz, task='detect')
+
+    print(f"{'Метрика':<16}{'PyTorch':>12}{'Экспорт':>12}{'Разница':>12}")
+    for key in reference:
+        delta = exported[key] - reference[key]
+        print(f"{key:<16}{reference[key]:>12}{exported[key]:>12}{delta:>+12.4f}")
+    if exported['inference_ms'] > 0:
+        print(f"Ускорение инференса: x{reference['inference_ms'] / exported['inference_ms']:.2f}")
+
+    report = {'reference': str(reference_path), 'exported': str(exported_path),
+              'pytorch': reference, 'export': exported}
+    exported_path = Path(exported_path)
+    report_path = exported_path.with_name(exported_path.stem + exported_path.suffix.replace('.', '_') + '_parity.json')
+    report_path.write_text(json.dumps(report, indent=2, ensure_ascii=False))
+    print(f"Отчет сохранен в: {report_path}")
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Экспорт модели для CPU-инференса (ONNX / OpenVINO, INT8).")
+    parser.add_argument('--model_path', required=True, type=str, help='Путь к обученной модели .pt.')
+    parser.add_argument('--format', choices=['onnx', 'openvino'], default='openvino', help='Целевой формат.')
+    parser.add_argument('--int8', action='store_true', help='INT8-квантование после обучения (только openvino).')
+    parser.add_argument('--data', type=str, default='config.yaml',
+                        help='Конфигурация датасета: источник калибровочных данных и данных для проверки.')
+    parser.add_argument('--fraction', type=float, default=0.1,
+                        help='Доля валидационной выборки из data/04_datasets для калибровки INT8.')
+    parser.add_argument('--imgsz', type=int, default=640, help='Размер изображения (экспорт фиксирует его).')
+    parser.add_argument('--batch', type=int, default=1, help='Размер батча экспортированной модели (для --static).')
+    shape = parser.add_mutually_exclusive_group()
+    # Сервер с несколькими камерами, prelabel.py и create_labeled_video.py подают кадры батчем,
+    # поэтому по умолчанию размеры входа динамические
+    shape.add_argument('--dynamic', dest='dynamic', action='store_true', default=True,
+                       help='Динамические размеры входа (по умолчанию): модель принимает батч любого размера.')
+    shape.add_argument('--static', dest='dynamic', action='store_false',
+                       help='Статические размеры входа: модель принимает только батч ровно --batch.')
+    parser.add_argument('--parity', action='store_true', help='Сравнить mAP и задержку с исходной .pt моделью.')
+    args = parser.parse_args()
+
+    if args.int8 and args.format != 'openvino':
+        # Статическое INT8-квантование ONNX-графа YOLO заметно теряет точность; для CPU используем OpenVINO (NNCF)
+        print("[ОШИБКА] INT8-квантование поддерживается только для --format openvino.", file=sys.stderr)
+        sys.exit(1)
+
+    print(f"Загрузка модели из: {args.model_path}")
+    model = YOLO(args.model_path)
+
+    print(f"Экспорт в {args.format}{' (INT8)' if args.int8 else ''}...")
+    if not args.dynamic:
+        print(f"Предупреждение: модель со статическим входом принимает только батч из {args.batch} кадров; "
+              f"для сервера с несколькими камерами и --batch в prelabel.py/create_labeled_video.py "
+              f"экспортируйте без --static.")
+    exported_path = model.export(
+        format=args.format,
+        imgsz=args.imgsz,
+        int8=args.int8,
+        data=args.data,
+        fraction=args.fraction,
+        batch=args.batch,
+        dynamic=args.dynamic,
+        device='cpu',
+    )
+    backend = args.format + ('-int8' if args.int8 else '')
+    print(f"[УСПЕХ] Модель экспортирована: {exported_path}")
+    print(f"Для использования передайте инструментам: --model_path {args.model_path} --backend {backend}")
+
+    if args.parity:
+        parity_check(args.model_path, exported_path, args.data, args.imgsz)
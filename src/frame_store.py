@@ -0,0 +1,205 @@
+# src/frame_store.py
+"""
+Упакованное хранилище кадров вместо сотен тысяч отдельных JPEG в одной папке.
+
+Кадры (уже закодированные JPEG) дописываются в большие файлы-шарды, а индекс -
+JSON Lines со строкой на кадр: имя, шард, смещение, длина, размеры и исходное видео.
+У каждого писателя свой префикс (обычно имя видео), свои шарды и свой индекс:
+
+    <store_dir>/<prefix>.00000.shard, <prefix>.00001.shard, ...
+    <store_dir>/<prefix>.index.jsonl
+
+Поэтому видео можно нарезать параллельно в разных процессах, а удалить или
+пересоздать кадры одного видео - удалив файлы его префикса. Чтение - через mmap:
+случайный доступ по имени и последовательный проход в порядке шардов
+(без открытия файла на кадр), плюс экспорт обратно в отдельные файлы для CVAT.
+"""
+import argparse
+import json
+import mmap
+import os
+from pathlib import Path
+
+import cv2
+import numpy as np
+from tqdm import tqdm
+
+SHARD_SUFFIX = '.shard'
+INDEX_SUFFIX = '.index.jsonl'
+
+
+class FrameShardWriter:
+    """Дописывает закодированные кадры в шарды префикса; новый шард начинается после shard_size_mb."""
+
+    def __init__(self, store_dir, prefix, shard_size_mb=1024):
+        self.store_dir = Path(store_dir)
+        self.store_dir.mkdir(parents=True, exist_ok=True)
+        self.prefix = prefix
+        self.shard_size = int(shard_size_mb * 1024 * 1024)
+        self.count = 0
+        self._shard_number = -1
+        self._shard = None
+        self._index = open(self.store_dir / f"{prefix}{INDEX_SUFFIX}", 'a')
+        self._open_next_shard()
+
+    def _open_next_shard(self):
+        if self._shard is not None:
+            self._shard.close()
+        self._shard_number += 1
+        self._shard_name = f"{self.prefix}.{self._shard_number:05d}{SHARD_SUFFIX}"
+        self._shard = open(self.store_dir / self._shard_name, 'ab')
+
+    def write(self, name, data, width, height, video=None, frame_index=None):
+        """data - байты закодированного изображения (например, результат cv2.imencode)."""
+        data = memoryview(data).cast('B')
+        if self._shard.tell() > 0 and self._shard.tell() + len(data) > self.shard_size:
+            self._open_next_shard()
+        offset = self._shard.tell()
+        self._shard.write(data)
+        # Строка индекса не должна попасть на диск раньше байтов кадра
+        self._shard.flush()
+        entry = {'name': name, 'shard': self._shard_name, 'offset': offset, 'length': len(data),
+                 'width': width, 'height': height, 'video': video, 'frame_index': frame_index}
+        self._index.write(json.dumps(entry, ensure_ascii=False) + '\n')
+        self.count += 1
+
+    def close(self):
+        os.fsync(self._shard.fileno())
+        self._shard.close()
+        self._index.close()
+
+
+def remove_prefix(store_dir, prefix):
+    """Удаляет шарды и индекс префикса. Возвращает число удаленных файлов."""
+    store_dir = Path(store_dir)
+    # glob по префиксу "a" захватил бы и шарды "a.b" - оставляем только <prefix>.<номер>.shard
+    paths = [path for path in store_dir.glob(f"{prefix}.*{SHARD_SUFFIX}")
+             if path.name[len(prefix) + 1:-len(SHARD_SUFFIX)].isdigit()]
+    paths.append(store_dir / f"{prefix}{INDEX_SUFFIX}")
+    removed = 0
+    for path in paths:
+        try:
+            path.unlink()
+            removed += 1
+        except FileNotFoundError:
+            pass
+    return removed
+
+
+class FrameStore:
+    """
+    Чтение хранилища: все индексы загружаются в память, шарды открываются через mmap
+    по мере обращения. Если имя встречается несколько раз, действует последняя запись.
+    """
+
+    def __init__(self, store_dir):
+        self.store_dir = Path(store_dir)
+        if not self.store_dir.is_dir():
+            raise FileNotFoundError(f"Хранилище кадров не найдено: {store_dir}")
+        self.entries = {}
+        for index_path in sorted(self.store_dir.glob(f"*{INDEX_SUFFIX}")):
+            with open(index_path) as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        break  # недописанная последняя строка прерванного запуска
+                    self.entries[entry['name']] = entry
+        self._maps = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, name):
+        return name in self.entries
+
+    def names(self, prefix=None):
+        """Имена кадров по порядку (как sorted(os.listdir()) для папки), prefix - фильтр по началу имени."""
+        return sorted(name for name in self.entries if prefix is None or name.startswith(prefix))
+
+    def info(self, name):
+        return self.entries[name]
+
+    def _map(self, shard):
+        if shard not in self._maps:
+            with open(self.store_dir / shard, 'rb') as f:
+                self._maps[shard] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._maps[shard]
+
+    def read_bytes(self, name):
+        """Закодированные байты кадра (без копирования файла на диск)."""
+        entry = self.entries[name]
+        return self._map(entry['shard'])[entry['offset']:entry['offset'] + entry['length']]
+
+    def read(self, name, flags=cv2.IMREAD_COLOR):
+        """Декодированный кадр (как cv2.imread)."""
+        return cv2.imdecode(np.frombuffer(self.read_bytes(name), dtype=np.uint8), flags)
+
+    def iter_bytes(self, names=None):
+        """Последовательный проход: (запись индекса, байты) в порядке расположения в шардах."""
+        entries = [self.entries[name] for name in names] if names is not None else list(self.entries.values())
+        entries.sort(key=lambda e: (e['shard'], e['offset']))
+        for entry in entries:
+            yield entry, self._map(entry['shard'])[entry['offset']:entry['offset'] + entry['length']]
+
+    def iter_frames(self, names=None, flags=cv2.IMREAD_COLOR):
+        """Последовательный проход с декодированием: (запись индекса, кадр)."""
+        for entry, data in self.iter_bytes(names):
+            yield entry, cv2.imdecode(np.frombuffer(data, dtype=np.uint8), flags)
+
+    def export(self, output_dir, names=None, show_progress=True):
+        """Выгружает кадры в отдельные файлы (байты как есть, без перекодирования). Возвращает их число."""
+        os.makedirs(output_dir, exist_ok=True)
+        count = 0
+        total = len(names) if names is not None else len(self.entries)
+        for entry, data in tqdm(self.iter_bytes(names), total=total, desc="Экспорт кадров", disable=not show_progress):
+            with open(os.path.join(output_dir, entry['name']), 'wb') as f:
+                f.write(data)
+            count += 1
+        return count
+
+    def close(self):
+        for mapped in self._maps.values():
+            mapped.close()
+        self._maps = {}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Просмотр и экспорт упакованного хранилища кадров.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    info_parser = subparsers.add_parser('info', help='Сводка по хранилищу: кадры и объем по видео.')
+    info_parser.add_argument('--store_dir', required=True, type=str, help='Папка хранилища кадров.')
+
+    export_parser = subparsers.add_parser('export', help='Выгрузить кадры в отдельные JPEG (например, для CVAT).')
+    export_parser.add_argument('--store_dir', required=True, type=str, help='Папка хранилища кадров.')
+    export_parser.add_argument('--output_dir', required=True, type=str, help='Папка для отдельных файлов.')
+    export_parser.add_argument('--prefix', type=str, help='Выгрузить только кадры с этим префиксом имени (видео).')
+    export_parser.add_argument('--names_file', type=str, help='Файл со списком имен кадров (по одному в строке).')
+
+    args = parser.parse_args()
+    store = FrameStore(args.store_dir)
+
+    if args.command == 'info':
+        videos = {}
+        for entry in store.entries.values():
+            stats = videos.setdefault(entry.get('video') or '-', [0, 0])
+            stats[0] += 1
+            stats[1] += entry['length']
+        print(f"Хранилище: {args.store_dir}, кадров: {len(store)}")
+        for video, (frames, size) in sorted(videos.items()):
+            print(f"  - {video}: {frames} кадров, {size / 1024 / 1024:.1f} МБ")
+    else:
+        names = store.names(args.prefix)
+        if args.names_file:
+            with open(args.names_file) as f:
+                wanted = {line.strip() for line in f if line.strip()}
+            missing = wanted - set(store.entries)
+            if missing:
+                print(f"Предупреждение: в хранилище нет {len(missing)} кадров из списка")
+            names = [name for name in names if name in wanted]
+        count = store.export(args.output_dir, names)
+        print(f"Выгружено кадров: {count} в {args.output_dir}")
+    store.close()
@@ -0,0 +1,15 @@
+# src/hashing.py
+"""Хэши содержимого файлов для инкрементальных запусков (манифест нарезки, кэш пре-лейблинга)."""
+import hashlib
+
+
+def file_hash(path, chunk_size=1024 * 1024):
+    """SHA-256 содержимого файла."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.hexdigest()
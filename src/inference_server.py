@@ -1,77 +1,274 @@
 # src/inference_server.py
+import time
+_PROCESS_START = time.perf_counter()
 
-import cv2
 import argparse
-from ultralytics import YOLO
-from flask import Flask, Response
+import json
+import os
+import threading
+from flask import Flask, Response, jsonify, abort, request
+import metrics
+from model_backend import BACKENDS
+from startup import StartupState
+# ultralytics, torch и cv2 импортируются в initialize() - уже после того, как HTTP-сервер
+# поднялся и отвечает на /healthz
 
 # --- Глобальные переменные ---
 app = Flask(__name__)
 model = None
-source = None
+sources = {}  # {source_id: источник}
+default_source_id = None  # Источник для /video_feed без ID
 frame_skip = 1
 confidence_threshold = 0.5
 imgsz = 640  # <-- Новая глобальная переменная
+pipeline = None  # Общий фоновый конвейер детекции для всех источников
+startup = StartupState(_PROCESS_START)
 
-def generate_frames():
-    """Генератор, который захватывает кадры, обрабатывает их и отдает как jpeg."""
-    # Используем try-except, чтобы элегантно обработать ошибку, если источник - число
-    try:
-        source_int = int(source)
-        cap = cv2.VideoCapture(source_int)
-    except ValueError:
-        cap = cv2.VideoCapture(source)
-        
-    if not cap.isOpened():
-        print(f"Ошибка: Не удалось открыть источник видео: {source}")
-        return
-
-    frame_count = 0
-    while True:
-        ret, frame = cap.read()
-        if not ret:
-            break
-
-        frame_count += 1
-        if frame_count % frame_skip != 0:
-            continue
-            
-        results = model(frame, imgsz=imgsz, conf=confidence_threshold, verbose=False) # <-- Используем imgsz
-        annotated_frame = results[0].plot()
-
-        if len(results[0].boxes) > 0:
-            cv2.putText(annotated_frame, "DEFECT DETECTED!", (10, 70), 
-                        cv2.FONT_HERSHEY_SIMPLEX, 1.5, (0, 0, 255), 3)
-
-        (flag, encodedImage) = cv2.imencode(".jpg", annotated_frame)
-        if not flag:
-            continue
-        yield (b'--frame\r\n' b'Content-Type: image/jpeg\r\n\r\n' + 
-               bytearray(encodedImage) + b'\r\n')
+def get_pipeline():
+    if pipeline is None:
+        abort(503, description="Сервер запускается: модель еще не загружена (см. /readyz)")
+    return pipeline
+
+def get_stream(source_id):
+    stream = get_pipeline().streams.get(source_id)
+    if stream is None:
+        abort(404, description=f"Неизвестный источник: {source_id}")
+    return stream
+
+def generate_frames(stream):
+    """
+    Генератор, который отдает кадры источника как multipart jpeg. Все клиенты
+    читают из одного общего конвейера, поэтому новый зритель не запускает
+    повторный захват и инференс, а стоит только сетевого трафика.
+    """
+    for packet in stream.broadcaster.subscribe():
+        yield packet['chunk']
 
 @app.route("/video_feed")
-def video_feed():
-    return Response(generate_frames(), mimetype="multipart/x-mixed-replace; boundary=frame")
+@app.route("/video_feed/<source_id>")
+def video_feed(source_id=None):
+    stream = get_stream(source_id or default_source_id)
+    return Response(generate_frames(stream), mimetype="multipart/x-mixed-replace; boundary=frame")
+
+def generate_detections(source_id=None):
+    """Генератор Server-Sent Events: одна JSON-запись детекций на обработанный кадр."""
+    for records in pipeline.detections.subscribe():
+        for record in records:
+            if source_id is None or record['source_id'] == source_id:
+                yield f"data: {json.dumps(record, separators=(',', ':'))}\n\n"
+
+@app.route("/detections")
+@app.route("/detections/<source_id>")
+def detections(source_id=None):
+    """Поток детекций (SSE) без отрисовки и кодирования кадров: все источники или один."""
+    if source_id is not None:
+        get_stream(source_id)
+    else:
+        get_pipeline()
+    return Response(generate_detections(source_id), mimetype="text/event-stream",
+                    headers={'Cache-Control': 'no-cache'})
+
+@app.route("/frame_skip", methods=['GET', 'POST'])
+@app.route("/frame_skip/<source_id>", methods=['GET', 'POST'])
+def frame_skip_control(source_id=None):
+    """
+    Чтение и изменение шага пропуска кадров без перезапуска сервера.
+    POST /frame_skip?value=3 (или value=auto) - для всех источников,
+    POST /frame_skip/<ID>?value=... - для одного.
+    Значение можно передать и в JSON-теле: {"value": 3} или просто 3 / "auto".
+    """
+    streams = [get_stream(source_id)] if source_id else list(get_pipeline().streams.values())
+    if request.method == 'POST':
+        value = request.values.get('value')
+        if value is None and request.is_json:
+            body = request.get_json()
+            value = body.get('value') if isinstance(body, dict) else body
+        try:
+            for stream in streams:
+                stream.set_frame_skip(value)
+        except (TypeError, ValueError):
+            abort(400, description="value должен быть целым числом >= 1 или 'auto'")
+    return jsonify({stream.source_id: stream.frame_skip_state() for stream in streams})
+
+@app.route("/metrics")
+def metrics_endpoint():
+    """Метрики в формате Prometheus: гистограммы стадий, счетчики кадров, очереди, клиенты, RSS."""
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+@app.route("/stats")
+def stats():
+    """Время работы стадий конвейера по источникам, размер батча инференса и число зрителей."""
+    return jsonify(get_pipeline().snapshot())
+
+@app.route("/healthz")
+def healthz():
+    """Liveness: процесс жив и обслуживает HTTP (модель может еще загружаться)."""
+    return jsonify({'status': 'ok', 'uptime_s': round(startup.total_seconds(), 1)})
+
+@app.route("/readyz")
+def readyz():
+    """Readiness: модель загружена и прогрета, источники запущены. Иначе 503 и текущая фаза запуска."""
+    return jsonify(startup.report()), (200 if startup.ready else 503)
+
+def initialize(args):
+    """
+    Тяжелая часть запуска, выполняется в фоне: импорт библиотек, загрузка модели,
+    прогрев на imgsz и запуск источников. Время каждой фазы попадает в отчет /readyz.
+    """
+    global model, sources, pipeline, default_source_id
+    try:
+        with startup.phase('import'):
+            import ultralytics  # noqa: F401 - основная часть времени импорта
+            from model_backend import load_model, warmup
+            from roi import load_rois
+            from stream_pipeline import DetectionPipeline, parse_sources
+            sources = parse_sources(args.source)
+
+        with startup.phase('model_load'):
+            model = load_model(args.model_path, args.backend)
+
+        with startup.phase('warmup'):
+            # Прогреваем батчем по числу источников - так же, как потом работает конвейер
+            runs = warmup(model, imgsz, batch=len(sources), runs=args.warmup_runs) if args.warmup_runs > 0 else []
+        if runs:
+            print(f"[*] Прогрев: {', '.join(f'{t * 1000:.0f} мс' for t in runs)}")
+
+        # Запускаем один фоновый цикл детекции, общий для всех клиентов и источников
+        motion_gate = None
+        if args.motion_gate:
+            motion_gate = {'threshold': args.motion_threshold, 'max_interval': args.motion_max_interval}
+        tracking, model_conf = None, confidence_threshold
+        if args.track:
+            tracking = {'high_conf': confidence_threshold, 'confirm_hits': args.confirm_hits, 'max_missed': args.max_missed}
+            model_conf = min(args.track_low_conf, confidence_threshold)
+        clips = None
+        if args.record_clips:
+            clips = {'output_dir': args.record_clips, 'pre_seconds': args.clip_pre_seconds,
+                     'post_seconds': args.clip_post_seconds, 'max_buffer_mb': args.clip_buffer_mb}
+        reader = None
+        if args.reader == 'ffmpeg':
+            reader = {'width': args.decode_width, 'fps': args.decode_fps, 'hwaccel': args.hwaccel}
+        with startup.phase('pipeline_start'):
+            new_pipeline = DetectionPipeline(model, sources, frame_skip, model_conf, imgsz,
+                                             max_frame_skip=args.max_frame_skip, motion_gate=motion_gate,
+                                             jpeg_quality=args.jpeg_quality, stream_scale=args.stream_scale,
+                                             stream_max_fps=args.stream_max_fps,
+                                             rois=load_rois(args.roi, args.roi_config),
+                                             tracking=tracking, detect_interval=args.detect_interval, clips=clips,
+                                             reader=reader)
+            for source_id in new_pipeline.start():
+                print(f"Ошибка: Не удалось открыть источник видео {source_id}: {sources[source_id]}")
+        if not new_pipeline.streams:
+            raise RuntimeError("Не удалось открыть ни один источник видео")
+    except Exception as e:
+        startup.fail(e)
+        print(f"Ошибка запуска: {e}")
+        # Без модели или источников сервер бесполезен - завершаем процесс, чтобы его перезапустили
+        os._exit(1)
+
+    default_source_id = next(iter(new_pipeline.streams))
+    pipeline = new_pipeline
+    startup.set_ready(pipeline, default_source_id)
+
+    print(f"[*] Сервер готов. Время запуска: {startup.summary()}")
+    for source_id in pipeline.streams:
+        print(f"[*] Стрим {source_id} доступен по адресу: http://<ВАШ_IP_АДРЕС>:{args.port}/video_feed/{source_id}")
+
+def frame_skip_arg(value):
+    """Тип аргумента --frame_skip: целое число >= 1 или 'auto'."""
+    if value == 'auto':
+        return value
+    value = int(value)
+    if value < 1:
+        raise argparse.ArgumentTypeError("frame_skip должен быть >= 1 или 'auto'")
+    return value
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="Стриминговый сервер для детекции.")
     parser.add_argument('--model_path', type=str, required=True)
-    parser.add_argument('--source', type=str, required=True)
-    parser.add_argument('--frame_skip', type=int, default=1) # <-- Поставим 1, чтобы обрабатывать каждый кадр
+    parser.add_argument('--backend', choices=BACKENDS, default='pytorch',
+                        help='Бэкенд инференса (экспорт для CPU - src/export_model.py).')
+    parser.add_argument('--source', type=str, nargs='+', required=True,
+                        help='Один или несколько источников: путь, ID камеры, URL или "id=источник".')
+    parser.add_argument('--frame_skip', type=frame_skip_arg, default=1,
+                        help='Обрабатывать каждый N-й кадр или "auto" - подбирать N по задержке инференса.') # <-- Поставим 1, чтобы обрабатывать каждый кадр
+    parser.add_argument('--max_frame_skip', type=int, default=30, help='Верхняя граница шага пропуска в режиме auto.')
     parser.add_argument('--confidence', type=float, default=0.6)
+    parser.add_argument('--roi', type=str, action='append',
+                        help='Область интереса x,y,w,h (для всех источников) или id=x,y,w,h. Можно указать несколько раз.')
+    parser.add_argument('--roi_config', type=str, help='YAML-файл с ROI по ID источников (ключ default - для всех).')
+    parser.add_argument('--motion_gate', action='store_true',
+                        help='Не прогонять через модель кадры без изменений, переиспользуя прошлые детекции.')
+    parser.add_argument('--motion_threshold', type=float, default=0.01,
+                        help='Доля изменившихся блоков кадра (0..1), начиная с которой запускается инференс.')
+    parser.add_argument('--motion_max_interval', type=float, default=2.0,
+                        help='Максимальный интервал (с) без инференса, после которого он выполняется принудительно.')
+    parser.add_argument('--track', action='store_true',
+                        help='Сопровождать дефекты трекером: стабильные ID, одно событие на дефект, тревога без мигания.')
+    parser.add_argument('--detect_interval', type=int, default=1,
+                        help='С --track запускать модель на каждом N-м кадре, между ними рамки продлевает трекер.')
+    parser.add_argument('--confirm_hits', type=int, default=3,
+                        help='Число детекций, после которого трек считается подтвержденным дефектом.')
+    parser.add_argument('--max_missed', type=int, default=3,
+                        help='Сколько запусков детектора подряд трек может не находиться, прежде чем удалиться.')
+    parser.add_argument('--track_low_conf', type=float, default=0.1,
+                        help='С --track модель запускается с этим порогом: слабые детекции только продлевают треки, '
+                             'новые треки заводятся по --confidence.')
+    parser.add_argument('--record_clips', type=str,
+                        help='Каталог для клипов дефектов (нужен --track): N секунд до и после подтвержденного дефекта + JSON с рамками.')
+    parser.add_argument('--clip_pre_seconds', type=float, default=5.0, help='Секунд видео до события в клипе.')
+    parser.add_argument('--clip_post_seconds', type=float, default=5.0, help='Секунд видео после события в клипе.')
+    parser.add_argument('--clip_buffer_mb', type=int, default=512,
+                        help='Ограничение памяти на источник, МБ: кольцевой буфер сырых кадров и кадры клипа, ждущие записи.')
+    parser.add_argument('--reader', choices=('opencv', 'ffmpeg'), default='opencv',
+                        help='Чтение источников: opencv (cv2.VideoCapture) или ffmpeg - подпроцесс ffmpeg, '
+                             'который уменьшает кадр и прореживает FPS прямо в декодере.')
+    parser.add_argument('--decode_width', type=int,
+                        help='С --reader ffmpeg: ширина кадра на выходе декодера (ROI задается в этих координатах).')
+    parser.add_argument('--decode_fps', type=float, help='С --reader ffmpeg: прореживание источника до этого FPS.')
+    parser.add_argument('--hwaccel', type=str, help='С --reader ffmpeg: аппаратное декодирование (cuda, vaapi, qsv, auto).')
+    parser.add_argument('--jpeg_quality', type=int, default=80, help='Качество JPEG превью-стрима (1-100).')
+    parser.add_argument('--stream_scale', type=float, default=1.0,
+                        help='Масштаб кадров превью-стрима (например, 0.5 - вдвое меньше по каждой стороне).')
+    parser.add_argument('--stream_max_fps', type=float, default=0,
+                        help='Максимальный FPS превью-стрима на источник (0 - без ограничения).')
+    parser.add_argument('--server', choices=('asgi', 'flask'), default='asgi',
+                        help='asgi - асинхронный сервер (Starlette + Uvicorn) с ограниченными буферами клиентов; '
+                             'flask - встроенный отладочный сервер Flask.')
+    parser.add_argument('--client_buffer', type=int, default=2,
+                        help='Размер очереди отправки на клиента в режиме asgi: медленный клиент теряет старые кадры.')
     parser.add_argument('--host', type=str, default='0.0.0.0')
     parser.add_argument('--port', type=int, default=5000)
     parser.add_argument('--imgsz', type=int, default=640, help='Размер изображения для инференса.') # <-- Новый аргумент
+    parser.add_argument('--warmup_runs', type=int, default=2,
+                        help='Число прогревочных инференсов на imgsz перед тем, как сервер станет готов (0 - без прогрева).')
     args = parser.parse_args()
+    if args.record_clips and not args.track:
+        # Без трекера подтвержденного дефекта нет: клип начинался бы с одиночного ложного срабатывания
+        parser.error("--record_clips требует --track")
 
     # Инициализируем глобальные переменные
-    model = YOLO(args.model_path)
-    source = args.source
     frame_skip = args.frame_skip
     confidence_threshold = args.confidence
     imgsz = args.imgsz # <-- Сохраняем новый аргумент
 
-    print(f"[*] Запуск сервера на http://{args.host}:{args.port}")
-    print(f"[*] Стрим доступен по адресу: http://<ВАШ_IP_АДРЕС>:{args.port}/video_feed")
-    
-    app.run(host=args.host, port=args.port, debug=False)
\ No newline at end of file
+    # Модель грузится в фоне: /healthz отвечает сразу, /readyz - когда модель прогрета
+    threading.Thread(target=initialize, args=(args,), name="startup", daemon=True).start()
+
+    print(f"[*] Запуск сервера ({args.server}) на http://{args.host}:{args.port}")
+    print(f"[*] Проверки: http://<ВАШ_IP_АДРЕС>:{args.port}/healthz, http://<ВАШ_IP_АДРЕС>:{args.port}/readyz")
+    print(f"[*] Поток детекций (SSE): http://<ВАШ_IP_АДРЕС>:{args.port}/detections")
+    print(f"[*] Управление пропуском кадров: http://<ВАШ_IP_АДРЕС>:{args.port}/frame_skip")
+    print(f"[*] Метрики Prometheus: http://<ВАШ_IP_АДРЕС>:{args.port}/metrics")
+    print(f"[*] Статистика стадий: http://<ВАШ_IP_АДРЕС>:{args.port}/stats")
+
+    if args.server == 'asgi':
+        # Импортируем здесь, чтобы режим flask не требовал starlette и uvicorn
+        from asgi_server import serve
+        serve(startup, args.host, args.port, args.client_buffer)
+    else:
+        try:
+            app.run(host=args.host, port=args.port, debug=False)
+        finally:
+            if pipeline is not None:
+                pipeline.stop()
\ No newline at end of file
@@ -0,0 +1,68 @@
+# src/model_backend.py
+"""
+Выбор бэкенда инференса для всех инструментов (сервер, разметка видео, пре-лейблинг).
+
+Исходные веса всегда задаются путем к .pt. Для CPU-бэкендов рядом с ним должна
+лежать экспортированная модель (см. src/export_model.py) с именем по соглашению
+Ultralytics:
+  pytorch        -> best.pt
+  onnx           -> best.onnx
+  openvino       -> best_openvino_model/
+  openvino-int8  -> best_int8_openvino_model/
+Если в model_path сразу передан .onnx или папка *_openvino_model, она используется как есть.
+"""
+import time
+from pathlib import Path
+
+import numpy as np
+
+BACKENDS = ('pytorch', 'onnx', 'openvino', 'openvino-int8')
+
+_EXPORT_SUFFIXES = {
+    'onnx': '.onnx',
+    'openvino': '_openvino_model',
+    'openvino-int8': '_int8_openvino_model',
+}
+
+
+def resolve_model_path(model_path, backend='pytorch'):
+    """Возвращает путь к модели для выбранного бэкенда."""
+    if backend not in BACKENDS:
+        raise ValueError(f"Неизвестный бэкенд '{backend}'. Доступны: {', '.join(BACKENDS)}")
+    path = Path(model_path)
+    if backend == 'pytorch' or path.suffix == '.onnx' or path.name.endswith('_openvino_model'):
+        return path
+    return path.with_name(path.stem + _EXPORT_SUFFIXES[backend])
+
+
+def load_model(model_path, backend='pytorch'):
+    """
+    Загружает модель YOLO для выбранного бэкенда.
+    Бросает FileNotFoundError, если экспортированной модели нет.
+    """
+    path = resolve_model_path(model_path, backend)
+    if not path.exists():
+        raise FileNotFoundError(
+            f"Модель для бэкенда '{backend}' не найдена: {path}. "
+            f"Сначала выполните экспорт: python3 src/export_model.py --model_path {model_path}"
+        )
+    # ultralytics (и torch) импортируются только здесь: модули, которым нужен лишь
+    # список BACKENDS, загружаются быстро
+    from ultralytics import YOLO
+    # Для экспортированных форматов задача не хранится в весах, указываем ее явно
+    return YOLO(str(path), task='detect')
+
+
+def warmup(model, imgsz=640, batch=1, runs=2):
+    """
+    Прогревает модель пустыми кадрами imgsz x imgsz батчем batch: первый инференс
+    платит за инициализацию ядер и выделение памяти, и делать это лучше до того,
+    как сервер объявит себя готовым. Возвращает время каждого прогона, с.
+    """
+    frames = [np.zeros((imgsz, imgsz, 3), dtype=np.uint8)] * max(1, batch)
+    timings = []
+    for _ in range(max(1, runs)):
+        t0 = time.perf_counter()
+        model(frames, imgsz=imgsz, verbose=False)
+        timings.append(time.perf_counter() - t0)
+    return timings
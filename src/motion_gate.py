@@ -0,0 +1,71 @@
+# src/motion_gate.py
+"""
+Дешевый детектор изменений перед моделью: на длинных участках намотки кадры
+почти одинаковые, и для них можно переиспользовать предыдущие детекции.
+
+Кадр уменьшается до маленькой серой "подписи" (по умолчанию 64x36, каждый пиксель -
+усредненный блок исходного кадра) и сравнивается с подписью последнего кадра,
+прошедшего через модель. Доля блоков, яркость которых изменилась сильнее
+pixel_delta, сравнивается с порогом threshold.
+"""
+import time
+
+import cv2
+import numpy as np
+
+
+class ChangeGate:
+    """
+    threshold     - доля изменившихся блоков (0..1), начиная с которой кадр считается новым;
+    max_interval  - через сколько секунд инференс выполняется принудительно;
+    pixel_delta   - изменение яркости блока (0..255), которое считается изменением.
+    """
+
+    def __init__(self, threshold=0.01, max_interval=2.0, pixel_delta=12, size=(64, 36)):
+        self.threshold = threshold
+        self.max_interval = max_interval
+        self.pixel_delta = pixel_delta
+        self.size = size
+
+        self._reference = None
+        self._reference_time = 0.0
+        self.checked = 0
+        self.skipped = 0
+        self.last_score = None
+
+    def signature(self, frame):
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) if frame.ndim == 3 else frame
+        return cv2.resize(gray, self.size, interpolation=cv2.INTER_AREA)
+
+    def check(self, frame):
+        """
+        Возвращает True, если кадр нужно прогнать через модель (и запоминает его
+        как новый опорный), или False, если можно переиспользовать прошлые детекции.
+        """
+        self.checked += 1
+        signature = self.signature(frame)
+        now = time.monotonic()
+
+        if self._reference is not None and now - self._reference_time < self.max_interval:
+            diff = cv2.absdiff(signature, self._reference)
+            self.last_score = float(np.count_nonzero(diff > self.pixel_delta)) / diff.size
+            if self.last_score < self.threshold:
+                self.skipped += 1
+                return False
+
+        self._reference = signature
+        self._reference_time = now
+        return True
+
+    def skip_ratio(self):
+        return round(self.skipped / self.checked, 3) if self.checked else 0.0
+
+    def state(self):
+        return {
+            'threshold': self.threshold,
+            'max_interval': self.max_interval,
+            'checked': self.checked,
+            'skipped': self.skipped,
+            'skip_ratio': self.skip_ratio(),
+            'last_score': round(self.last_score, 4) if self.last_score is not None else None,
+        }
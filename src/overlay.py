@@ -0,0 +1,67 @@
+# src/overlay.py
+"""
+Легкая отрисовка детекций для превью-стрима вместо results.plot().
+
+Рисует только наши классы (row_gap, defect) прямо в переиспользуемый буфер:
+кадр копируется (или сразу уменьшается) в заранее выделенный массив, поэтому
+на каждый кадр не создается новая копия изображения.
+"""
+import cv2
+import numpy as np
+
+# Цвета классов в BGR; неизвестные классы рисуются серым
+CLASS_COLORS = {
+    'row_gap': (255, 160, 0),
+    'defect': (0, 0, 255),
+}
+DEFAULT_COLOR = (200, 200, 200)
+
+
+class OverlayRenderer:
+    """
+    names - словарь {class_id: имя класса} модели;
+    scale - коэффициент уменьшения выходного кадра (1.0 - исходное разрешение).
+    """
+
+    def __init__(self, names, scale=1.0, line_width=2):
+        self.names = names
+        self.scale = scale
+        self.line_width = line_width
+        self._colors = {cls: CLASS_COLORS.get(name, DEFAULT_COLOR) for cls, name in names.items()}
+        self._buffer = None
+
+    def _prepare_buffer(self, frame):
+        height, width = frame.shape[:2]
+        size = (max(1, round(width * self.scale)), max(1, round(height * self.scale)))
+        if self._buffer is None or self._buffer.shape[1::-1] != size:
+            self._buffer = np.empty((size[1], size[0], 3), dtype=np.uint8)
+        if self.scale == 1.0:
+            np.copyto(self._buffer, frame)
+        else:
+            cv2.resize(frame, size, dst=self._buffer, interpolation=cv2.INTER_AREA)
+        return self._buffer
+
+    def render(self, frame, boxes, alarm_text="DEFECT DETECTED!"):
+        """
+        Рисует рамки поверх копии кадра во внутреннем буфере и возвращает его.
+        boxes - строки [class_id, conf, x1, y1, x2, y2] в пикселях исходного кадра
+        (формат detection_record), после трекера в конце строки идет track_id.
+        Буфер перезаписывается следующим вызовом.
+        """
+        canvas = self._prepare_buffer(frame)
+        font_scale = max(0.4, 0.6 * self.scale)
+        for class_id, conf, x1, y1, x2, y2, *track in boxes:
+            color = self._colors.get(class_id, DEFAULT_COLOR)
+            p1 = (int(x1 * self.scale), int(y1 * self.scale))
+            p2 = (int(x2 * self.scale), int(y2 * self.scale))
+            cv2.rectangle(canvas, p1, p2, color, self.line_width)
+            label = f"{self.names.get(class_id, class_id)} {conf:.2f}"
+            if track:
+                label = f"#{track[0]} {label}"
+            cv2.putText(canvas, label, (p1[0], max(12, p1[1] - 4)), cv2.FONT_HERSHEY_SIMPLEX,
+                        font_scale, color, 1, cv2.LINE_AA)
+
+        if boxes and alarm_text:
+            cv2.putText(canvas, alarm_text, (10, int(70 * self.scale)), cv2.FONT_HERSHEY_SIMPLEX,
+                        1.5 * self.scale, (0, 0, 255), max(1, int(3 * self.scale)))
+        return canvas
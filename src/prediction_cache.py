@@ -0,0 +1,106 @@
+# src/prediction_cache.py
+"""
+Постоянный кэш сырых предсказаний для prelabel.py.
+
+Ключ записи - хэш содержимого изображения (байты JPEG, а для кадров, читаемых
+прямо из видео, - пиксели кадра) плюс ROI, если она задана. Записи лежат в
+отдельном файле для каждой пары "хэш весов модели + параметры инференса"
+(imgsz, бэкенд, нижний порог уверенности):
+
+    <cache_dir>/<ключ>.jsonl       - строка на изображение: {"key": ..., "boxes": [[cls, conf, x, y, w, h], ...]}
+    <cache_dir>/<ключ>.meta.json   - путь и хэш модели, параметры (для справки)
+
+Рамки хранятся в нормализованных xywh со всеми детекциями не ниже нижнего
+порога, поэтому метки можно выгрузить заново с любым --conf не ниже него без
+запуска модели. Кэши разных чекпоинтов лежат рядом и не мешают друг другу.
+"""
+import hashlib
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+
+from hashing import file_hash
+from model_backend import resolve_model_path
+
+# Столбцы строки рамки: класс, уверенность, нормализованные x, y, w, h
+ROW_SIZE = 6
+
+
+def model_hash(model_path, backend='pytorch'):
+    """SHA-256 весов модели выбранного бэкенда (для папки OpenVINO - всех ее файлов по порядку)."""
+    path = resolve_model_path(model_path, backend)
+    if not path.is_dir():
+        return file_hash(path)
+    digest = hashlib.sha256()
+    for file_path in sorted(p for p in path.rglob('*') if p.is_file()):
+        digest.update(str(file_path.relative_to(path)).encode())
+        digest.update(file_hash(file_path).encode())
+    return digest.hexdigest()
+
+
+def image_key(data, roi=None):
+    """Ключ изображения: SHA-256 байтов (массив NumPy или bytes) и ROI, если она есть."""
+    key = hashlib.sha256(memoryview(np.ascontiguousarray(data)).cast('B')).hexdigest()
+    return key if roi is None else f"{key}@{','.join(map(str, roi))}"
+
+
+class PredictionCache:
+    """Кэш предсказаний одной модели с одними параметрами инференса. Новые записи сразу дописываются в файл."""
+
+    def __init__(self, cache_dir, model_path, backend, params):
+        cache_dir = Path(cache_dir)
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        self.model_hash = model_hash(model_path, backend)
+        self.params = dict(params, backend=backend)
+        name = hashlib.sha256(json.dumps([self.model_hash, self.params], sort_keys=True).encode()).hexdigest()[:16]
+        self.path = cache_dir / f"{name}.jsonl"
+        meta_path = cache_dir / f"{name}.meta.json"
+        if not meta_path.exists():
+            with open(meta_path, 'w') as f:
+                json.dump({'model_path': str(model_path), 'model_sha256': self.model_hash, 'params': self.params},
+                          f, indent=2, ensure_ascii=False)
+
+        self.entries = {}
+        if self.path.exists():
+            valid_size = 0
+            with open(self.path, 'rb') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line) if line.endswith(b'\n') else None
+                    except ValueError:
+                        record = None
+                    if record is None:
+                        break  # недописанная последняя строка прерванного запуска
+                    self.entries[record['key']] = record['boxes']
+                    valid_size += len(line)
+            if valid_size < self.path.stat().st_size:
+                # Обрезаем хвост, чтобы новые записи не склеились с недописанной строкой
+                os.truncate(self.path, valid_size)
+        self.added = 0
+        self._file = open(self.path, 'a')
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        """Рамки изображения (float32, N x 6) или None, если его нет в кэше."""
+        boxes = self.entries.get(key)
+        if boxes is None:
+            return None
+        return np.array(boxes, dtype=np.float32).reshape(-1, ROW_SIZE)
+
+    def add(self, key, rows):
+        if key in self.entries:
+            return  # одинаковые изображения в одном батче
+        boxes = rows.tolist()
+        self.entries[key] = boxes
+        self._file.write(json.dumps({'key': key, 'boxes': boxes}) + '\n')
+        self.added += 1
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
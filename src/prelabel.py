@@ -1,57 +1,273 @@
 # src/prelabel.py
 import os
 import argparse
-from ultralytics import YOLO
+from frame_store import FrameStore
+from model_backend import BACKENDS, load_model
+from prediction_cache import PredictionCache, image_key
+from roi import clip_roi, crop, load_rois, select_roi, shift_result
+from video_index import frame_name, iter_frames, load_index, read_refs
 from pathlib import Path
 from tqdm import tqdm
 import glob
+import queue
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+import cv2
+import numpy as np
 
-def run_prelabeling(model_path: str, input_dir: str, output_dir: str, conf_threshold: float, imgsz: int, quiet: bool = False):
+# One line per box: class id and normalized xywh; repr() of the float32 values keeps full precision
+LABEL_LINE = '%d %r %r %r %r\n'
+
+
+def prediction_rows(result):
+    """All boxes of a result as one float32 array of rows: class, confidence, normalized x, y, w, h."""
+    boxes = result.boxes
+    # Whole arrays are copied off the device at once instead of indexing tensors per box
+    return np.column_stack((boxes.cls.cpu().numpy(), boxes.conf.cpu().numpy(),
+                            boxes.xywhn.cpu().numpy())).astype(np.float32)
+
+
+def format_labels(rows, conf_threshold=None):
+    """YOLO label text for prediction rows above conf_threshold, formatted in one step."""
+    if conf_threshold is not None:
+        # Same strict comparison as the model's own confidence filter
+        rows = rows[rows[:, 1] > conf_threshold]
+    if not len(rows):
+        return ''
+    return (LABEL_LINE * len(rows)) % tuple(rows[:, [0, 2, 3, 4, 5]].ravel().tolist())
+
+
+def prefetch(items, load, workers=4, queue_size=16):
+    """
+    Yields load(item) for every item, in order. A producer thread walks items and submits
+    them to a pool of worker threads (cv2 decoding releases the GIL), keeping at most
+    queue_size results in flight.
+    """
+    futures = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+
+    def produce(pool):
+        try:
+            for item in items:
+                if stop.is_set():
+                    break
+                futures.put(pool.submit(load, item))
+        except Exception as e:
+            # Errors of the item source itself (e.g. an unreadable video) surface in the consumer
+            failed = Future()
+            failed.set_exception(e)
+            futures.put(failed)
+        futures.put(None)
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        producer = threading.Thread(target=produce, args=(pool,), name="prefetch", daemon=True)
+        producer.start()
+        try:
+            while True:
+                future = futures.get()
+                if future is None:
+                    break
+                yield future.result()
+        finally:
+            stop.set()
+            # Unblock the producer if it is waiting on a full queue
+            while producer.is_alive():
+                try:
+                    futures.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+
+
+class LabelWriter:
+    """Writes label files on a background thread so inference never waits on the disk."""
+
+    def __init__(self, max_pending=256):
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._error = None
+        self._thread = threading.Thread(target=self._run, name="label-writer", daemon=True)
+        self._thread.start()
+
+    def write(self, path, text):
+        if self._error is not None:
+            raise self._error
+        self._queue.put((path, text))
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            path, text = item
+            try:
+                with open(path, 'w') as f:
+                    f.write(text)
+            except Exception as e:
+                self._error = e
+
+    def close(self):
+        """Waits until every queued label file is written."""
+        self._queue.put(None)
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+
+
+def run_prelabeling(model_path: str, input_dir: str, output_dir: str, conf_threshold: float, imgsz: int, quiet: bool = False,
+                    backend: str = 'pytorch', rois: dict = None, input_store: str = None,
+                    input_refs: str = None, video_index: str = None, batch: int = 1, workers: int = 4,
+                    cache_dir: str = None, cache_floor: float = 0.05):
     """
     Runs inference on all images in a directory and saves the results as YOLO .txt files.
+    If rois is given (see roi.load_rois), each image is cropped to the ROI matching its
+    file name prefix before inference; labels are still normalized to the full image.
+    If input_store is given, frames are streamed from that packed frame store
+    (see frame_store.py) instead of input_dir. If input_refs (CSV of video,frame_idx) and
+    video_index are given, frames are decoded straight from the source videos (see video_index.py)
+    and labels are named <video>_vframe_<frame_idx>.txt.
+    Images are decoded ahead of the model by `workers` prefetch threads and run through the
+    model `batch` at a time; label files are written by a background thread.
+    If cache_dir is given, raw predictions down to cache_floor are kept in a persistent cache
+    (see prediction_cache.py) keyed by model weights, inference parameters and image content:
+    images seen before are not decoded or run through the model, their labels are re-exported
+    from the cache at the current conf_threshold.
     """
     # --- 1. Load Model ---
     if not quiet:
-        print(f"Loading model from: {model_path}")
+        print(f"Loading model from: {model_path} (backend: {backend})")
     try:
-        model = YOLO(model_path)
+        model = load_model(model_path, backend)
     except Exception as e:
         print(f"Error loading model: {e}") # Errors should always be printed
         return
 
+    # Inference runs at the cache floor so that later runs can re-export at any higher threshold
+    model_conf = min(conf_threshold, cache_floor) if cache_dir is not None else conf_threshold
+    cache = None
+    if cache_dir is not None:
+        cache = PredictionCache(cache_dir, model_path, backend, {'imgsz': imgsz, 'conf_floor': model_conf})
+        if not quiet:
+            print(f"Prediction cache: {cache.path} ({len(cache)} images)")
+
     # --- 2. Prepare Directories ---
-    input_path = Path(input_dir)
     output_path = Path(output_dir)
     output_path.mkdir(parents=True, exist_ok=True)
     
-    image_files = glob.glob(os.path.join(input_path, '*.jpg'))
+    # Each source yields (image name, item) and a loader that turns the item into encoded image bytes
+    # (None - the item is already a decoded frame); loading and decoding run on the prefetch workers,
+    # so they overlap with inference
+    if input_refs is not None:
+        index = load_index(video_index)
+        if index is None:
+            print(f"Error: video index not found or outdated: {video_index}")
+            return
+        refs = read_refs(input_refs)
+        # Video frames are decoded sequentially by the producer thread (seeking needs one reader per video)
+        items = ((Path(frame_name(video, frame_idx) + '.jpg'), image)
+                 for video, frame_idx, image in iter_frames(refs, index))
+        load = None
+        image_count = len(set(refs))
+        source = input_refs
+    elif input_store is not None:
+        store = FrameStore(input_store)
+        # Frames are read sequentially in shard order from memory-mapped shards
+        items = ((Path(entry['name']), data) for entry, data in store.iter_bytes())
+        load = lambda data: np.frombuffer(data, dtype=np.uint8)
+        image_count = len(store)
+        source = input_store
+    else:
+        image_files = glob.glob(os.path.join(Path(input_dir), '*.jpg'))
+        items = ((Path(image_path), image_path) for image_path in image_files)
+        load = lambda image_path: np.fromfile(image_path, dtype=np.uint8)
+        image_count = len(image_files)
+        source = input_dir
     if not quiet:
-        print(f"Found {len(image_files)} images to process in {input_dir}.")
+        print(f"Found {image_count} images to process in {source}.")
+
+    checked_rois = {}  # (roi, image shape) -> ROI clipped to the image, or None for the full image
+    checked_lock = threading.Lock()
+
+    def effective_roi(roi, shape, image_path):
+        # The ROI is checked once per image size: it may not fit images smaller than the config assumes
+        with checked_lock:
+            if (roi, shape) not in checked_rois:
+                clipped = clip_roi(roi, shape)
+                if clipped is None:
+                    print(f"Warning: ROI {roi} lies outside {shape[1]}x{shape[0]} images "
+                          f"(first seen: {image_path.name}), using the full image")
+                elif clipped != roi:
+                    print(f"Warning: ROI {roi} exceeds {shape[1]}x{shape[0]} images "
+                          f"(first seen: {image_path.name}), clipped to {clipped}")
+                checked_rois[roi, shape] = clipped
+            return checked_rois[roi, shape]
+
+    def prepare(item):
+        # Look up the cache, then decode and crop to the ROI (if one matches this frame) on a prefetch worker
+        image_path, data = item
+        roi = select_roi(rois, image_path.stem)
+        if load is not None:
+            data = load(data)
+        key = rows = None
+        if cache is not None:
+            key = image_key(data, roi)
+            rows = cache.get(key)
+            if rows is not None:
+                return image_path, None, None, None, key, rows
+        image = cv2.imdecode(data, cv2.IMREAD_COLOR) if load is not None else data
+        if image is None:
+            raise OSError(f"Could not read image: {image_path}")
+        if roi is not None:
+            roi = effective_roi(tuple(roi), image.shape[:2], image_path)
+        model_input, offset = crop(image, roi)
+        return image_path, image, model_input, offset, key, None
 
     # --- 3. Process Images ---
-    
-    # Use tqdm only if not in quiet mode
-    image_iterator = tqdm(image_files, desc="Pre-labeling images") if not quiet else image_files
-
-    for image_path_str in image_iterator:
-        image_path = Path(image_path_str)
-        
-        # Run detection
-        results = model(image_path, imgsz=imgsz, conf=conf_threshold, verbose=False)
-        
-        # Prepare output file path
-        output_txt_path = output_path / (image_path.stem + '.txt')
-        
-        # Write results to .txt file
-        with open(output_txt_path, 'w') as f:
-            for box in results[0].boxes:
-                # Get coordinates in xywhn format (normalized)
-                xywhn = box.xywhn[0]
-                # Get class id
-                class_id = int(box.cls[0])
-                
-                # Write to file in YOLO format
-                f.write(f"{class_id} {xywhn[0]} {xywhn[1]} {xywhn[2]} {xywhn[3]}\n")
+    batch = max(1, batch)
+    writer = LabelWriter()
+    pbar = tqdm(total=image_count, desc="Pre-labeling images", disable=quiet)
+
+    def run_batch(pending):
+        results = model([model_input for _, _, model_input, _, _, _ in pending], imgsz=imgsz, conf=model_conf,
+                        verbose=False)
+        for (image_path, image, model_input, offset, key, _), result in zip(pending, results):
+            if model_input is not image:
+                result = shift_result(result, offset, image)
+            rows = prediction_rows(result)
+            if cache is not None:
+                cache.add(key, rows)
+            writer.write(output_path / (image_path.stem + '.txt'), format_labels(rows, conf_threshold))
+        if cache is not None:
+            cache.flush()
+        pbar.update(len(pending))
+
+    hits = misses = 0
+    try:
+        pending = []
+        for prepared in prefetch(items, prepare, workers, queue_size=max(2 * batch, 4 * workers)):
+            image_path, _, model_input, _, _, rows = prepared
+            if rows is not None:
+                # Seen before with this model and parameters: re-export without inference
+                writer.write(output_path / (image_path.stem + '.txt'), format_labels(rows, conf_threshold))
+                pbar.update(1)
+                hits += 1
+                continue
+            misses += 1
+            # Batches are kept to one input shape: mixed shapes change the letterbox padding
+            if pending and (len(pending) == batch or pending[-1][2].shape != model_input.shape):
+                run_batch(pending)
+                pending = []
+            pending.append(prepared)
+        if pending:
+            run_batch(pending)
+    finally:
+        pbar.close()
+        writer.close()
+        if cache is not None:
+            cache.close()
+
+    if cache is not None and not quiet:
+        total = hits + misses
+        print(f"Prediction cache: {hits} hits, {misses} misses ({hits / total if total else 0:.1%} hit rate), "
+              f"{cache.added} images added, {len(cache)} in cache")
 
     if not quiet:
         print("\n--- Pre-labeling complete! ---")
@@ -61,12 +277,32 @@ def run_prelabeling(model_path: str, input_dir: str, output_dir: str, conf_thres
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="Batch pre-labeling script using a trained YOLO model.")
     parser.add_argument('--model_path', required=True, type=str, help='Path to the trained .pt model.')
-    parser.add_argument('--input_dir', required=True, type=str, help='Directory with images to label.')
+    parser.add_argument('--input_dir', type=str, help='Directory with images to label.')
+    parser.add_argument('--input_store', type=str, help='Packed frame store (see frame_store.py) to label instead of --input_dir.')
+    parser.add_argument('--input_refs', type=str, help='CSV of video,frame_idx frame references to label straight from the videos.')
+    parser.add_argument('--video_index', type=str, help='Video index JSON for --input_refs (see video_index.py).')
     parser.add_argument('--output_dir', required=True, type=str, help='Directory to save the .txt label files.')
     parser.add_argument('--conf', type=float, default=0.25, help='Confidence threshold for detection.')
     parser.add_argument('--imgsz', type=int, default=640, help='Image size for inference.')
+    parser.add_argument('--batch', type=int, default=1, help='Number of images per inference batch (e.g. 16 on CPU).')
+    parser.add_argument('--workers', type=int, default=4, help='Number of threads decoding images ahead of the model.')
+    parser.add_argument('--cache_dir', type=str,
+                        help='Persistent prediction cache: images seen with the same model and parameters are not re-run.')
+    parser.add_argument('--cache_floor', type=float, default=0.05,
+                        help='Lowest confidence kept in the cache; cached images can be re-exported at any --conf above it.')
     parser.add_argument('--quiet', action='store_true', help='Suppress all output except for errors.')
+    parser.add_argument('--backend', choices=BACKENDS, default='pytorch', help='Inference backend (pytorch, onnx, openvino, openvino-int8).')
+    parser.add_argument('--roi', type=str, help='Region of interest x,y,w,h applied to every image before inference.')
+    parser.add_argument('--roi_config', type=str, help='YAML file with ROIs keyed by frame name prefix (video name) or "default".')
     
     args = parser.parse_args()
+    if not args.input_dir and not args.input_store and not args.input_refs:
+        parser.error("one of --input_dir, --input_store or --input_refs is required")
+    if args.input_refs and not args.video_index:
+        parser.error("--input_refs requires --video_index")
+    
+    rois = load_rois([args.roi] if args.roi else None, args.roi_config)
     
-    run_prelabeling(args.model_path, args.input_dir, args.output_dir, args.conf, args.imgsz, args.quiet)
+    run_prelabeling(args.model_path, args.input_dir, args.output_dir, args.conf, args.imgsz, args.quiet, args.backend, rois,
+                    args.input_store, args.input_refs, args.video_index, args.batch, args.workers,
+                    args.cache_dir, args.cache_floor)
@@ -7,6 +7,8 @@ import random
 import argparse
 from tqdm import tqdm
 
+from frame_store import FrameStore
+
 def create_dirs(base_path):
     """Создает правильную структуру папок для YOLO."""
     os.makedirs(os.path.join(base_path, 'train', 'images'), exist_ok=True)
@@ -14,18 +16,28 @@ def create_dirs(base_path):
     os.makedirs(os.path.join(base_path, 'valid', 'images'), exist_ok=True)
     os.makedirs(os.path.join(base_path, 'valid', 'labels'), exist_ok=True)
 
-def copy_files(basenames, image_source_dir, label_source_dir, dest_dir_base):
-    """Копирует пары .jpg и .txt файлов в целевую директорию."""
+def copy_files(basenames, image_source_dir, label_source_dir, dest_dir_base, image_store=None):
+    """
+    Копирует пары .jpg и .txt файлов в целевую директорию.
+    Если задан image_store (FrameStore), изображения берутся из упакованного хранилища кадров.
+    """
     image_dest = os.path.join(dest_dir_base, 'images')
     label_dest = os.path.join(dest_dir_base, 'labels')
     
     for basename in tqdm(basenames, desc=f"Копирование в {dest_dir_base}"):
-        shutil.copy(os.path.join(image_source_dir, basename + '.jpg'), image_dest)
+        if image_store is not None:
+            # Байты JPEG из шарда как есть, без перекодирования
+            with open(os.path.join(image_dest, basename + '.jpg'), 'wb') as f:
+                f.write(image_store.read_bytes(basename + '.jpg'))
+        else:
+            shutil.copy(os.path.join(image_source_dir, basename + '.jpg'), image_dest)
         shutil.copy(os.path.join(label_source_dir, basename + '.txt'), label_dest)
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="Финальная сборка датасета из верифицированной разметки.")
-    parser.add_argument('--image_dir', type=str, required=True, help='Папка со ВСЕМИ исходными изображениями (e.g., /app/data/02_processed/frames).')
+    image_group = parser.add_mutually_exclusive_group(required=True)
+    image_group.add_argument('--image_dir', type=str, help='Папка со ВСЕМИ исходными изображениями (e.g., /app/data/02_processed/frames).')
+    image_group.add_argument('--image_store', type=str, help='Упакованное хранилище кадров (см. frame_store.py) вместо --image_dir.')
     parser.add_argument('--label_dir', type=str, required=True, help='Папка с ВЕРИФИЦИРОВАННОЙ разметкой (e.g., /app/data/temp_cvat_verified_export/obj_train_data).')
     parser.add_argument('--output_dir', type=str, default='/app/data/03_annotated', help='Финальная папка для датасета.')
     parser.add_argument('--val_split', type=float, default=0.2, help='Доля данных для валидации.')
@@ -48,6 +60,13 @@ if __name__ == '__main__':
         exit()
 
     final_basenames = [os.path.splitext(os.path.basename(f))[0] for f in label_files]
+
+    image_store = FrameStore(args.image_store) if args.image_store else None
+    if image_store is not None:
+        missing = [name for name in final_basenames if name + '.jpg' not in image_store]
+        if missing:
+            print(f"Ошибка: в хранилище {args.image_store} нет {len(missing)} изображений из разметки (например, {missing[0]}.jpg).")
+            exit()
     
     # Перемешиваем и делим на train/valid
     random.shuffle(final_basenames)
@@ -63,8 +82,8 @@ if __name__ == '__main__':
     print("-" * 30)
 
     # Копируем файлы в финальные директории
-    copy_files(train_basenames, args.image_dir, args.label_dir, os.path.join(args.output_dir, 'train'))
-    copy_files(valid_basenames, args.image_dir, args.label_dir, os.path.join(args.output_dir, 'valid'))
+    copy_files(train_basenames, args.image_dir, args.label_dir, os.path.join(args.output_dir, 'train'), image_store)
+    copy_files(valid_basenames, args.image_dir, args.label_dir, os.path.join(args.output_dir, 'valid'), image_store)
 
     print("Сборка финального датасета успешно завершена!")
     print(f"Готовый датасет находится в папке: {args.output_dir}")
\ No newline at end of file
@@ -0,0 +1,117 @@
+# src/roi.py
+"""
+Области интереса (ROI): зона намотки занимает только часть кадра, поэтому
+кадр обрезается до ROI перед инференсом, а рамки переводятся обратно
+в координаты полного кадра. Так меньший imgsz дает то же эффективное
+разрешение на зоне дефектов.
+
+ROI задается как "x,y,w,h" в пикселях полного кадра:
+  - в командной строке: --roi 0,200,1920,700 (для всех) или --roi cam1=0,200,1920,700;
+  - в YAML-файле (--roi_config), где ключ - ID источника, префикс имени видео/кадра или default:
+        default: [0, 200, 1920, 700]
+        cam1: [100, 150, 1600, 800]
+"""
+import re
+
+import yaml
+
+DEFAULT_KEY = 'default'
+
+
+def parse_roi(text):
+    """Разбирает строку "x,y,w,h" в кортеж целых чисел."""
+    parts = [int(float(p)) for p in str(text).split(',')]
+    if len(parts) != 4 or parts[2] <= 0 or parts[3] <= 0:
+        raise ValueError(f"ROI должна иметь вид x,y,w,h с положительными w и h: {text}")
+    return tuple(parts)
+
+
+def load_rois(roi_args=None, roi_config=None):
+    """
+    Собирает словарь {ключ: (x, y, w, h)} из YAML-файла и аргументов --roi.
+    Аргументы командной строки переопределяют значения из файла.
+    """
+    rois = {}
+    if roi_config:
+        with open(roi_config) as f:
+            for key, value in (yaml.safe_load(f) or {}).items():
+                rois[str(key)] = parse_roi(','.join(map(str, value)) if isinstance(value, (list, tuple)) else value)
+    for value in roi_args or []:
+        match = re.match(r'^([A-Za-z0-9_-]+)=(.+)$', value)
+        key, text = (match.group(1), match.group(2)) if match else (DEFAULT_KEY, value)
+        rois[key] = parse_roi(text)
+    return rois
+
+
+def select_roi(rois, name):
+    """ROI для источника или файла: точное совпадение ключа, затем самый длинный префикс имени, затем default."""
+    if not rois:
+        return None
+    if name in rois:
+        return rois[name]
+    prefixes = [key for key in rois if key != DEFAULT_KEY and str(name).startswith(key)]
+    if prefixes:
+        return rois[max(prefixes, key=len)]
+    return rois.get(DEFAULT_KEY)
+
+
+def clip_roi(roi, frame_shape):
+    """Пересечение ROI с кадром размера frame_shape (высота, ширина, ...) или None, если оно пустое."""
+    height, width = frame_shape[:2]
+    x, y, w, h = roi
+    x0, y0 = max(0, x), max(0, y)
+    x1, y1 = min(width, x + w), min(height, y + h)
+    if x1 <= x0 or y1 <= y0:
+        return None
+    return x0, y0, x1 - x0, y1 - y0
+
+
+def check_roi(roi, frame_shape, name):
+    """
+    Проверяет ROI источника name по размеру его кадра (вызывается на первом кадре).
+    ROI, выходящая за кадр, обрезается по его границам; если ROI целиком вне кадра
+    (например, разрешение источника меньше, чем рассчитан конфиг), используется весь
+    кадр. В обоих случаях печатается предупреждение. Возвращает ROI для crop() или None.
+    """
+    if roi is None:
+        return None
+    height, width = frame_shape[:2]
+    clipped = clip_roi(roi, frame_shape)
+    if clipped is None:
+        print(f"Предупреждение: [{name}] ROI {tuple(roi)} целиком вне кадра {width}x{height}, используется весь кадр")
+    elif clipped != tuple(roi):
+        print(f"Предупреждение: [{name}] ROI {tuple(roi)} выходит за кадр {width}x{height}, обрезана до {clipped}")
+    return clipped
+
+
+def crop(frame, roi):
+    """
+    Вырезает ROI из кадра (без копирования - это view) с обрезкой по границам кадра.
+    Возвращает (обрезанный кадр, (x0, y0)) - смещение для перевода рамок обратно.
+    Пустое пересечение с кадром - ошибка (ROI проверяется заранее, см. check_roi).
+    """
+    if roi is None:
+        return frame, (0, 0)
+    clipped = clip_roi(roi, frame.shape)
+    if clipped is None:
+        height, width = frame.shape[:2]
+        raise ValueError(f"ROI {tuple(roi)} не пересекается с кадром {width}x{height}")
+    x0, y0, w, h = clipped
+    return frame[y0:y0 + h, x0:x0 + w], (x0, y0)
+
+
+def shift_result(result, offset, frame):
+    """
+    Переводит результат YOLO, полученный на обрезанном кадре, в координаты полного
+    кадра frame: рамки сдвигаются на offset, orig_img заменяется полным кадром.
+    """
+    from ultralytics.engine.results import Results
+
+    data = result.boxes.data.clone()
+    if len(data) and offset != (0, 0):
+        shift = data.new_tensor([offset[0], offset[1], offset[0], offset[1]])
+        data[:, :4] += shift
+    shifted = Results(frame, path=result.path, names=result.names, boxes=data)
+    shifted.speed = result.speed
+    return shifted
+
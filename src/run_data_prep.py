@@ -1,59 +1,163 @@
 # src/run_data_prep.py (ФИНАЛЬНАЯ ВЕРСИЯ)
-import subprocess
+"""
+Пайплайн подготовки данных: санитарная обработка имен и нарезка обучающих видео на кадры.
+
+Запуск инкрементальный: в манифесте (MANIFEST_PATH) для каждого исходного видео
+хранятся размер, mtime, хэш содержимого, параметры нарезки и список сохраненных
+кадров. Повторный запуск нарезает только новые или изменившиеся видео (и все - при
+смене параметров), а кадры видео, которых больше нет в RAW_VIDEO_DIR, удаляются.
+Хэш пересчитывается, только если изменились размер или mtime.
+"""
+import json
 import os
 import sys
 
+from data_processing import process_videos
+from frame_store import remove_prefix
+from hashing import file_hash
+from sanitize_filenames import sanitize_dir
+
 # --- КОНФИГУРАЦИЯ ---
 RAW_VIDEO_DIR = "/app/data/01_raw"
 PROCESSED_FRAMES_DIR = "/app/data/02_processed/frames"
+MANIFEST_PATH = "/app/data/02_processed/frames_manifest.json"
 FRAME_SKIP = 4 # Сохраняем каждый 4-й кадр
+WORKERS = os.cpu_count() or 1 # Видео нарезаются параллельно в пуле процессов
+# Отсев почти одинаковых кадров, например {'threshold': 0.02, 'pixel_delta': 12}; None - сохранять все кадры
+DEDUP = None
+# Упакованное хранилище кадров (см. frame_store.py) вместо отдельных JPEG, например "/app/data/02_processed/frame_store"
+STORE_DIR = None
+# Чтение видео через ffmpeg с уменьшением кадра в декодере (см. video_reader.py), например {'width': 1280}; None - OpenCV
+READER = None
 
 # Определяем видео, которое нужно ИСКЛЮЧИТЬ из обработки
 # Указываем его САНИРОВАННОЕ имя, так как этот этап идет после переименования
 TEST_VIDEO_SANITIZED_NAME = "nru_2025_06_16_12_49_50.mp4"
 
-os.makedirs(PROCESSED_FRAMES_DIR, exist_ok=True)
+MANIFEST_VERSION = 1
 
-print("--- Запуск Пайплайна Подготовки Данных ---")
 
-try:
-    # --- ЭТАП 1: Санитарная обработка имен ВСЕХ файлов ---
-    print(f"\n[ЭТАП 1/3] Запуск санитайзера для папки: {RAW_VIDEO_DIR}")
-    subprocess.run(["python3", "src/sanitize_filenames.py", "--input_dir", RAW_VIDEO_DIR], check=True)
-    print("[УСПЕХ] Имена файлов успешно санированы.")
+def load_manifest(path):
+    try:
+        with open(path) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return {'version': MANIFEST_VERSION, 'videos': {}}
+    if manifest.get('version') != MANIFEST_VERSION:
+        return {'version': MANIFEST_VERSION, 'videos': {}}
+    return manifest
 
-    # --- ЭТАП 2: Определение списка видео для обучения ---
-    print(f"\n[ЭТАП 2/3] Определение списка обучающих видео...")
-    all_videos = [f for f in os.listdir(RAW_VIDEO_DIR) if f.lower().endswith('.mp4')]
-    
-    if TEST_VIDEO_SANITIZED_NAME not in all_videos:
-        print(f"[ОШИБКА] Тестовое видео '{TEST_VIDEO_SANITIZED_NAME}' не найдено в папке {RAW_VIDEO_DIR}")
-        sys.exit(1)
 
-    train_videos = [v for v in all_videos if v != TEST_VIDEO_SANITIZED_NAME]
-    
-    print(f"-> Найдено видео для обучения: {len(train_videos)} шт.")
-    for video in train_videos:
-        print(f"  - {video}")
-    print(f"-> Видео для тестирования (пропущено): {TEST_VIDEO_SANITIZED_NAME}")
-
-    # --- ЭТАП 3: Поочередная нарезка ТОЛЬКО обучающих видео ---
-    print(f"\n[ЭТАП 3/3] Запуск нарезки кадров. Сохраняется каждый {FRAME_SKIP}-й кадр.")
-    for video_file in train_videos:
-        video_path = os.path.join(RAW_VIDEO_DIR, video_file)
-        subprocess.run([
-            "python3", "src/data_processing.py",
-            "--video_file", video_path,
-            "--output_dir", PROCESSED_FRAMES_DIR,
-            "--frame_skip", str(FRAME_SKIP)
-        ], check=True)
-    
-    print("\n--- Пайплайн Подготовки Данных Успешно Завершен! ---")
-    print(f"В папке {PROCESSED_FRAMES_DIR} теперь находятся кадры ТОЛЬКО из обучающих видео.")
-
-except subprocess.CalledProcessError as e:
-    print(f"\n[ОШИБКА] Один из этапов завершился с ошибкой: {e}", file=sys.stderr)
-    sys.exit(1)
-except FileNotFoundError as e:
-    print(f"\n[ОШИБКА] Файл не найден: {e}", file=sys.stderr)
-    sys.exit(1)
\ No newline at end of file
+def save_manifest(path, manifest):
+    # Запись через временный файл: прерванный запуск не оставит битый манифест
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=2, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+def source_state(video_path, previous=None):
+    """Размер, mtime и хэш видео. Хэш берется из previous, если размер и mtime не изменились."""
+    stat = os.stat(video_path)
+    state = {'size': stat.st_size, 'mtime': stat.st_mtime}
+    if previous and previous.get('size') == state['size'] and previous.get('mtime') == state['mtime']:
+        state['sha256'] = previous['sha256']
+    else:
+        state['sha256'] = file_hash(video_path)
+    return state
+
+
+def remove_outputs(entry, output_dir):
+    """Удаляет кадры, сохраненные для видео из манифеста. Возвращает число удаленных кадров."""
+    store_dir = entry.get('params', {}).get('store_dir')
+    if store_dir is not None:
+        remove_prefix(store_dir, entry['prefix'])
+        return len(entry.get('files', []))
+    removed = 0
+    for name in entry.get('files', []):
+        try:
+            os.remove(os.path.join(output_dir, name))
+            removed += 1
+        except FileNotFoundError:
+            pass
+    return removed
+
+
+# Пул процессов нарезки импортирует этот модуль заново (spawn/forkserver) - пайплайн запускается только из __main__
+if __name__ == '__main__':
+    os.makedirs(PROCESSED_FRAMES_DIR, exist_ok=True)
+
+    print("--- Запуск Пайплайна Подготовки Данных ---")
+
+    try:
+        # --- ЭТАП 1: Санитарная обработка имен ВСЕХ файлов ---
+        print(f"\n[ЭТАП 1/3] Запуск санитайзера для папки: {RAW_VIDEO_DIR}")
+        if not os.path.isdir(RAW_VIDEO_DIR):
+            print(f"[ОШИБКА] Директория не найдена: {RAW_VIDEO_DIR}", file=sys.stderr)
+            sys.exit(1)
+        sanitize_dir(RAW_VIDEO_DIR)
+        print("[УСПЕХ] Имена файлов успешно санированы.")
+
+        # --- ЭТАП 2: Определение списка видео для обучения ---
+        print(f"\n[ЭТАП 2/3] Определение списка обучающих видео...")
+        all_videos = [f for f in os.listdir(RAW_VIDEO_DIR) if f.lower().endswith('.mp4')]
+
+        if TEST_VIDEO_SANITIZED_NAME not in all_videos:
+            print(f"[ОШИБКА] Тестовое видео '{TEST_VIDEO_SANITIZED_NAME}' не найдено в папке {RAW_VIDEO_DIR}")
+            sys.exit(1)
+
+        train_videos = sorted(v for v in all_videos if v != TEST_VIDEO_SANITIZED_NAME)
+
+        print(f"-> Найдено видео для обучения: {len(train_videos)} шт.")
+        for video in train_videos:
+            print(f"  - {video}")
+        print(f"-> Видео для тестирования (пропущено): {TEST_VIDEO_SANITIZED_NAME}")
+
+        # --- ЭТАП 3: Нарезка только новых и изменившихся обучающих видео ---
+        print(f"\n[ЭТАП 3/3] Запуск нарезки кадров. Сохраняется каждый {FRAME_SKIP}-й кадр.")
+        params = {'frame_skip': FRAME_SKIP, 'dedup': DEDUP, 'store_dir': STORE_DIR, 'reader': READER}
+        manifest = load_manifest(MANIFEST_PATH)
+        videos = manifest['videos']
+
+        # Кадры видео, которых больше нет среди обучающих, удаляются вместе с записью манифеста
+        for name in sorted(set(videos) - set(train_videos)):
+            removed = remove_outputs(videos.pop(name), PROCESSED_FRAMES_DIR)
+            print(f"  - {name}: исходного видео больше нет, удалено кадров: {removed}")
+
+        pending, states = [], {}
+        for name in train_videos:
+            entry = videos.get(name)
+            states[name] = source_state(os.path.join(RAW_VIDEO_DIR, name), entry)
+            # Параметры, которых не было в манифесте старой версии, считаются выключенными (None)
+            unchanged = (entry is not None and entry['sha256'] == states[name]['sha256']
+                         and dict(dict.fromkeys(params), **entry['params']) == params)
+            if unchanged:
+                # Файл мог быть скопирован заново с тем же содержимым - обновляем только mtime
+                entry.update(states[name])
+                continue
+            if entry is not None:
+                # Видео изменилось или изменились параметры: старые кадры больше не актуальны
+                remove_outputs(videos.pop(name), PROCESSED_FRAMES_DIR)
+            pending.append(name)
+        save_manifest(MANIFEST_PATH, manifest)
+
+        print(f"-> Без изменений: {len(train_videos) - len(pending)} видео, к нарезке: {len(pending)}")
+
+        def record(video_path, stats):
+            name = os.path.basename(video_path)
+            if not stats['frames']:
+                return  # видео не открылось - повторим при следующем запуске
+            videos[name] = dict(states[name], params=params, frames=stats['frames'], files=stats['files'],
+                                prefix=os.path.splitext(name)[0])
+            save_manifest(MANIFEST_PATH, manifest)
+
+        video_paths = [os.path.join(RAW_VIDEO_DIR, name) for name in pending]
+        process_videos(video_paths, PROCESSED_FRAMES_DIR, FRAME_SKIP, WORKERS, DEDUP, on_result=record,
+                       store_dir=STORE_DIR, reader=READER)
+
+        print("\n--- Пайплайн Подготовки Данных Успешно Завершен! ---")
+        print(f"В папке {STORE_DIR or PROCESSED_FRAMES_DIR} теперь находятся кадры ТОЛЬКО из обучающих видео.")
+
+    except OSError as e:
+        print(f"\n[ОШИБКА] Один из этапов завершился с ошибкой: {e}", file=sys.stderr)
+        sys.exit(1)
@@ -19,33 +19,39 @@ def sanitize_name(filename):
     
     return f"{sanitized_base}{sanitized_ext}"
 
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser(description="Универсальный санитайзер имен файлов в директории.")
-    parser.add_argument('--input_dir', required=True, type=str, help='Директория, в которой нужно переименовать файлы.')
-    args = parser.parse_args()
+def sanitize_dir(input_dir):
+    """Переименовывает файлы директории в безопасный формат. Возвращает число переименованных файлов."""
+    print(f"Сканирование директории для санитарной обработки: {input_dir}")
+    renamed = 0
 
-    if not os.path.isdir(args.input_dir):
-        print(f"[ОШИБКА] Директория не найдена: {args.input_dir}", file=sys.stderr)
-        sys.exit(1)
-
-    print(f"Сканирование директории для санитарной обработки: {args.input_dir}")
-    
     # Получаем список файлов ПЕРЕД переименованием
-    for filename in os.listdir(args.input_dir):
-        original_path = os.path.join(args.input_dir, filename)
-        
+    for filename in os.listdir(input_dir):
+        original_path = os.path.join(input_dir, filename)
+
         # Пропускаем папки, если они вдруг есть
         if os.path.isdir(original_path):
             continue
-            
+
         sanitized_filename = sanitize_name(filename)
-        
+
         if filename != sanitized_filename:
-            new_path = os.path.join(args.input_dir, sanitized_filename)
+            new_path = os.path.join(input_dir, sanitized_filename)
             try:
                 os.rename(original_path, new_path)
+                renamed += 1
                 print(f"  -> Переименовано: '{filename}' -> '{sanitized_filename}'")
             except OSError as e:
                 print(f"[ОШИБКА] не удалось переименовать '{filename}': {e}", file=sys.stderr)
-        
+    return renamed
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Универсальный санитайзер имен файлов в директории.")
+    parser.add_argument('--input_dir', required=True, type=str, help='Директория, в которой нужно переименовать файлы.')
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.input_dir):
+        print(f"[ОШИБКА] Директория не найдена: {args.input_dir}", file=sys.stderr)
+        sys.exit(1)
+
+    sanitize_dir(args.input_dir)
     print("\nСанитарная обработка имен файлов завершена!")
\ No newline at end of file
@@ -0,0 +1,88 @@
+# src/startup.py
+"""
+Состояние запуска сервера для /healthz и /readyz.
+
+HTTP-сервер поднимается сразу, а тяжелая часть запуска (импорт ultralytics/torch,
+загрузка модели, прогрев, старт конвейера) идет в фоне по фазам. Время каждой фазы
+попадает в отчет о запуске и в метрику wdd_startup_phase_seconds.
+"""
+import contextlib
+import threading
+import time
+
+from metrics import REGISTRY
+
+STARTUP_SECONDS = REGISTRY.gauge('wdd_startup_phase_seconds', 'Длительность фаз запуска сервера.')
+READY = REGISTRY.gauge('wdd_ready', '1, если модель загружена, прогрета и конвейер запущен.')
+
+
+class StartupState:
+    def __init__(self, started_at=None):
+        self.started_at = started_at if started_at is not None else time.perf_counter()
+        self.phases = {}  # {фаза: секунды} в порядке выполнения
+        self.current_phase = None
+        self.ready = False
+        self.error = None
+        self.pipeline = None
+        self.default_source_id = None
+        self._callbacks = []
+        self._lock = threading.Lock()
+        READY.set(0)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Замеряет фазу запуска: with startup.phase('model_load'): ..."""
+        self.current_phase = name
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - t0
+            with self._lock:
+                self.phases[name] = elapsed
+            STARTUP_SECONDS.set(round(elapsed, 4), phase=name)
+
+    def on_ready(self, callback):
+        """Вызывает callback(pipeline), когда конвейер запущен (сразу, если уже запущен)."""
+        with self._lock:
+            if not self.ready:
+                self._callbacks.append(callback)
+                return
+        callback(self.pipeline)
+
+    def set_ready(self, pipeline, default_source_id):
+        with self._lock:
+            self.pipeline = pipeline
+            self.default_source_id = default_source_id
+            self.ready = True
+            self.current_phase = None
+            callbacks, self._callbacks = self._callbacks, []
+        READY.set(1)
+        STARTUP_SECONDS.set(round(self.total_seconds(), 4), phase='total')
+        for callback in callbacks:
+            callback(pipeline)
+
+    def fail(self, error):
+        with self._lock:
+            self.error = str(error)
+
+    def total_seconds(self):
+        return time.perf_counter() - self.started_at
+
+    def report(self):
+        with self._lock:
+            phases = {name: round(seconds, 3) for name, seconds in self.phases.items()}
+            return {
+                'ready': self.ready,
+                'phase': self.current_phase,
+                'error': self.error,
+                'startup_seconds': phases,
+                'uptime_s': round(self.total_seconds(), 1),
+            }
+
+    def summary(self):
+        """Строка отчета о запуске для консоли."""
+        names = {'import': 'импорт', 'model_load': 'загрузка модели', 'warmup': 'прогрев',
+                 'pipeline_start': 'запуск источников'}
+        parts = [f"{names.get(name, name)} {seconds:.2f} с" for name, seconds in self.phases.items()]
+        return f"{', '.join(parts)}; всего {self.total_seconds():.2f} с с момента старта процесса"
@@ -0,0 +1,762 @@
+# src/stream_pipeline.py
+"""
+Многопоточный конвейер для стримингового сервера:
+захват кадров -> инференс -> отрисовка и кодирование в JPEG.
+
+Стадии работают в отдельных потоках и связаны ограниченными очередями,
+которые при переполнении выбрасывают самые старые элементы. Поэтому
+медленная стадия не тормозит остальные, а задержка не накапливается.
+
+Один конвейер обслуживает все источники: у каждого источника свои потоки
+захвата и кодирования, а инференс идет одним батчем по свежим кадрам всех
+источников. Результат публикуется через FrameBroadcaster, из которого
+читает любое число клиентов.
+
+С трекингом (tracking.DefectTracker) модель запускается только на каждом
+detect_interval-м кадре, а на промежуточных рамки продлеваются трекером.
+"""
+import math
+import os
+import queue
+import re
+import threading
+import time
+from collections import deque
+
+import cv2
+
+from clip_recorder import ClipRecorder
+from metrics import REGISTRY
+from motion_gate import ChangeGate
+from overlay import OverlayRenderer
+from roi import check_roi, crop, select_roi
+from tracking import DefectTracker
+from video_reader import FFmpegReader
+
+# Маркер конца потока (источник закончился или конвейер остановлен)
+END_OF_STREAM = object()
+
+# --- Метрики Prometheus (см. /metrics) ---
+STAGE_SECONDS = REGISTRY.histogram(
+    'wdd_stage_duration_seconds',
+    'Время стадий конвейера: capture, preprocess, inference, postprocess, plot, encode.')
+BATCH_SECONDS = REGISTRY.histogram('wdd_inference_batch_duration_seconds', 'Время одного батчевого инференса.')
+BATCH_SIZE = REGISTRY.histogram('wdd_inference_batch_size', 'Число кадров в батче инференса.',
+                                buckets=(1, 2, 3, 4, 6, 8, 12, 16))
+COUNTER_HELP = {
+    'frames_read': 'Прочитанные (декодированные) кадры.',
+    'frames_skipped': 'Кадры, пропущенные по frame_skip без декодирования.',
+    'frames_dropped': 'Устаревшие кадры, выброшенные из очередей конвейера.',
+    'frames_with_detections': 'Обработанные кадры, на которых есть детекции.',
+    'frames_not_rendered': 'Кадры, не отрисованные из-за отсутствия зрителей видео.',
+    'frames_gated': 'Кадры без изменений, для которых переиспользованы прошлые детекции.',
+    'frames_rate_limited': 'Кадры, не отрисованные из-за ограничения FPS стрима.',
+    'frames_tracked': 'Кадры без запуска модели, рамки для которых продлены трекером.',
+    'defect_events': 'Подтвержденные дефекты (одно событие на трек).',
+    'clips_written': 'Сохраненные клипы дефектов.',
+    'clips_truncated': 'Клипы дефектов, укороченные из-за отставания записи (ограничение памяти).',
+}
+
+
+def open_capture(source, reader=None):
+    """
+    Открывает источник видео: ID камеры (число), путь к файлу или URL потока.
+    reader - параметры FFmpegReader (словарь: width, fps, hwaccel...) для чтения через ffmpeg
+    с уменьшением кадра в декодере, None - cv2.VideoCapture.
+    """
+    if reader is not None:
+        return FFmpegReader(source, **reader)
+    try:
+        return cv2.VideoCapture(int(source))
+    except ValueError:
+        return cv2.VideoCapture(source)
+
+
+def parse_sources(values):
+    """
+    Разбирает список источников из командной строки в словарь {source_id: источник}.
+    Источник можно задать как "id=источник" (например, "line3=rtsp://..."),
+    иначе ему назначается ID вида cam0, cam1, ...
+    """
+    sources = {}
+    for i, value in enumerate(values):
+        match = re.match(r'^([A-Za-z0-9_-]+)=(.+)$', value)
+        source_id, source = (match.group(1), match.group(2)) if match else (f"cam{i}", value)
+        if source_id in sources:
+            raise ValueError(f"Повторяющийся ID источника: {source_id}")
+        sources[source_id] = source
+    return sources
+
+
+def put_latest(q, item):
+    """
+    Кладет элемент в ограниченную очередь. Если очередь заполнена,
+    выбрасывает самые старые элементы. Возвращает число выброшенных элементов.
+    """
+    dropped = 0
+    while True:
+        try:
+            q.put_nowait(item)
+            return dropped
+        except queue.Full:
+            try:
+                q.get_nowait()
+                dropped += 1
+            except queue.Empty:
+                pass
+
+
+class StageTimings:
+    """
+    Потокобезопасная скользящая статистика времени работы стадий и счетчики.
+    Если заданы labels, значения дублируются в метрики Prometheus с этими метками.
+    """
+
+    def __init__(self, window=120, labels=None):
+        self._lock = threading.Lock()
+        self._window = window
+        self._labels = labels
+        self._samples = {}
+        self._counters = {}
+
+    def observe(self, stage, seconds):
+        with self._lock:
+            samples = self._samples.get(stage)
+            if samples is None:
+                samples = self._samples[stage] = deque(maxlen=self._window)
+            samples.append(seconds)
+        if self._labels is not None:
+            STAGE_SECONDS.observe(seconds, stage=stage, **self._labels)
+
+    def incr(self, name, value=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+        if self._labels is not None:
+            REGISTRY.counter(f'wdd_{name}_total', COUNTER_HELP.get(name, name)).inc(value, **self._labels)
+
+    def snapshot(self):
+        """
+        Возвращает словарь со средним/максимальным временем каждой стадии (мс),
+        пропускной способностью стадии (к/с) и стадией, ограничивающей FPS.
+        """
+        with self._lock:
+            stages = {}
+            for stage, samples in self._samples.items():
+                if not samples:
+                    continue
+                avg = sum(samples) / len(samples)
+                stages[stage] = {
+                    'avg_ms': round(avg * 1000, 2),
+                    'max_ms': round(max(samples) * 1000, 2),
+                    'max_fps': round(1.0 / avg, 1) if avg > 0 else None,
+                }
+            counters = dict(self._counters)
+
+        bottleneck = max(stages, key=lambda s: stages[s]['avg_ms']) if stages else None
+        return {'stages': stages, 'counters': counters, 'bottleneck': bottleneck}
+
+
+def multipart_chunk(encoded_image):
+    """
+    Собирает кусок multipart/x-mixed-replace потока для одного JPEG-кадра.
+    encoded_image - результат cv2.imencode (numpy-буфер): его байты копируются
+    один раз, сразу в итоговый chunk. Возвращает (chunk, memoryview на JPEG внутри chunk).
+    """
+    data = memoryview(encoded_image).cast('B')
+    header = b'--frame\r\nContent-Type: image/jpeg\r\nContent-Length: %d\r\n\r\n' % data.nbytes
+    chunk = b''.join((header, data, b'\r\n'))
+    return chunk, memoryview(chunk)[len(header):len(header) + data.nbytes]
+
+
+def detection_record(source_id, frame_index, timestamp, result, offset=(0, 0)):
+    """
+    Компактная запись детекций одного кадра без отрисовки:
+    boxes - список [class_id, conf, x1, y1, x2, y2] в пикселях полного кадра
+    (offset - смещение ROI, на которой выполнялся инференс).
+    """
+    boxes = result.boxes
+    rows = []
+    if len(boxes) > 0:
+        classes = boxes.cls.cpu().numpy().astype(int).tolist()
+        confs = boxes.conf.cpu().numpy().round(3).tolist()
+        xyxy = boxes.xyxy.cpu().numpy() + (offset[0], offset[1], offset[0], offset[1])
+        rows = [[cls, conf] + box for cls, conf, box in zip(classes, confs, xyxy.round(1).tolist())]
+    return {'source_id': source_id, 'frame_index': frame_index, 'timestamp': round(timestamp, 3), 'boxes': rows}
+
+
+class FrameBroadcaster:
+    """
+    Хранит последний опубликованный пакет и раздает его подписчикам.
+    Каждый подписчик читает в своем темпе: медленный клиент просто
+    пропускает промежуточные пакеты и никого не задерживает.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._latest = None
+        self._seq = 0
+        self._closed = False
+        self._subscribers = 0
+
+    @property
+    def subscriber_count(self):
+        return self._subscribers
+
+    def publish(self, packet):
+        with self._cond:
+            self._latest = packet
+            self._seq += 1
+            self._cond.notify_all()
+
+    def close(self):
+        """Сообщает подписчикам, что новых пакетов больше не будет."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def latest(self):
+        with self._cond:
+            return self._latest
+
+    def subscribe(self, timeout=0.5):
+        """Генератор новых пакетов. Завершается после close()."""
+        with self._cond:
+            self._subscribers += 1
+            last_seq = self._seq if self._latest is None else self._seq - 1
+        try:
+            while True:
+                with self._cond:
+                    self._cond.wait_for(lambda: self._seq > last_seq or self._closed, timeout=timeout)
+                    if self._seq > last_seq:
+                        last_seq = self._seq
+                        packet = self._latest
+                    elif self._closed:
+                        return
+                    else:
+                        continue
+                yield packet
+        finally:
+            with self._cond:
+                self._subscribers -= 1
+
+
+class LatestFrameCapture:
+    """
+    Поток захвата: непрерывно читает источник и хранит только самый свежий кадр.
+    Кадры, которые потребитель не успел забрать, перезаписываются, поэтому
+    очередь внутри бэкенда захвата не растет. Пропускаемые по frame_skip кадры
+    только захватываются (grab) без декодирования.
+    frame_sink(frame_index, frame), если задан, получает каждый декодированный кадр
+    (например, кольцевой буфер ClipRecorder) и не должен блокироваться.
+    reader - параметры чтения через ffmpeg (см. open_capture).
+    """
+
+    def __init__(self, source, frame_skip=1, timings=None, loop_file=True, on_frame=None, frame_sink=None,
+                 reader=None):
+        self.source = source
+        self.reader = reader
+        self.frame_skip = max(1, frame_skip)
+        self.loop_file = loop_file
+        self.on_frame = on_frame
+        self.frame_sink = frame_sink
+        self.timings = timings or StageTimings()
+        self.finished = False
+        self.source_fps = None  # FPS источника: из метаданных или измеренный
+
+        self._cap = None
+        self._cond = threading.Condition()
+        self._frame = None
+        self._frame_index = 0
+        self._seq = 0
+        self._consumed_seq = 0
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Открывает источник и запускает поток захвата. Возвращает False, если источник не открылся."""
+        self._cap = open_capture(self.source, self.reader)
+        if not self._cap.isOpened():
+            return False
+        self._thread = threading.Thread(target=self._run, name=f"capture-{self.source}", daemon=True)
+        self._thread.start()
+        return True
+
+    def _run(self):
+        # Видеофайл читаем в темпе его собственного FPS, иначе он "проиграется" за секунды,
+        # и по окончании начинаем сначала: сервер общий и должен работать непрерывно.
+        # Камеры и сетевые потоки сами отдают кадры в реальном времени.
+        is_file = os.path.isfile(str(self.source))
+        nominal_fps = self._cap.get(cv2.CAP_PROP_FPS)
+        if nominal_fps and nominal_fps > 0:
+            self.source_fps = nominal_fps
+        frame_interval = 1.0 / self.source_fps if is_file and self.source_fps else 0.0
+        next_due = time.perf_counter()
+        last_arrival = None
+
+        frame_count = 0
+        rewound = False
+        try:
+            while not self._stop_event.is_set():
+                if frame_interval:
+                    delay = next_due - time.perf_counter()
+                    if delay > 0:
+                        time.sleep(delay)
+                    next_due += frame_interval
+
+                frame_count += 1
+                if frame_count % self.frame_skip != 0:
+                    ret, frame = self._cap.grab(), None
+                else:
+                    t0 = time.perf_counter()
+                    ret, frame = self._cap.read()
+                    if ret:
+                        self.timings.observe('capture', time.perf_counter() - t0)
+
+                if not ret:
+                    # Перематываем файл в начало, но только если после прошлой перемотки что-то прочиталось
+                    if is_file and self.loop_file and not rewound:
+                        self._cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+                        rewound = True
+                        continue
+                    break
+                rewound = False
+
+                if not nominal_fps or nominal_fps <= 0:
+                    # Источник не сообщает FPS - оцениваем по темпу поступления кадров
+                    now = time.perf_counter()
+                    if last_arrival is not None and now > last_arrival:
+                        instant_fps = 1.0 / (now - last_arrival)
+                        self.source_fps = instant_fps if self.source_fps is None else 0.9 * self.source_fps + 0.1 * instant_fps
+                    last_arrival = now
+
+                if frame is None:
+                    self.timings.incr('frames_skipped')
+                    continue
+                self.timings.incr('frames_read')
+                if self.frame_sink is not None:
+                    self.frame_sink(frame_count, frame)
+
+                with self._cond:
+                    if self._seq > self._consumed_seq:
+                        # Предыдущий кадр так никто и не забрал - он устарел
+                        self.timings.incr('frames_dropped')
+                    self._frame = frame
+                    self._frame_index = frame_count
+                    self._seq += 1
+                    self._cond.notify_all()
+                if self.on_frame is not None:
+                    self.on_frame()
+        finally:
+            self._cap.release()
+            with self._cond:
+                self.finished = True
+                self._cond.notify_all()
+            if self.on_frame is not None:
+                self.on_frame()
+
+    def get(self, last_seq, timeout=0.5):
+        """
+        Ждет кадр новее last_seq. Возвращает (seq, frame_index, frame)
+        или None по таймауту / после завершения источника.
+        """
+        with self._cond:
+            self._cond.wait_for(lambda: self._seq > last_seq or self.finished, timeout=timeout)
+            if self._seq <= last_seq:
+                return None
+            self._consumed_seq = self._seq
+            return self._seq, self._frame_index, self._frame
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join(timeout=2.0)
+
+
+class SourceStream:
+    """
+    Все, что относится к одному источнику: поток захвата, очередь и поток
+    отрисовки/кодирования, статистика и broadcaster. Отрисованный кадр
+    публикуется в self.broadcaster как пакет со словарем:
+    detections (см. detection_record), jpeg (memoryview) и готовый multipart chunk.
+    Отрисовка и кодирование выполняются, только пока есть зрители видео,
+    и не чаще stream_max_fps раз в секунду (0 - без ограничения).
+
+    frame_skip - целое число или "auto". В режиме "auto" шаг пропуска
+    подбирается по измеренной задержке инференса так, чтобы обработка
+    успевала за источником в реальном времени.
+
+    tracker - DefectTracker или None; detect_interval - модель запускается на каждом
+    detect_interval-м обработанном кадре, остальные кадры сопровождаются трекером.
+    clips - параметры ClipRecorder (словарь) или None: запись клипов вокруг дефектов
+    (клип начинается по событию трекера, поэтому нужен tracker).
+    """
+
+    def __init__(self, source_id, source, frame_skip=1, queue_size=2, on_frame=None, max_frame_skip=30,
+                 gate=None, names=None, jpeg_quality=80, stream_scale=1.0, stream_max_fps=0, roi=None,
+                 tracker=None, detect_interval=1, clips=None, reader=None):
+        self.source_id = source_id
+        self.source = source
+        self.roi = roi  # (x, y, w, h) или None - весь кадр
+        self._roi_checked = False
+        self.gate = gate  # ChangeGate или None
+        self.tracker = tracker
+        self.detect_interval = max(1, detect_interval) if tracker is not None else 1
+        self.last_record = None
+        self.last_detections = []  # сырые детекции последнего инференса (до трекера)
+        self._frames_since_detection = 0
+        self.renderer = OverlayRenderer(names or {}, scale=stream_scale)
+        self.encode_params = [cv2.IMWRITE_JPEG_QUALITY, int(jpeg_quality)]
+        self.min_render_interval = 1.0 / stream_max_fps if stream_max_fps > 0 else 0.0
+        self._last_render = 0.0
+        self.timings = StageTimings(labels={'source': source_id})
+        self.recorder = None
+        if clips is not None:
+            if tracker is None:
+                raise ValueError("Запись клипов начинается по подтвержденному дефекту и требует трекинга")
+            self.recorder = ClipRecorder(source_id, timings=self.timings, **clips)
+        self.capture = LatestFrameCapture(source, 1, self.timings, on_frame=on_frame,
+                                          frame_sink=self.recorder.add_frame if self.recorder else None,
+                                          reader=reader)
+        self.broadcaster = FrameBroadcaster()
+        self.last_seq = 0
+        self.max_frame_skip = max_frame_skip
+        self.adaptive_skip = False
+        self.set_frame_skip(frame_skip)
+
+        self._latency_ema = None
+        self._processed_times = deque(maxlen=60)
+
+        self._encode_queue = queue.Queue(maxsize=queue_size)
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if not self.capture.start():
+            return False
+        self._thread = threading.Thread(target=self._encode_loop, name=f"encode-{self.source_id}", daemon=True)
+        self._thread.start()
+        return True
+
+    def set_frame_skip(self, value):
+        """Задает шаг пропуска кадров: целое число >= 1 или "auto" для адаптивного режима."""
+        if value == 'auto':
+            self.adaptive_skip = True
+            return
+        if isinstance(value, (bool, float)):
+            # int() молча отбросил бы дробную часть (2.7 -> 2)
+            raise TypeError("frame_skip должен быть целым числом или 'auto'")
+        value = int(value)
+        if value < 1:
+            raise ValueError("frame_skip должен быть >= 1 или 'auto'")
+        self.adaptive_skip = False
+        self.capture.frame_skip = value
+
+    def record_inference(self, latency):
+        """Учитывает обработанный кадр и в режиме "auto" пересчитывает шаг пропуска."""
+        self._processed_times.append(time.perf_counter())
+        self.timings.observe('inference', latency)
+
+        self._latency_ema = latency if self._latency_ema is None else 0.8 * self._latency_ema + 0.2 * latency
+        source_fps = self.capture.source_fps
+        if self.adaptive_skip and source_fps:
+            # За время одного инференса источник выдает latency * fps кадров - их и пропускаем.
+            # С трекингом модель работает на каждом detect_interval-м кадре, и пропускать нужно меньше
+            target = math.ceil(self._latency_ema * source_fps / self.detect_interval)
+            self.capture.frame_skip = min(max(1, target), self.max_frame_skip)
+
+    def needs_detection(self):
+        """Нужно ли запускать модель на следующем кадре (всегда, если трекинг выключен)."""
+        if self.tracker is None or self.last_record is None:
+            return True
+        return self._frames_since_detection + 1 >= self.detect_interval
+
+    def apply_tracking(self, record, detections=None):
+        """
+        Пропускает запись через трекер: detections - сырые детекции кадра или None,
+        если модель на нем не запускалась (тогда рамки продлеваются по треку).
+        Рамки записи заменяются подтвержденными треками, новые события кладутся в record['events'].
+        """
+        if self.tracker is None:
+            return record
+        frame_index = record['frame_index']
+        if detections is None:
+            self._frames_since_detection += 1
+            self._processed_times.append(time.perf_counter())
+            self.timings.incr('frames_tracked')
+            record['boxes'] = self.tracker.predict(frame_index)
+            return record
+
+        self._frames_since_detection = 0
+        record['boxes'], events = self.tracker.update(frame_index, detections)
+        if events:
+            record['events'] = events
+            self.timings.incr('defect_events', len(events))
+            for event in events:
+                print(f"[{self.source_id}] Подтвержден дефект: трек {event['track_id']}, "
+                      f"класс {event['class_id']}, кадр {event['confirmed_frame']}")
+        return record
+
+    def processed_fps(self):
+        """Фактическая частота обработанных кадров по последним инференсам."""
+        times = list(self._processed_times)
+        if len(times) < 2 or times[-1] <= times[0]:
+            return None
+        return round((len(times) - 1) / (times[-1] - times[0]), 2)
+
+    def frame_skip_state(self):
+        source_fps = self.capture.source_fps
+        return {
+            'mode': 'auto' if self.adaptive_skip else 'fixed',
+            'frame_skip': self.capture.frame_skip,
+            'source_fps': round(source_fps, 2) if source_fps else None,
+            'processed_fps': self.processed_fps(),
+        }
+
+    def submit(self, record, frame):
+        """Передает кадр и его детекции на отрисовку, вытесняя неотрисованный старый."""
+        if self.recorder is not None:
+            self.recorder.observe(record)
+        if self.broadcaster.subscriber_count == 0:
+            # Видео никто не смотрит - не тратим CPU на отрисовку и imencode()
+            self.timings.incr('frames_not_rendered')
+            return
+        now = time.perf_counter()
+        if now - self._last_render < self.min_render_interval:
+            self.timings.incr('frames_rate_limited')
+            return
+        self._last_render = now
+        dropped = put_latest(self._encode_queue, (record, frame))
+        if dropped:
+            self.timings.incr('frames_dropped', dropped)
+
+    def finish(self):
+        put_latest(self._encode_queue, END_OF_STREAM)
+
+    def queue_depth(self):
+        return self._encode_queue.qsize()
+
+    def _encode_loop(self):
+        while not self._stop_event.is_set():
+            try:
+                item = self._encode_queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            if item is END_OF_STREAM:
+                break
+            record, frame = item
+
+            t0 = time.perf_counter()
+            annotated_frame = self.renderer.render(frame, record['boxes'])
+            t1 = time.perf_counter()
+            flag, encoded_image = cv2.imencode(".jpg", annotated_frame, self.encode_params)
+            t2 = time.perf_counter()
+            self.timings.observe('plot', t1 - t0)
+            self.timings.observe('encode', t2 - t1)
+            if not flag:
+                continue
+
+            # Chunk собирается один раз на кадр и отдается всем подписчикам как есть
+            chunk, jpeg = multipart_chunk(encoded_image)
+            self.broadcaster.publish({
+                'detections': record,
+                'jpeg': jpeg,
+                'chunk': chunk,
+            })
+        self.broadcaster.close()
+
+    def stop(self):
+        self._stop_event.set()
+        self.capture.stop()
+        if self._thread is not None:
+            self._thread.join(timeout=2.0)
+        if self.recorder is not None:
+            self.recorder.stop()
+        self.broadcaster.close()
+
+
+class DetectionPipeline:
+    """
+    Общий конвейер для нескольких источников. У каждого источника свой поток
+    захвата и свой поток отрисовки (SourceStream), а инференс выполняет один
+    поток: он собирает самые свежие кадры всех источников и прогоняет их
+    через модель одним батчем, так что веса загружены один раз.
+
+    Детекции каждого батча публикуются в self.detections как список записей
+    detection_record - без отрисовки, для интеграций, которым нужны только рамки.
+    """
+
+    def __init__(self, model, sources, frame_skip=1, conf=0.5, imgsz=640, queue_size=2, max_frame_skip=30,
+                 motion_gate=None, jpeg_quality=80, stream_scale=1.0, stream_max_fps=0, rois=None,
+                 tracking=None, detect_interval=1, clips=None, reader=None):
+        """
+        sources - словарь {source_id: источник} (см. parse_sources); frame_skip - число или "auto";
+        motion_gate - параметры ChangeGate (словарь) или None, чтобы прогонять через модель каждый кадр;
+        jpeg_quality, stream_scale, stream_max_fps - настройки превью-стрима (см. SourceStream);
+        rois - словарь ROI (см. roi.load_rois): кадр обрезается до ROI источника перед инференсом;
+        tracking - параметры DefectTracker (словарь) или None; detect_interval - шаг запуска модели при трекинге;
+        clips - параметры ClipRecorder (словарь с output_dir и др.) или None, чтобы не записывать клипы;
+        reader - параметры FFmpegReader (см. open_capture) или None, чтобы читать источники через OpenCV.
+        """
+        self.model = model
+        self.conf = conf
+        self.imgsz = imgsz
+        self.timings = StageTimings()
+        self.detections = FrameBroadcaster()
+        self._frame_ready = threading.Event()
+        self.streams = {
+            source_id: SourceStream(source_id, source, frame_skip, queue_size,
+                                    on_frame=self._frame_ready.set, max_frame_skip=max_frame_skip,
+                                    gate=ChangeGate(**motion_gate) if motion_gate is not None else None,
+                                    names=model.names, jpeg_quality=jpeg_quality,
+                                    stream_scale=stream_scale, stream_max_fps=stream_max_fps,
+                                    roi=select_roi(rois, source_id),
+                                    tracker=DefectTracker(**tracking) if tracking is not None else None,
+                                    detect_interval=detect_interval, clips=clips, reader=reader)
+            for source_id, source in sources.items()
+        }
+        self._stop_event = threading.Event()
+        self._thread = None
+
+        REGISTRY.gauge('wdd_queue_depth', 'Глубина очереди на отрисовку/кодирование.').set_callback(
+            lambda: [({'source': sid}, stream.queue_depth()) for sid, stream in self.streams.items()])
+        REGISTRY.gauge('wdd_connected_clients', 'Подключенные клиенты: зрители видео и подписчики /detections.').set_callback(
+            lambda: [({'source': sid, 'stream': 'video'}, stream.broadcaster.subscriber_count)
+                     for sid, stream in self.streams.items()]
+            + [({'source': 'all', 'stream': 'detections'}, self.detections.subscriber_count)])
+
+    def start(self):
+        """Запускает все источники и поток инференса. Возвращает список ID источников, которые не открылись."""
+        failed = [source_id for source_id, stream in self.streams.items() if not stream.start()]
+        for source_id in failed:
+            del self.streams[source_id]
+        if self.streams:
+            self._thread = threading.Thread(target=self._infer_loop, name="inference", daemon=True)
+            self._thread.start()
+        return failed
+
+    def _collect_batch(self):
+        """Забирает по одному новому кадру от каждого источника, у которого он есть."""
+        batch = []
+        for stream in self.streams.values():
+            item = stream.capture.get(stream.last_seq, timeout=0)
+            if item is not None:
+                stream.last_seq, frame_index, frame = item
+                if not stream._roi_checked:
+                    # Размер кадра источника известен только сейчас: ROI из конфига может не подходить к нему
+                    stream.roi = check_roi(stream.roi, frame.shape, stream.source_id)
+                    stream._roi_checked = True
+                # В модель (и в детектор изменений) идет только ROI источника
+                model_input, offset = crop(frame, stream.roi)
+                batch.append((stream, frame_index, frame, model_input, offset))
+        return batch
+
+    def _infer_loop(self):
+        active = list(self.streams.values())
+        while active and not self._stop_event.is_set():
+            self._frame_ready.wait(timeout=0.5)
+            self._frame_ready.clear()
+            batch = self._collect_batch()
+            if not batch:
+                for stream in [s for s in active if s.capture.finished]:
+                    stream.finish()
+                    active.remove(stream)
+                continue
+
+            # Между запусками детектора рамки продлевает трекер, кадры без заметных
+            # изменений тоже не идут в модель - для них берем прошлые детекции
+            to_infer, reused, tracked = [], [], []
+            for item in batch:
+                stream, _, _, model_input, _ = item
+                if not stream.needs_detection():
+                    tracked.append(item)
+                    continue
+                if stream.gate is None:
+                    to_infer.append(item)
+                    continue
+                t0 = time.perf_counter()
+                changed = stream.gate.check(model_input)
+                stream.timings.observe('motion_gate', time.perf_counter() - t0)
+                (to_infer if changed else reused).append(item)
+
+            timestamp = time.time()
+            records = []
+            if to_infer:
+                t0 = time.perf_counter()
+                results = self.model([item[3] for item in to_infer], imgsz=self.imgsz, conf=self.conf, verbose=False)
+                elapsed = time.perf_counter() - t0
+
+                self.timings.observe('inference_batch', elapsed)
+                self.timings.observe('inference_per_frame', elapsed / len(to_infer))
+                self.timings.incr('batches')
+                self.timings.incr('batched_frames', len(to_infer))
+                BATCH_SECONDS.observe(elapsed)
+                BATCH_SIZE.observe(len(to_infer))
+                for (stream, frame_index, frame, _, offset), result in zip(to_infer, results):
+                    # Для источника задержка инференса - это время всего батча
+                    stream.record_inference(elapsed)
+                    # Ultralytics сообщает время пред- и постобработки на изображение в мс
+                    for stage in ('preprocess', 'postprocess'):
+                        stream.timings.observe(stage, result.speed[stage] / 1000)
+                    if len(result.boxes) > 0:
+                        stream.timings.incr('frames_with_detections')
+                    record = detection_record(stream.source_id, frame_index, timestamp, result, offset)
+                    stream.last_detections = record['boxes']
+                    record = stream.apply_tracking(record, stream.last_detections)
+                    stream.last_record = record
+                    records.append(record)
+                    stream.submit(record, frame)
+
+            for stream, frame_index, frame, _, _ in reused:
+                stream.timings.incr('frames_gated')
+                record = dict(stream.last_record, frame_index=frame_index, timestamp=round(timestamp, 3), reused=True)
+                record.pop('events', None)
+                # Повторная подача прошлых детекций засчитала бы трекам лишние совпадения
+                # (подтверждение без новых детекций) - треки только продлеваются, как на кадрах между запусками
+                record = stream.apply_tracking(record)
+                records.append(record)
+                stream.submit(record, frame)
+
+            for stream, frame_index, frame, _, _ in tracked:
+                t0 = time.perf_counter()
+                record = {'source_id': stream.source_id, 'frame_index': frame_index,
+                          'timestamp': round(timestamp, 3), 'tracked': True}
+                record = stream.apply_tracking(record)
+                stream.timings.observe('tracking', time.perf_counter() - t0)
+                records.append(record)
+                stream.submit(record, frame)
+            self.detections.publish(records)
+
+        for stream in active:
+            stream.finish()
+        self.detections.close()
+
+    def snapshot(self):
+        """Статистика инференса (батчи) и всех источников."""
+        engine = self.timings.snapshot()
+        counters = engine['counters']
+        engine['avg_batch_size'] = round(counters['batched_frames'] / counters['batches'], 2) if counters.get('batches') else None
+        sources = {}
+        for source_id, stream in self.streams.items():
+            snapshot = stream.timings.snapshot()
+            snapshot['source'] = stream.source
+            snapshot['subscribers'] = stream.broadcaster.subscriber_count
+            snapshot['frame_skip'] = stream.frame_skip_state()
+            if stream.gate is not None:
+                snapshot['motion_gate'] = stream.gate.state()
+            if stream.roi is not None:
+                snapshot['roi'] = list(stream.roi)
+            if stream.tracker is not None:
+                snapshot['tracking'] = dict(stream.tracker.state(), detect_interval=stream.detect_interval)
+            if stream.recorder is not None:
+                snapshot['clips'] = stream.recorder.state()
+            sources[source_id] = snapshot
+        return {'inference': engine, 'sources': sources, 'detection_subscribers': self.detections.subscriber_count}
+
+    def stop(self):
+        self._stop_event.set()
+        self._frame_ready.set()
+        if self._thread is not None:
+            self._thread.join(timeout=2.0)
+        for stream in self.streams.values():
+            stream.stop()
+        self.detections.close()
@@ -0,0 +1,176 @@
+# src/tracking.py
+"""
+Временное сопровождение дефектов между кадрами.
+
+Трекер в духе ByteTrack, но без внешних зависимостей: детекции сопоставляются
+с треками по IoU в два прохода (сначала уверенные, затем слабые детекции),
+между запусками детектора рамки продлеваются по постоянной скорости.
+Трек считается подтвержденным после confirm_hits совпадений - в этот момент
+один раз генерируется событие, поэтому на один физический дефект приходится
+одно событие, а надпись тревоги не мигает.
+
+Рамки передаются строками [class_id, conf, x1, y1, x2, y2] (как в detection_record),
+трекер возвращает строки [class_id, conf, x1, y1, x2, y2, track_id].
+"""
+import time
+
+import numpy as np
+
+
+def iou(a, b):
+    """IoU двух рамок (x1, y1, x2, y2)."""
+    ix1, iy1 = max(a[0], b[0]), max(a[1], b[1])
+    ix2, iy2 = min(a[2], b[2]), min(a[3], b[3])
+    inter = max(0.0, ix2 - ix1) * max(0.0, iy2 - iy1)
+    if inter <= 0:
+        return 0.0
+    area_a = (a[2] - a[0]) * (a[3] - a[1])
+    area_b = (b[2] - b[0]) * (b[3] - b[1])
+    return inter / (area_a + area_b - inter)
+
+
+class Track:
+    def __init__(self, track_id, class_id, conf, box, frame_index):
+        self.track_id = track_id
+        self.class_id = class_id
+        self.conf = conf
+        self.box = list(box)
+        self.velocity = [0.0, 0.0, 0.0, 0.0]  # изменение координат рамки за кадр
+        self.hits = 1
+        self.missed = 0
+        self.confirmed = False
+        self.first_frame = frame_index
+        self.last_frame = frame_index
+
+    def predicted_box(self, frame_index):
+        dt = frame_index - self.last_frame
+        return [c + v * dt for c, v in zip(self.box, self.velocity)]
+
+    def update(self, class_id, conf, box, frame_index):
+        dt = frame_index - self.last_frame
+        if dt > 0:
+            measured = [(new - old) / dt for new, old in zip(box, self.box)]
+            # Сглаживаем скорость, чтобы одна неточная рамка не уводила трек
+            self.velocity = [0.6 * v + 0.4 * m for v, m in zip(self.velocity, measured)]
+        self.class_id = class_id
+        self.conf = conf
+        self.box = list(box)
+        self.hits += 1
+        self.missed = 0
+        self.last_frame = frame_index
+
+    def row(self, frame_index):
+        box = [round(c, 1) for c in self.predicted_box(frame_index)]
+        return [self.class_id, round(self.conf, 3)] + box + [self.track_id]
+
+
+class DefectTracker:
+    """
+    iou_threshold  - минимальный IoU для сопоставления детекции с треком;
+    high_conf      - граница уверенных детекций (первый проход сопоставления);
+    confirm_hits   - число совпадений, после которого трек подтвержден и выдается событие;
+    max_missed     - сколько запусков детектора подряд трек может не находиться, прежде чем удалиться.
+    """
+
+    def __init__(self, iou_threshold=0.3, high_conf=0.5, confirm_hits=3, max_missed=3):
+        self.iou_threshold = iou_threshold
+        self.high_conf = high_conf
+        self.confirm_hits = confirm_hits
+        self.max_missed = max_missed
+        self.tracks = []
+        self.events_total = 0
+        self._next_id = 1
+
+    def _match(self, tracks, detections, frame_index):
+        """Жадное сопоставление по убыванию IoU (с учетом класса). Возвращает пары и несопоставленное."""
+        candidates = []
+        for ti, track in enumerate(tracks):
+            predicted = track.predicted_box(frame_index)
+            for di, det in enumerate(detections):
+                if det[0] != track.class_id:
+                    continue
+                overlap = iou(predicted, det[2:6])
+                if overlap >= self.iou_threshold:
+                    candidates.append((overlap, ti, di))
+        candidates.sort(reverse=True)
+
+        matched_tracks, matched_dets, pairs = set(), set(), []
+        for _, ti, di in candidates:
+            if ti in matched_tracks or di in matched_dets:
+                continue
+            matched_tracks.add(ti)
+            matched_dets.add(di)
+            pairs.append((tracks[ti], detections[di]))
+        unmatched_tracks = [t for i, t in enumerate(tracks) if i not in matched_tracks]
+        unmatched_dets = [d for i, d in enumerate(detections) if i not in matched_dets]
+        return pairs, unmatched_tracks, unmatched_dets
+
+    def update(self, frame_index, detections):
+        """
+        Обновляет треки детекциями кадра frame_index.
+        Возвращает (строки подтвержденных треков, список новых событий).
+        """
+        high = [d for d in detections if d[1] >= self.high_conf]
+        low = [d for d in detections if d[1] < self.high_conf]
+
+        pairs, unmatched_tracks, unmatched_high = self._match(self.tracks, high, frame_index)
+        # Второй проход: слабые детекции продлевают только уже существующие треки
+        low_pairs, unmatched_tracks, _ = self._match(unmatched_tracks, low, frame_index)
+
+        events = []
+        for track, det in pairs + low_pairs:
+            track.update(det[0], det[1], det[2:6], frame_index)
+            self._maybe_confirm(track, frame_index, events)
+        for track in unmatched_tracks:
+            track.missed += 1
+        self.tracks = [t for t in self.tracks if t.missed <= self.max_missed]
+
+        # Новые треки заводятся только по уверенным детекциям
+        for det in unmatched_high:
+            track = Track(self._next_id, det[0], det[1], det[2:6], frame_index)
+            self._next_id += 1
+            self._maybe_confirm(track, frame_index, events)
+            self.tracks.append(track)
+
+        return self.predict(frame_index), events
+
+    def _maybe_confirm(self, track, frame_index, events):
+        """Подтверждает трек, набравший confirm_hits совпадений, и один раз добавляет событие."""
+        if track.confirmed or track.hits < self.confirm_hits:
+            return
+        track.confirmed = True
+        self.events_total += 1
+        events.append({
+            'track_id': track.track_id,
+            'class_id': track.class_id,
+            'conf': round(track.conf, 3),
+            'box': [round(c, 1) for c in track.box],
+            'first_frame': track.first_frame,
+            'confirmed_frame': frame_index,
+            'timestamp': round(time.time(), 3),
+        })
+
+    def predict(self, frame_index):
+        """Рамки подтвержденных треков, продленные на кадр frame_index (без запуска детектора)."""
+        return [t.row(frame_index) for t in self.tracks if t.confirmed]
+
+    def state(self):
+        return {
+            'active_tracks': len(self.tracks),
+            'confirmed_tracks': sum(1 for t in self.tracks if t.confirmed),
+            'events_total': self.events_total,
+        }
+
+
+def tracks_to_result(frame, rows, names):
+    """
+    Results Ultralytics из строк трекера, чтобы рисовать их через result.plot():
+    рамки получают подпись с ID трека.
+    """
+    import torch
+    from ultralytics.engine.results import Results
+
+    data = np.zeros((len(rows), 7), dtype=np.float32)
+    for i, (class_id, conf, x1, y1, x2, y2, track_id) in enumerate(rows):
+        data[i] = (x1, y1, x2, y2, track_id, conf, class_id)
+    return Results(frame, path='', names=names, boxes=torch.from_numpy(data))
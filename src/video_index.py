@@ -0,0 +1,243 @@
+# src/video_index.py
+"""
+Индекс ключевых кадров исходных видео и "виртуальные" наборы кадров.
+
+Вместо нарезки видео в JPEG кадр задается ссылкой (видео, номер кадра). Индекс
+хранит для каждого видео из data/01_raw число кадров, FPS, размер и номера/время
+ключевых кадров - их находит проход по сжатому потоку без декодирования.
+Кадр N читается перемоткой к ближайшему ключевому кадру перед ним и
+декодированием вперед; при чтении ссылок по возрастанию внутри одного видео
+перемотка нужна, только если до нужного кадра встречается новый ключевой кадр.
+
+В JPEG сохраняются (materialize) только кадры, отобранные для разметки.
+Набор ссылок хранится в CSV со столбцами video,frame_idx.
+"""
+import argparse
+import bisect
+import csv
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import cv2
+from tqdm import tqdm
+
+from data_processing import VIDEO_EXTENSIONS
+
+INDEX_VERSION = 1
+
+
+def build_entry(video_path):
+    """Сканирует видео без декодирования и возвращает запись индекса (None, если видео не открылось)."""
+    stat = os.stat(video_path)
+    cap = cv2.VideoCapture(str(video_path), cv2.CAP_FFMPEG)
+    if not cap.isOpened():
+        return None
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+    height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    # Сырые пакеты вместо декодированных кадров: grab() только читает поток
+    cap.set(cv2.CAP_PROP_FORMAT, -1)
+
+    keyframes, keyframe_ms = [], []
+    frame_count = 0
+    while cap.grab():
+        if cap.get(cv2.CAP_PROP_LRF_HAS_KEY_FRAME):
+            keyframes.append(frame_count)
+            keyframe_ms.append(round(cap.get(cv2.CAP_PROP_POS_MSEC), 3))
+        frame_count += 1
+    cap.release()
+
+    if not keyframes or keyframes[0] != 0:
+        # Бэкенд не сообщает о ключевых кадрах - читаем от начала видео
+        keyframes.insert(0, 0)
+        keyframe_ms.insert(0, 0.0)
+    return {
+        'size': stat.st_size, 'mtime': stat.st_mtime, 'fps': fps, 'width': width, 'height': height,
+        'frame_count': frame_count, 'keyframes': keyframes, 'keyframe_ms': keyframe_ms,
+    }
+
+
+def load_index(index_path):
+    try:
+        with open(index_path) as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return index if index.get('version') == INDEX_VERSION else None
+
+
+def update_index(video_dir, index_path, workers=None):
+    """
+    Строит или обновляет индекс видео папки video_dir: пересканируются только новые
+    видео и видео с другим размером или mtime, записи удаленных видео убираются.
+    """
+    video_dir = Path(video_dir)
+    index = load_index(index_path) or {}
+    previous = index.get('videos', {}) if index.get('video_dir') == str(video_dir.resolve()) else {}
+
+    names = sorted(f for f in os.listdir(video_dir) if f.lower().endswith(VIDEO_EXTENSIONS))
+    videos, pending = {}, []
+    for name in names:
+        stat = os.stat(video_dir / name)
+        entry = previous.get(name)
+        if entry is not None and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime:
+            videos[name] = entry
+        else:
+            pending.append(name)
+
+    print(f"Видео: {len(names)}, в индексе без изменений: {len(videos)}, к сканированию: {len(pending)}")
+    if pending:
+        workers = max(1, min(workers or os.cpu_count() or 1, len(pending)))
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            entries = pool.map(build_entry, [str(video_dir / name) for name in pending])
+            for name, entry in tqdm(zip(pending, entries), total=len(pending), desc="Индексация видео"):
+                if entry is None:
+                    print(f"Предупреждение: Не удалось открыть видеофайл: {name}")
+                    continue
+                videos[name] = entry
+
+    index = {'version': INDEX_VERSION, 'video_dir': str(video_dir.resolve()), 'videos': videos}
+    tmp_path = str(index_path) + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(index, f, ensure_ascii=False)
+    os.replace(tmp_path, index_path)
+    return index
+
+
+def frame_name(video, frame_idx):
+    """Имя файла для кадра видео (без расширения): <имя видео>_vframe_<номер кадра>."""
+    return f"{os.path.splitext(video)[0]}_vframe_{frame_idx:06d}"
+
+
+def read_refs(path):
+    """Читает CSV со ссылками на кадры (столбцы video,frame_idx)."""
+    with open(path, newline='') as f:
+        return [(row['video'], int(row['frame_idx'])) for row in csv.DictReader(f)]
+
+
+def write_refs(path, refs):
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['video', 'frame_idx'])
+        writer.writerows(refs)
+
+
+class VideoFrameReader:
+    """Чтение кадров одного видео по номеру: перемотка к ключевому кадру и декодирование вперед."""
+
+    def __init__(self, video_path, entry):
+        self.cap = cv2.VideoCapture(str(video_path))
+        if not self.cap.isOpened():
+            raise OSError(f"Не удалось открыть видеофайл: {video_path}")
+        self.keyframes = entry['keyframes']
+        self.frame_count = entry['frame_count']
+        self.position = 0  # номер кадра, который вернет следующий grab()
+        self.seeks = 0
+        self.grabs = 0
+
+    def read(self, frame_idx):
+        if not 0 <= frame_idx < self.frame_count:
+            raise IndexError(f"Кадра {frame_idx} нет в видео ({self.frame_count} кадров)")
+        keyframe = self.keyframes[bisect.bisect_right(self.keyframes, frame_idx) - 1]
+        # Вперед до кадра без перемотки - только если по пути нет более близкого ключевого кадра
+        if not keyframe <= self.position <= frame_idx:
+            self.cap.set(cv2.CAP_PROP_POS_FRAMES, keyframe)
+            self.position = keyframe
+            self.seeks += 1
+        while self.position <= frame_idx:
+            if not self.cap.grab():
+                raise OSError(f"Видео закончилось раньше кадра {frame_idx}")
+            self.position += 1
+            self.grabs += 1
+        ret, frame = self.cap.retrieve()
+        if not ret:
+            raise OSError(f"Не удалось декодировать кадр {frame_idx}")
+        return frame
+
+    def release(self):
+        self.cap.release()
+
+
+def iter_frames(refs, index, video_dir=None):
+    """
+    Выдает (video, frame_idx, кадр) для ссылок refs, сгруппировав их по видео и упорядочив
+    по номеру кадра (так перемоток меньше всего). video_dir по умолчанию - папка из индекса.
+    """
+    video_dir = Path(video_dir or index['video_dir'])
+    by_video = {}
+    for video, frame_idx in refs:
+        by_video.setdefault(video, set()).add(frame_idx)
+    for video in sorted(by_video):
+        entry = index['videos'].get(video)
+        if entry is None:
+            print(f"Предупреждение: видео {video} нет в индексе, его кадры пропущены")
+            continue
+        reader = VideoFrameReader(video_dir / video, entry)
+        try:
+            for frame_idx in sorted(by_video[video]):
+                yield video, frame_idx, reader.read(frame_idx)
+        finally:
+            reader.release()
+
+
+def sample_refs(index, step, videos=None):
+    """Виртуальный аналог нарезки с --frame_skip: каждый step-й кадр каждого видео индекса."""
+    refs = []
+    for video, entry in sorted(index['videos'].items()):
+        if videos is None or video in videos:
+            refs.extend((video, frame_idx) for frame_idx in range(0, entry['frame_count'], step))
+    return refs
+
+
+def materialize(refs, index, output_dir, video_dir=None):
+    """Сохраняет кадры по ссылкам в JPEG (<видео>_vframe_<номер>.jpg). Возвращает число кадров."""
+    os.makedirs(output_dir, exist_ok=True)
+    count = 0
+    for video, frame_idx, frame in tqdm(iter_frames(refs, index, video_dir), total=len(refs), desc="Сохранение кадров"):
+        cv2.imwrite(os.path.join(output_dir, frame_name(video, frame_idx) + '.jpg'), frame)
+        count += 1
+    return count
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Индекс ключевых кадров видео и виртуальные наборы кадров.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    build_parser = subparsers.add_parser('build', help='Построить или обновить индекс видео папки.')
+    build_parser.add_argument('--video_dir', required=True, type=str, help='Папка с исходными видео.')
+    build_parser.add_argument('--index', required=True, type=str, help='Путь к файлу индекса (JSON).')
+    build_parser.add_argument('--workers', type=int, default=None, help='Число процессов для сканирования видео.')
+
+    sample_parser = subparsers.add_parser('sample', help='Составить набор ссылок: каждый N-й кадр видео.')
+    sample_parser.add_argument('--index', required=True, type=str, help='Путь к файлу индекса (JSON).')
+    sample_parser.add_argument('--frame_skip', type=int, default=4, help='Брать каждый N-ный кадр.')
+    sample_parser.add_argument('--videos', type=str, nargs='+', help='Только эти видео (по умолчанию - все).')
+    sample_parser.add_argument('--output', required=True, type=str, help='CSV со ссылками video,frame_idx.')
+
+    materialize_parser = subparsers.add_parser('materialize', help='Сохранить кадры по ссылкам в JPEG.')
+    materialize_parser.add_argument('--index', required=True, type=str, help='Путь к файлу индекса (JSON).')
+    materialize_parser.add_argument('--refs', required=True, type=str, help='CSV со ссылками video,frame_idx.')
+    materialize_parser.add_argument('--output_dir', required=True, type=str, help='Папка для JPEG.')
+    materialize_parser.add_argument('--video_dir', type=str, help='Папка с видео, если она не та, что при индексации.')
+
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        index = update_index(args.video_dir, args.index, args.workers)
+        keyframes = sum(len(entry['keyframes']) for entry in index['videos'].values())
+        frames = sum(entry['frame_count'] for entry in index['videos'].values())
+        print(f"Индекс сохранен: {args.index} ({len(index['videos'])} видео, {frames} кадров, "
+              f"{keyframes} ключевых кадров)")
+    else:
+        index = load_index(args.index)
+        if index is None:
+            parser.error(f"индекс не найден или устарел: {args.index} (см. команду build)")
+        if args.command == 'sample':
+            refs = sample_refs(index, args.frame_skip, set(args.videos) if args.videos else None)
+            write_refs(args.output, refs)
+            print(f"Ссылок на кадры: {len(refs)}, сохранены в {args.output}")
+        else:
+            count = materialize(read_refs(args.refs), index, args.output_dir, args.video_dir)
+            print(f"Сохранено кадров: {count} в {args.output_dir}")
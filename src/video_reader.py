@@ -0,0 +1,277 @@
+# src/video_reader.py
+"""
+Чтение видео через ffmpeg: декодер сам уменьшает кадр, переводит его в нужный
+формат пикселей и прореживает кадры, а в Python приходят уже готовые сырые кадры.
+
+cv2.VideoCapture всегда декодирует кадр в полном разрешении камеры и переводит в BGR,
+после чего модель сразу сжимает его до 640. FFmpegReader запускает ffmpeg
+подпроцессом (-f rawvideo в pipe) с фильтрами select/fps/scale, а кадры читает
+из pipe напрямую в заранее выделенные массивы NumPy (readinto, без лишних копий).
+
+Интерфейс повторяет нужную часть cv2.VideoCapture (isOpened, read, grab,
+retrieve, get, set, release), поэтому его можно подставить вместо OpenCV.
+"""
+import re
+import shutil
+import subprocess
+import threading
+from collections import deque
+
+import cv2
+import numpy as np
+
+READERS = ('opencv', 'ffmpeg')
+
+# Сколько ждать описания потоков от ffmpeg (подключение к RTSP может быть долгим), с
+HEADER_TIMEOUT = 30.0
+# Сколько последних строк stderr ffmpeg хранить для сообщений об ошибках
+STDERR_LINES = 50
+
+_CHANNELS = {'bgr24': 3, 'rgb24': 3, 'gray': 1}
+# Строки описания потоков: "Stream #0:0: Video: h264 ..., yuv420p, 1920x1080 [SAR 1:1], 25 fps, 25 tbr, ..."
+_SIZE = re.compile(r', (\d+)x(\d+)')
+_FPS = re.compile(r', ([\d.]+) (?:fps|tbr)')
+_DURATION = re.compile(r'Duration: (\d+):(\d+):([\d.]+)')
+
+
+def _even(value):
+    return max(2, int(round(value / 2.0)) * 2)
+
+
+class FFmpegReader:
+    """
+    source     - путь к файлу, URL потока или номер камеры (Linux: /dev/videoN);
+    width      - ширина кадра на выходе декодера (высота - с сохранением пропорций), None - исходный размер;
+    fps        - прореживание до заданного FPS (фильтр fps), None - без прореживания;
+    every_nth  - оставлять только каждый N-й кадр (фильтр select), например вместо --frame_skip;
+    pix_fmt    - формат кадров: bgr24 (как OpenCV), rgb24 или gray;
+    buffers    - число заранее выделенных кадров, по кругу переиспользуемых read():
+                 кадр, полученный из read(), действителен, пока не прочитаны следующие buffers кадров.
+                 0 - новый массив на каждый кадр (для потребителей, которые хранят кадры в очередях);
+    hwaccel    - аппаратное декодирование ffmpeg (cuda, vaapi, qsv, auto), None - программное.
+
+    Источник открывает только сам ffmpeg: размер, FPS и длительность берутся из описания
+    потоков, которое он печатает в stderr при запуске (камеру или RTSP нельзя открыть
+    второй раз ради свойств). stderr читается отдельным потоком, иначе на долгом потоке
+    предупреждения ffmpeg заполнили бы pipe и он бы остановился.
+    """
+
+    def __init__(self, source, width=None, fps=None, every_nth=None, pix_fmt='bgr24', buffers=0, hwaccel=None,
+                 ffmpeg_bin='ffmpeg', open_timeout=HEADER_TIMEOUT):
+        if pix_fmt not in _CHANNELS:
+            raise ValueError(f"Неподдерживаемый pix_fmt: {pix_fmt} (доступны: {', '.join(_CHANNELS)})")
+        self.source = source
+        self.target_width = _even(width) if width else None
+        self.fps = fps
+        self.every_nth = max(1, int(every_nth or 1))
+        self.pix_fmt = pix_fmt
+        self.hwaccel = hwaccel
+        self.ffmpeg_bin = ffmpeg_bin
+        self.open_timeout = open_timeout
+        self.error = None
+        self.width = self.height = None
+        self.source_width = self.source_height = 0
+        self.source_fps = 0.0
+        self.source_frame_count = 0
+        self.log = deque(maxlen=STDERR_LINES)  # последние строки stderr ffmpeg
+        self._proc = None
+        self._stderr_thread = None
+        self._duration = 0.0
+        self._position = 0  # число прочитанных кадров на выходе декодера
+        self._start_seconds = 0.0
+        self._grabbed = None
+        self._buffers = []
+        self._next_buffer = 0
+
+        if not ffmpeg_available(ffmpeg_bin):
+            self.error = f"{ffmpeg_bin} не найден в PATH"
+            return
+        if not self._start():
+            return
+        channels = _CHANNELS[pix_fmt]
+        self._shape = (self.height, self.width, channels) if channels > 1 else (self.height, self.width)
+        self.frame_bytes = int(np.prod(self._shape))
+        self._buffers = [np.empty(self._shape, dtype=np.uint8) for _ in range(buffers)]
+
+    @property
+    def output_fps(self):
+        if self.fps:
+            return float(self.fps)
+        return self.source_fps / self.every_nth if self.source_fps else 0.0
+
+    def command(self):
+        """Команда запуска ffmpeg (полезно для отладки)."""
+        # Уровень info нужен ради описания потоков; -nostats отключает строки прогресса
+        cmd = [self.ffmpeg_bin, '-nostdin', '-hide_banner', '-nostats', '-loglevel', 'info']
+        if self.hwaccel:
+            cmd += ['-hwaccel', self.hwaccel]
+        source = str(self.source)
+        if source.isdigit():
+            cmd += ['-f', 'v4l2']
+            source = f"/dev/video{source}"
+        elif source.startswith('rtsp://'):
+            cmd += ['-rtsp_transport', 'tcp']
+        if self._start_seconds > 0:
+            cmd += ['-ss', f"{self._start_seconds:.6f}"]
+        cmd += ['-i', source, '-an', '-sn']
+
+        filters = []
+        if self.every_nth > 1:
+            filters.append(f"select='not(mod(n\\,{self.every_nth}))'")
+        if self.fps:
+            filters.append(f"fps={self.fps}")
+        if self.target_width:
+            # -2: высота с сохранением пропорций, кратная 2; area - то же усреднение, что INTER_AREA в OpenCV
+            filters.append(f"scale={self.target_width}:-2:flags=area")
+        if filters:
+            cmd += ['-vf', ','.join(filters)]
+        # Без дублирования и выбрасывания кадров: после select нужен переменный FPS
+        cmd += ['-vsync', '0', '-f', 'rawvideo', '-pix_fmt', self.pix_fmt, 'pipe:1']
+        return cmd
+
+    def _start(self):
+        """Запускает ffmpeg и ждет описания потоков. Возвращает False, если видео не открылось."""
+        self._proc = subprocess.Popen(self.command(), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        header = threading.Event()
+        self._stderr_thread = threading.Thread(target=self._read_stderr, args=(self._proc, header),
+                                               name="ffmpeg-stderr", daemon=True)
+        self._stderr_thread.start()
+        if not header.wait(self.open_timeout) or self.width is None:
+            self.release()
+            self.error = self.log[-1] if self.log else f"ffmpeg не сообщил параметры видео за {self.open_timeout} с"
+            return False
+        return True
+
+    def _read_stderr(self, proc, header):
+        """Разбирает описание входного и выходного потоков и хранит последние строки журнала."""
+        section = None
+        for raw in iter(proc.stderr.readline, b''):
+            line = raw.decode(errors='replace').rstrip()
+            self.log.append(line)
+            if header.is_set():
+                continue
+            if line.startswith('Input #'):
+                section = 'input'
+            elif line.startswith('Output #'):
+                section = 'output'
+            elif section == 'input' and 'Duration:' in line:
+                match = _DURATION.search(line)
+                self._duration = (int(match[1]) * 3600 + int(match[2]) * 60 + float(match[3])) if match else 0.0
+            elif section is not None and 'Video:' in line:
+                size = _SIZE.search(line)
+                if size is None:
+                    continue
+                if section == 'input' and not self.source_width:
+                    self.source_width, self.source_height = int(size[1]), int(size[2])
+                    rate = _FPS.search(line)
+                    self.source_fps = float(rate[1]) if rate else 0.0
+                    self.source_frame_count = int(round(self._duration * self.source_fps))
+                elif section == 'output':
+                    self.width, self.height = int(size[1]), int(size[2])
+                    header.set()
+        header.set()  # ffmpeg завершился, так и не начав выдавать кадры
+        proc.stderr.close()
+
+    def isOpened(self):
+        return self._proc is not None
+
+    def _frame_buffer(self):
+        if not self._buffers:
+            return np.empty(self._shape, dtype=np.uint8)
+        frame = self._buffers[self._next_buffer]
+        self._next_buffer = (self._next_buffer + 1) % len(self._buffers)
+        return frame
+
+    def _read_into(self, frame):
+        view = memoryview(frame).cast('B')
+        filled = 0
+        while filled < self.frame_bytes:
+            count = self._proc.stdout.readinto(view[filled:])
+            if not count:
+                return False
+            filled += count
+        return True
+
+    def grab(self):
+        if self._proc is None:
+            return False
+        frame = self._frame_buffer()
+        if not self._read_into(frame):
+            self._finish()
+            self._grabbed = None
+            return False
+        self._grabbed = frame
+        self._position += 1
+        return True
+
+    def retrieve(self):
+        return (self._grabbed is not None), self._grabbed
+
+    def read(self):
+        if not self.grab():
+            return False, None
+        return True, self._grabbed
+
+    def _finish(self):
+        if self._proc is None:
+            return
+        self._proc.stdout.close()
+        returncode = self._proc.wait()
+        self._stderr_thread.join(timeout=5)
+        if returncode != 0 and self.log:
+            self.error = self.log[-1]
+            print(f"Предупреждение: ffmpeg завершился с ошибкой для {self.source}: {self.error}")
+        self._proc = None
+
+    def get(self, prop):
+        if prop == cv2.CAP_PROP_FRAME_WIDTH:
+            return float(self.width or 0)
+        if prop == cv2.CAP_PROP_FRAME_HEIGHT:
+            return float(self.height or 0)
+        if prop == cv2.CAP_PROP_FPS:
+            return self.output_fps
+        if prop == cv2.CAP_PROP_FRAME_COUNT:
+            if self.source_frame_count <= 0:
+                return 0.0
+            if self.fps and self.source_fps:
+                return float(int(self.source_frame_count * self.fps / self.source_fps))
+            return float(-(-self.source_frame_count // self.every_nth))
+        if prop == cv2.CAP_PROP_POS_FRAMES:
+            return float(self._position)
+        if prop == cv2.CAP_PROP_POS_MSEC:
+            return 1000.0 * self._position / self.output_fps if self.output_fps else 0.0
+        return 0.0
+
+    def set(self, prop, value):
+        """Поддерживается только перемотка CAP_PROP_POS_FRAMES (в кадрах на выходе декодера)."""
+        if prop != cv2.CAP_PROP_POS_FRAMES or not self.output_fps or self.width is None:
+            return False
+        self.release()
+        self._position = int(value)
+        self._start_seconds = self._position / self.output_fps
+        return self._start()
+
+    def release(self):
+        if self._proc is not None:
+            self._proc.kill()
+            self._proc.wait()
+            self._proc.stdout.close()
+            # stderr закрывает поток чтения журнала, получив конец pipe
+            self._stderr_thread.join(timeout=5)
+            self._proc = None
+
+
+def open_video(source, reader='opencv', **options):
+    """
+    Открывает видео выбранным способом: 'opencv' - cv2.VideoCapture (options не используются),
+    'ffmpeg' - FFmpegReader(source, **options).
+    """
+    if reader == 'ffmpeg':
+        return FFmpegReader(source, **options)
+    if reader != 'opencv':
+        raise ValueError(f"Неизвестный способ чтения видео: {reader} (доступны: {', '.join(READERS)})")
+    return cv2.VideoCapture(int(source)) if str(source).isdigit() else cv2.VideoCapture(str(source))
+
+
+def ffmpeg_available(ffmpeg_bin='ffmpeg'):
+    return shutil.which(ffmpeg_bin) is not None
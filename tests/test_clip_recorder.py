@@ -0,0 +1,44 @@
+import threading
+
+import numpy as np
+
+from clip_recorder import ClipRecorder
+
+
+def test_clip_queue_is_bounded_when_writer_lags(tmp_path):
+    recorder = ClipRecorder('cam0', tmp_path, pre_seconds=100.0, post_seconds=100.0, max_buffer_mb=1)
+    # Поток записи "завис" на диске: пока событие не установлено, кадры из очереди клипа не забираются
+    release = threading.Event()
+    write_clip = recorder._write_clip
+    recorder._write_clip = lambda clip: (release.wait(), write_clip(clip))
+
+    frame = np.zeros((100, 100, 3), dtype=np.uint8)  # 30 КБ, в бюджет 1 МБ помещается 34 кадра
+    for i in range(10):
+        recorder.add_frame(i, frame.copy())
+    recorder.observe({'frame_index': 9, 'timestamp': 0.0, 'boxes': [[0, 0.9, 1, 1, 5, 5]],
+                      'events': [{'track_id': 1, 'frame_index': 9}]})
+    for i in range(10, 200):
+        recorder.add_frame(i, frame.copy())
+
+    state = recorder.state()
+    assert state['clips_truncated'] == 1
+    assert not state['recording']
+    assert recorder._queued_bytes <= recorder.max_buffer_bytes
+
+    release.set()
+    recorder.stop()
+    assert recorder.clips_written == 1
+    assert recorder._queued_bytes == 0
+
+
+def test_clip_starts_only_on_tracker_event(tmp_path):
+    recorder = ClipRecorder('cam0', tmp_path, pre_seconds=1.0, post_seconds=0.0)
+    frame = np.zeros((10, 10, 3), dtype=np.uint8)
+    recorder.add_frame(0, frame)
+    # Кадр с рамкой, но без подтвержденного дефекта (одиночное срабатывание) клип не начинает
+    recorder.observe({'frame_index': 0, 'timestamp': 0.0, 'boxes': [[0, 0.9, 1, 1, 5, 5]]})
+    assert not recorder.state()['recording']
+    recorder.observe({'frame_index': 1, 'timestamp': 0.0, 'boxes': [[0, 0.9, 1, 1, 5, 5]],
+                      'events': [{'track_id': 1, 'frame_index': 1}]})
+    assert recorder.state()['recording']
+    recorder.stop()
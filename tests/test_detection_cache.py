@@ -0,0 +1,101 @@
+import numpy as np
+import pytest
+import torch
+
+from detection_cache import DetectionCache, DetectionLog
+
+META = {'fps': 10.0, 'width': 160, 'height': 120, 'names': {0: 'scratch', 1: 'dent'}, 'conf_floor': 0.05}
+
+
+def arrays(frames, cls, conf):
+    count = len(frames)
+    return {
+        'frame_index': np.array(frames, dtype=np.int32), 'cls': np.array(cls, dtype=np.int16),
+        'conf': np.array(conf, dtype=np.float32),
+        'xyxy': np.arange(count * 4, dtype=np.float32).reshape(count, 4),
+    }
+
+
+class FakeResult:
+    """Результат YOLO: DetectionLog.add читает только boxes.xyxy, conf и cls."""
+
+    def __init__(self, data):
+        data = torch.tensor(data, dtype=torch.float32)
+        self.boxes = type('Boxes', (), {'xyxy': data[:, :4], 'conf': data[:, 4], 'cls': data[:, 5],
+                                        '__len__': lambda boxes: len(data)})()
+
+
+def save(tmp_path, log, total_frames=10):
+    path = tmp_path / 'video.detections.npz'
+    log.save(path, total_frames, META)
+    return DetectionCache(path)
+
+
+def test_round_trip_frame_boxes(tmp_path):
+    log = DetectionLog()
+    # Рамки записаны не по порядку кадров, в том числе на первом и последнем кадре
+    log.extend(arrays([9, 0, 4, 0], [1, 0, 0, 1], [0.9, 0.8, 0.3, 0.6]))
+    cache = save(tmp_path, log)
+
+    assert cache.total_frames == 10
+    assert cache.meta['boxes'] == 4
+    assert cache.names == {0: 'scratch', 1: 'dent'}
+    assert list(cache.frame_offsets) == [0, 2, 2, 2, 2, 3, 3, 3, 3, 3, 4]
+
+    first = cache.frame_boxes(0)
+    assert first.shape == (2, 6)
+    assert sorted(first[:, 5]) == [0, 1]
+    last = cache.frame_boxes(9)
+    assert last.tolist() == [[0, 1, 2, 3, pytest.approx(0.9), 1]]
+    assert cache.frame_boxes(1).shape == (0, 6)
+    assert cache.frame_boxes(10).shape == (0, 6)  # за концом видео
+
+    assert len(cache.frame_boxes(0, conf=0.7)) == 1
+    assert cache.frame_boxes(0, class_ids={1}).tolist()[0][5] == 1
+
+
+def test_empty_log(tmp_path):
+    cache = save(tmp_path, DetectionLog(), total_frames=5)
+    assert cache.total_frames == 5
+    assert list(cache.frame_offsets) == [0] * 6
+    assert cache.frame_boxes(0).shape == (0, 6)
+    assert cache.stats() == {}
+
+
+def test_segment_logs_merge_with_frame_offset(tmp_path):
+    # Как в process_video_segments: каждый сегмент пишет свой файл с номерами кадров всего видео
+    parts = []
+    for i, start in enumerate((0, 5)):
+        part = DetectionLog(frame_offset=start)
+        part.add(1, FakeResult([[i, 0, 10, 10, 0.5, 0]]))
+        part.add(4, FakeResult([[i, 1, 10, 10, 0.6, 1], [i, 2, 10, 10, 0.7, 0]]))
+        parts.append(tmp_path / f'segment_{i}.detections.npz')
+        part.save(parts[-1], 5, META)
+    merged = DetectionLog()
+    for path in parts:
+        merged.extend(DetectionCache(path).arrays())
+    cache = save(tmp_path, merged)
+
+    assert cache.total_frames == 10
+    assert [len(cache.frame_boxes(i)) for i in range(10)] == [0, 1, 0, 0, 2, 0, 1, 0, 0, 2]
+    assert cache.frame_boxes(6)[:, :2].tolist() == [[1, 0]]
+    assert cache.frame_boxes(9)[:, :2].tolist() == [[1, 1], [1, 2]]
+
+
+def test_stats_counts_episodes(tmp_path):
+    log = DetectionLog()
+    # fps 10, пауза до 1 с (10 кадров) не разрывает эпизод: кадры 0-2 и 12 - один эпизод, 30-31 - второй
+    log.extend(arrays([0, 1, 2, 12, 30, 31, 5], [0, 0, 0, 0, 0, 0, 1], [0.9, 0.8, 0.7, 0.6, 0.5, 0.4, 0.03]))
+    cache = save(tmp_path, log, total_frames=40)
+
+    stats = cache.stats(conf=0.05)
+    assert set(stats) == {'scratch'}
+    scratch = stats['scratch']
+    assert scratch['boxes'] == 6
+    assert scratch['frames'] == 6
+    assert scratch['episodes'] == 2
+    assert scratch['frame_share'] == 0.15
+    assert scratch['first_sec'] == 0.0 and scratch['last_sec'] == 3.1
+    assert type(scratch['first_sec']) is float and type(scratch['last_sec']) is float
+    assert cache.stats(conf=0.55)['scratch']['episodes'] == 1
+    assert cache.stats(conf=0.0, class_ids={1})['dent']['frames'] == 1
@@ -0,0 +1,58 @@
+from types import SimpleNamespace
+
+import pytest
+from starlette.testclient import TestClient
+
+import inference_server
+from asgi_server import create_app
+from startup import StartupState
+from stream_pipeline import SourceStream
+
+
+class FakeStream:
+    """Источник без захвата: разбор значения - настоящий SourceStream.set_frame_skip."""
+
+    source_id = 'cam0'
+    set_frame_skip = SourceStream.set_frame_skip
+
+    def __init__(self):
+        self.adaptive_skip = False
+        self.capture = SimpleNamespace(frame_skip=1)
+
+    def frame_skip_state(self):
+        return {'frame_skip': self.capture.frame_skip}
+
+
+class FakePipeline:
+    def __init__(self):
+        self.streams = {'cam0': FakeStream()}
+
+
+@pytest.fixture
+def asgi_client():
+    startup = StartupState()
+    startup.pipeline = FakePipeline()
+    return TestClient(create_app(startup))
+
+
+@pytest.fixture
+def flask_client(monkeypatch):
+    monkeypatch.setattr(inference_server, 'pipeline', FakePipeline())
+    return inference_server.app.test_client()
+
+
+@pytest.mark.parametrize('body, status, frame_skip', [
+    ({'value': 3}, 200, 3), (3, 200, 3), ('3', 200, 3), ('auto', 200, 1), ([], 400, 1), (None, 400, 1),
+    ({}, 400, 1), (2.7, 400, 1), ({'value': 2.0}, 400, 1), (True, 400, 1), (0, 400, 1),
+])
+def test_frame_skip_json_body(asgi_client, flask_client, body, status, frame_skip):
+    asgi_response = asgi_client.post('/frame_skip', json=body)
+    flask_response = flask_client.post('/frame_skip', json=body)
+    assert asgi_response.status_code == flask_response.status_code == status
+    if status == 200:
+        assert asgi_response.json() == flask_response.json == {'cam0': {'frame_skip': frame_skip}}
+
+
+def test_frame_skip_invalid_json(asgi_client):
+    response = asgi_client.post('/frame_skip', content=b'{', headers={'content-type': 'application/json'})
+    assert response.status_code == 400
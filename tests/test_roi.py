@@ -0,0 +1,23 @@
+import numpy as np
+import pytest
+
+from roi import check_roi, crop
+
+
+def test_check_roi_clips_to_frame():
+    assert check_roi((100, 50, 200, 200), (120, 160, 3), 'cam0') == (100, 50, 60, 70)
+    assert check_roi((10, 10, 20, 20), (120, 160, 3), 'cam0') == (10, 10, 20, 20)
+    assert check_roi(None, (120, 160, 3), 'cam0') is None
+
+
+def test_check_roi_outside_frame_uses_full_frame(capsys):
+    assert check_roi((1000, 1000, 50, 50), (120, 160, 3), 'cam0') is None
+    assert '[cam0]' in capsys.readouterr().out
+
+
+def test_crop_rejects_roi_outside_frame():
+    frame = np.zeros((120, 160, 3), dtype=np.uint8)
+    cropped, offset = crop(frame, (100, 50, 200, 200))
+    assert cropped.shape == (70, 60, 3) and offset == (100, 50)
+    with pytest.raises(ValueError):
+        crop(frame, (1000, 1000, 50, 50))
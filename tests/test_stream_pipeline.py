@@ -0,0 +1,84 @@
+import time
+
+import cv2
+import numpy as np
+import torch
+from ultralytics.engine.results import Results
+
+from stream_pipeline import DetectionPipeline
+
+
+class FirstCallModel:
+    """Модель, которая находит дефект только при первом вызове."""
+
+    names = {0: 'defect'}
+
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self, images, **kwargs):
+        self.calls += 1
+        results = []
+        for image in images:
+            boxes = torch.zeros((0, 6))
+            if self.calls == 1:
+                boxes = torch.tensor([[10.0, 10.0, 50.0, 50.0, 0.9, 0.0]])
+            result = Results(image, path='', names=self.names, boxes=boxes)
+            result.speed = {'preprocess': 0.0, 'inference': 0.0, 'postprocess': 0.0}
+            results.append(result)
+        return results
+
+
+def write_static_video(path, frames=50, size=(160, 120)):
+    writer = cv2.VideoWriter(str(path), cv2.VideoWriter_fourcc(*'MJPG'), 25, size)
+    frame = np.full((size[1], size[0], 3), 128, dtype=np.uint8)
+    for _ in range(frames):
+        writer.write(frame)
+    writer.release()
+
+
+def test_gated_frames_do_not_confirm_tracks(tmp_path):
+    video = tmp_path / 'static.avi'
+    write_static_video(video)
+    model = FirstCallModel()
+    pipeline = DetectionPipeline(model, {'cam0': str(video)}, conf=0.5,
+                                 motion_gate={'threshold': 0.01, 'max_interval': 1000.0},
+                                 tracking={'confirm_hits': 3, 'max_missed': 100})
+    assert pipeline.start() == []
+    stream = pipeline.streams['cam0']
+    try:
+        deadline = time.monotonic() + 10
+        while stream.timings.snapshot()['counters'].get('frames_gated', 0) < 5 and time.monotonic() < deadline:
+            time.sleep(0.05)
+    finally:
+        pipeline.stop()
+
+    counters = stream.timings.snapshot()['counters']
+    assert counters.get('frames_gated', 0) >= 5
+    assert model.calls == 1
+    assert counters.get('defect_events', 0) == 0
+    assert not any(track.confirmed for track in stream.tracker.tracks)
+
+
+def test_roi_outside_frame_falls_back_to_full_frame(tmp_path, capsys):
+    video = tmp_path / 'static.avi'
+    write_static_video(video)
+    model = FirstCallModel()
+    shapes = []
+    call = model.__call__
+    model_fn = lambda images, **kwargs: shapes.extend(image.shape for image in images) or call(images, **kwargs)
+    model_fn.names = model.names
+    pipeline = DetectionPipeline(model_fn, {'cam0': str(video)}, conf=0.5, rois={'default': (1000, 1000, 50, 50)})
+    assert pipeline.start() == []
+    stream = pipeline.streams['cam0']
+    try:
+        deadline = time.monotonic() + 10
+        while model.calls < 3 and time.monotonic() < deadline:
+            time.sleep(0.05)
+    finally:
+        pipeline.stop()
+
+    assert model.calls >= 3
+    assert set(shapes) == {(120, 160, 3)}
+    assert stream.roi is None
+    assert '[cam0]' in capsys.readouterr().out